@@ -0,0 +1,489 @@
+#!/usr/bin/env python3
+
+# Copyright 2016-2019 Thomas Krug
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import docutils
+import docutils.core
+
+from render import engine, html_writer, Pipeline
+from preprocess import handle_spaces, handle_spaces_, Preprocessor
+from index import grep_batch, rst_files as note_files
+from links import find_refs, local, parse_refs, scan_refs
+
+# render benchmark:
+#
+#   labnote bench demo
+#   labnote bench --json run.json --scale 10 ~/notes
+#
+# microbenchmarks, run from the repository:
+#
+#   ./bench.py --micro engine demo
+
+
+def rst_files(path):
+    files = []
+    for cd, subdirs, fs in os.walk(path):
+        if ".git" in cd:
+            continue
+        for f in sorted(fs):
+            if f.endswith(".rst"):
+                files.append(os.path.join(cd, f))
+    return files
+
+
+def timeit(func, rounds):
+    # best of rounds, in ms
+    best = None
+    for i in range(rounds):
+        start = time.perf_counter()
+        func()
+        delta = time.perf_counter() - start
+        if best is None or delta < best:
+            best = delta
+    return best * 1000
+
+
+def report(name, results):
+    print("")
+    print(name)
+    for (f, old, new) in results:
+        print("  {:40} {:8.2f} ms {:8.2f} ms  x{:.1f}".format(f, old, new, old / new))
+    old = sum(r[1] for r in results)
+    new = sum(r[2] for r in results)
+    print("  {:40} {:8.2f} ms {:8.2f} ms  x{:.1f}".format("total", old, new, old / new))
+
+
+## engine
+#
+# publish_* set up a new publisher for every call, an engine is reused
+
+def bench_engine(files, rounds):
+
+    args = {
+        "_disable_config": True,
+        "embed_stylesheet": False,
+        "stylesheet_path": "",
+        "stylesheet": "",
+        "math_output": "HTML",
+        "output_encoding": "unicode"
+    }
+
+    html = []
+    tex = []
+    for fp in files:
+        with open(fp, "r") as f:
+            rst = f.read()
+        dtree = docutils.core.publish_doctree(rst, settings_overrides={"_disable_config": True})
+
+        # writing changes the doctree, labnote writes a fresh one each time
+
+        def old_html():
+            writer = html_writer()
+            docutils.core.publish_from_doctree(dtree.deepcopy(), writer=writer,
+                                               settings_overrides=args)
+            return writer.parts["html_body"]
+
+        def new_html():
+            engine_ = engine("doctree", html_writer, args)
+            engine_.publish(dtree.deepcopy())
+            return engine_.parts["html_body"]
+
+        def old_tex():
+            return docutils.core.publish_string(rst, writer_name="latex",
+                                                settings_overrides={"doctitle_xform": False,
+                                                                    "latex_preamble": ""})
+
+        def new_tex():
+            return engine("string", "latex", {"doctitle_xform": False}).publish(rst, latex_preamble="")
+
+        if old_html() != new_html():
+            print("html output differs:", fp)
+        html.append((fp, timeit(old_html, rounds), timeit(new_html, rounds)))
+
+        try:
+            if old_tex() != new_tex():
+                print("tex output differs:", fp)
+        except NotImplementedError:
+            # same as rst2tex
+            continue
+        tex.append((fp, timeit(old_tex, rounds), timeit(new_tex, rounds)))
+
+    report("html writer (publish_from_doctree / engine)", html)
+    report("latex (publish_string / engine)", tex)
+
+
+## preprocess
+#
+# handle_spaces on a 10k line file made of the given files
+
+def bench_preprocess(files, rounds):
+
+    lines = []
+    while len(lines) < 10000:
+        for fp in files:
+            with open(fp, "r") as f:
+                lines.extend(f.read().splitlines())
+    rst = "\n".join(lines[:10000]) + "\n"
+
+    if handle_spaces_(rst) != handle_spaces(rst):
+        print("output differs")
+
+    # typing in the middle of the file
+    edit = lines[:5000] + ["`new link <some file.rst>`_"] + lines[5000:9999]
+    edit = "\n".join(edit) + "\n"
+    prep = Preprocessor()
+
+    def incremental():
+        prep(rst)
+        prep(edit)
+
+    res = [("handle_spaces", timeit(lambda: handle_spaces_(rst), rounds),
+                             timeit(lambda: handle_spaces(rst), rounds)),
+           ("handle_spaces, edit (2 calls)", timeit(lambda: (handle_spaces_(rst), handle_spaces_(edit)), rounds),
+                                             timeit(incremental, rounds))]
+
+    report("preprocess, 10k lines (previous / shared)", res)
+
+
+## grep
+#
+# Global search over a tree of 2000 notes made of the given files, with
+# the walk and line by line regex of the previous grep as reference.
+
+def grep_(pattern, dirpath):
+    # previous implementation
+    r = re.compile(pattern, flags=re.IGNORECASE)
+    res = []
+    for parent, dirs, files in os.walk(dirpath):
+        for f in files:
+            filepath = os.path.join(parent, f)
+            if os.path.isfile(filepath) and filepath.endswith(".rst"):
+                with open(filepath) as f:
+                    for (lineno, line) in enumerate(f):
+                        if r.search(line):
+                            filepath = os.path.normpath(filepath)
+                            filepath = filepath.replace(dirpath, "", 1)
+                            if filepath[0] == "/":
+                                filepath = filepath[1:]
+                            res.append([str(lineno+1), filepath, line.strip()])
+    return res
+
+
+def bench_grep(files, rounds):
+
+    texts = []
+    for fp in files:
+        with open(fp, "r") as f:
+            texts.append(f.read())
+
+    root = tempfile.mkdtemp()
+    try:
+        for i in range(2000):
+            d = os.path.join(root, "d{}".format(i % 40))
+            os.makedirs(d, exist_ok=True)
+            with open(os.path.join(d, "n{}.rst".format(i)), "w") as f:
+                f.write(texts[i % len(texts)])
+
+        def new(pattern):
+            batch = [(path, None) for path in sorted(note_files(root))]
+            return grep_batch(pattern, root, batch)
+
+        res = []
+        for pattern in ("docutils", "image::", "zzzz", r"^\.\. \w+::"):
+            if sorted(grep_(pattern, root)) != sorted(new(pattern)):
+                print("results differ:", pattern)
+            res.append((pattern, timeit(lambda: grep_(pattern, root), rounds),
+                                 timeit(lambda: new(pattern), rounds)))
+    finally:
+        shutil.rmtree(root)
+
+    report("grep, 2000 files (previous / literal fast path)", res)
+
+
+## links
+#
+# Local references of every file and of a tree of 2000 notes made of them,
+# parsed by docutils and scanned.  Files the scanner gives up on are parsed
+# as well, the second tree is made of the others only.  Lines differ for
+# images only.
+
+def bench_links(files, rounds):
+
+    texts = []
+    for fp in files:
+        with open(fp, "r") as f:
+            texts.append(f.read())
+
+    def parsed(rst):
+        return [(line, ref) for (line, ref) in parse_refs(rst) if local(ref)]
+
+    res = []
+    for (fp, rst) in zip(files, texts):
+        if [ref for (line, ref) in parsed(rst)] != [ref for (line, ref) in find_refs(rst)]:
+            print("results differ:", fp)
+        name = fp if scan_refs(rst) is not None else fp + " (parsed)"
+        res.append((name, timeit(lambda: parsed(rst), rounds), timeit(lambda: find_refs(rst), rounds)))
+    report("links (docutils / scanner)", res)
+
+    # once, docutils takes a while
+    res = []
+    plain = [rst for rst in texts if scan_refs(rst) is not None]
+    for (name, docs) in (("2000 files", texts), ("2000 files, none parsed", plain)):
+        if not docs:
+            continue
+        tree = [docs[i % len(docs)] for i in range(2000)]
+        res.append((name, timeit(lambda: [parsed(rst) for rst in tree], 1),
+                          timeit(lambda: [find_refs(rst) for rst in tree], 1)))
+    report("links, tree (docutils / scanner)", res)
+
+
+## pipeline
+#
+# Renders every document the way the editor does: first with empty caches
+# (opening the file), then while typing a word into a new paragraph in the
+# middle of it (incremental).
+
+def percentile(values, p):
+    # nearest rank
+    values = sorted(values)
+    if not values:
+        return None
+    k = max(0, min(len(values) - 1, math.ceil(p / 100 * len(values)) - 1))
+    return values[k]
+
+
+def latency(values):
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values) if values else None,
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else None,
+    }
+
+
+def typing(rst, rounds):
+    # snapshots while typing into a new paragraph in the middle,
+    # returns [(rst, cursor line)]
+    lines = rst.splitlines()
+    mid = len(lines) // 2
+    # next block boundary
+    while mid < len(lines) and lines[mid].strip():
+        mid += 1
+    head = lines[:mid]
+    tail = lines[mid:]
+    word = "typing"
+    res = []
+    for i in range(rounds):
+        text = word[:i % len(word) + 1] * (i // len(word) + 1)
+        res.append(("\n".join(head + ["", text] + tail) + "\n", mid + 1))
+    return res
+
+
+def bench_pipeline(files, root, rounds, scale):
+
+    docs = []
+    total_open = []
+    total_type = []
+    chars = 0
+    seconds = 0
+
+    for fp in files:
+        with open(fp, "r") as f:
+            rst = f.read()
+        rst = "\n".join([rst] * scale)
+        rel = os.path.relpath(fp, root)
+
+        pipeline = Pipeline(root)
+
+        # opening the file, caches are empty
+        opened = []
+        for i in range(rounds):
+            pipeline.set_file(rel)
+            start = time.perf_counter()
+            pipeline.render(rst)
+            opened.append((time.perf_counter() - start) * 1000)
+        chars += len(rst) * rounds
+        seconds += sum(opened) / 1000
+
+        # typing, caches are warm
+        typed = []
+        for (text, line) in typing(rst, rounds):
+            start = time.perf_counter()
+            pipeline.render(text, line)
+            typed.append((time.perf_counter() - start) * 1000)
+
+        # not timed, tracing slows python down
+        pipeline.set_file(rel)
+        tracemalloc.start()
+        pipeline.render(rst)
+        (current, peak) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        docs.append({
+            "file": rel,
+            "size": len(rst),
+            "lines": rst.count("\n") + 1,
+            "open": latency(opened),
+            "typing": latency(typed),
+            "peak_memory": peak,
+            "phases": pipeline.stats.summary(),
+        })
+        total_open.extend(opened)
+        total_type.extend(typed)
+
+    return {
+        "root": os.path.abspath(root),
+        "rounds": rounds,
+        "scale": scale,
+        "documents": docs,
+        "open": latency(total_open),
+        "typing": latency(total_type),
+        # opening files back to back
+        "throughput": {
+            "documents_per_second": len(total_open) / seconds if seconds else None,
+            "chars_per_second": chars / seconds if seconds else None,
+        },
+        # kilobytes on linux
+        "max_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def print_pipeline(res):
+    print("{:40} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8} {:>10}".format(
+        "document", "chars", "open50", "open95", "type50", "type95", "type99", "peak kB"))
+    for doc in res["documents"]:
+        print("{:40} {:8} {:8.2f} {:8.2f} {:8.2f} {:8.2f} {:8.2f} {:10.0f}".format(
+            doc["file"], doc["size"], doc["open"]["p50"], doc["open"]["p95"],
+            doc["typing"]["p50"], doc["typing"]["p95"], doc["typing"]["p99"],
+            doc["peak_memory"] / 1024))
+    print("")
+    for name in ("open", "typing"):
+        lat = res[name]
+        print("{:8} p50 {:8.2f} ms  p95 {:8.2f} ms  p99 {:8.2f} ms  max {:8.2f} ms".format(
+            name, lat["p50"], lat["p95"], lat["p99"], lat["max"]))
+    thr = res["throughput"]
+    print("throughput {:.1f} documents/s, {:.0f} kchars/s".format(
+        thr["documents_per_second"], thr["chars_per_second"] / 1000))
+    print("max rss {} kB".format(res["max_rss"]))
+
+
+## incremental
+#
+# Typing into a generated note of 300 sections, rendered whole and by
+# blocks.  Links with the same text give a message on every render, the
+# block renderer has to parse the whole note then.
+
+def sectioned(sections, duplicates):
+    parts = []
+    for i in range(sections):
+        title = "Section {}".format(i)
+        link = "`here <a{}.rst>`_".format(i) if duplicates else "`note {0} <a{0}.rst>`_".format(i)
+        parts.append("{}\n{}\n\n"
+                     "Some text of section {} with *emphasis* and ``code``,\n"
+                     "a link to {} and one more line.\n\n"
+                     "- first item\n- second item\n\n"
+                     "An example::\n\n    x = {}\n\n"
+                     ".. note:: Keep this in mind.\n".format(title, "=" * len(title), i, link, i))
+    return "\n".join(parts)
+
+
+def bench_incremental(files, rounds):
+
+    res = []
+    for duplicates in (False, True):
+        rst = sectioned(300, duplicates)
+        edits = typing(rst, rounds)
+        times = []
+        for incremental in (False, True):
+            pipeline = Pipeline(".")
+            pipeline.incremental = incremental
+            pipeline.render(rst)
+            start = time.perf_counter()
+            for (text, line) in edits:
+                pipeline.render(text, line)
+            times.append((time.perf_counter() - start) * 1000 / len(edits))
+        name = "300 sections" + (", same link texts" if duplicates else "")
+        res.append((name, times[0], times[1]))
+
+    report("typing, per edit (full / incremental)", res)
+
+
+benchmarks = {
+    "engine": bench_engine,
+    "grep": bench_grep,
+    "incremental": bench_incremental,
+    "links": bench_links,
+    "preprocess": bench_preprocess,
+}
+
+
+def main(argv):
+
+    parser = argparse.ArgumentParser(prog="labnote bench")
+    parser.add_argument("--rounds", "-n", type=int, default=20)
+    parser.add_argument("--scale", type=int, default=1,
+                        help="repeat every document this many times")
+    parser.add_argument("--json", metavar="PATH",
+                        help="write results as json, - for stdout")
+    parser.add_argument("--micro", choices=sorted(benchmarks),
+                        help="run a microbenchmark instead")
+    parser.add_argument("path", nargs="?", default="demo")
+    args = parser.parse_args(argv)
+
+    files = rst_files(args.path)
+    if not files:
+        print("no rst files in", args.path)
+        return 1
+
+    if args.micro:
+        # docutils reports to stderr
+        with contextlib.redirect_stderr(io.StringIO()):
+            benchmarks[args.micro](files, args.rounds)
+        return 0
+
+    res = bench_pipeline(files, args.path, args.rounds, args.scale)
+
+    if args.json == "-":
+        json.dump(res, sys.stdout, indent=2)
+        print("")
+        return 0
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(res, f, indent=2)
+            f.write("\n")
+
+    print_pipeline(res)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -16,16 +16,27 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
+import concurrent.futures
 import contextlib
+import functools
+import hashlib
 import io
+import json
 import os
+import pathlib
 import re
 import sys
+import urllib.parse
 
 import docutils
 import docutils.core
 import docutils.utils
 
+from index import cache_path
+from links import LinkGraph, doctree_refs, local, scan_refs
+from preprocess import handle_spaces, rechar
+from registry import Registry
+
 # TODO
 #
 # git gc
@@ -71,66 +82,222 @@ def rst2dtree(rst):
     return err.getvalue(), dtree
 
 
-rechar = u"\u02FD"
-def handle_spaces(rstin):
-    rstout = ""
-    reg = re.compile("`.*<.* .*>`_")
-    for line in rstin.splitlines():
-        mat = reg.search(line)
-        if mat:
-            state = 0
-            tl = ""
-            for (i, c) in enumerate(line):
-                if state == 0 and c == '`':
-                    state = 1
-                if state == 1 and c == '<':
-                    state = 2
-                if state == 2 and c == '`':
-                    state = 0
-                if state == 2 and c == ' ':
-                    c = rechar
-                tl += c
-            line = tl
-        rstout += line + "\n"
-    return rstout
-
-
-def handle_rst(f, cd, sd, verbose):
+todo_re = re.compile("TODO|FIXME", re.IGNORECASE)
+
+# start of a parser message in the output of rst2dtree
+message_re = re.compile(r"^<string>:(\d*): \((\w+)/(\d)\) ", re.MULTILINE)
 
-    filepath = os.path.join(cd, f)
-    rst = None
-    with open(filepath, "r") as fh:
-        rst = fh.read()
+
+def find_todos(rst):
+    # [(line, text)] of the lines with TODO or FIXME, text with its newline
+    if not todo_re.search(rst):
+        return []
+    lines = rst.split("\n")
+    return [(no + 1, line + "\n" if no + 1 < len(lines) else line)
+            for (no, line) in enumerate(lines) if todo_re.search(line)]
+
+
+def parse_messages(err):
+    # [(line or None, level, text)] of the parser messages in err
+    res = []
+    found = list(message_re.finditer(err))
+    for (k, m) in enumerate(found):
+        end = found[k + 1].start() if k + 1 < len(found) else len(err)
+        line = int(m.group(1)) if m.group(1) else None
+        res.append((line, int(m.group(3)), err[m.end():end].strip()))
+    return res
+
+
+def parse_rst(filepath, messages=False):
+    # the slow part of handle_rst, runs in a worker process with --jobs
+    # everything check.py needs of a note, the file is read once
+    # returns {"empty", "output", "messages": of the parser, "refs": [(line, ref)]
+    # or None if parsing failed, "todos": [(line, text)], "lines": count,
+    # "hash": sha1 of what was parsed, for the cache}
+    # messages: parse with docutils for its messages, else they are None
+    # if the references could be scanned without it
+    #
+    # the references are those of links.find_refs either way, docutils
+    # only adds the messages, so the link data does not depend on them
+
+    with open(filepath, "rb") as fh:
+        data = fh.read()
+    # decoded like open() in text mode
+    rst = io.TextIOWrapper(io.BytesIO(data)).read()
+
+    res = {"empty": not rst, "output": "", "messages": "", "refs": [],
+           "todos": find_todos(rst), "lines": len(rst.splitlines()),
+           "hash": hashlib.sha1(data).hexdigest()}
 
     if not rst:
+        return res
+
+    refs = scan_refs(rst)
+    if refs is not None and not messages:
+        res.update(messages=None, refs=refs)
+        return res
+
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        (err, dtree) = rst2dtree(handle_spaces(rst))
+    res.update(output=out.getvalue(), messages=err)
+
+    if refs is None and dtree:
+        refs = [(line, ref.replace(rechar, " ")) for (line, ref) in doctree_refs(dtree) if local(ref)]
+
+    res["refs"] = refs
+    return res
+
+
+## cache
+#
+# Results of parse_rst by path, with mtime, size and hash of the file they
+# were parsed from, in .labnote/check-cache.  Files are only parsed again
+# if they changed, touched files are recognized by their hash.  Whether a
+# referenced file exists is looked up in the registry walk on every run.
+
+# results of other versions are not used
+cache_version = "4 " + docutils.__version__
+
+
+def load_cache(path):
+    try:
+        with open(path, "r") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if cache.get("version") != cache_version:
+        return {}
+    return cache["files"]
+
+
+def save_cache(path, files):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump({"version": cache_version, "files": files}, f)
+    os.rename(tmp, path)
+
+
+def cached(entry, path, registry, messages=False):
+    # parse_rst result of entry if path did not change, else None
+    if not entry or (messages and entry["parsed"]["messages"] is None):
+        return None
+    stat = registry.stat(path)
+    if stat == (entry["mtime"], entry["size"]):
+        return entry["parsed"]
+    if stat and registry.hash(path) == entry["hash"]:
+        (entry["mtime"], entry["size"]) = stat
+        return entry["parsed"]
+    return None
+
+
+## findings
+#
+# What is wrong with the notes, besides the text output, for --format json
+# and sarif.  Paths are relative to the checked directory, lines start at 1
+# and are None if unknown.
+
+# rule -> (level, description), level None if it depends on the result
+rules = {
+    "missing": ("error", "Referenced file is missing"),
+    "parse-failed": ("error", "File could not be parsed"),
+    "parser": (None, "Message of the rst parser"),
+    "todo": ("note", "Line contains TODO or FIXME"),
+    "unreferenced": ("note", "File is not referenced by any note"),
+}
+
+# docutils message levels, info, warning, error and severe
+message_levels = {1: "note", 2: "warning", 3: "error", 4: "error"}
+
+sarif_schema = "https://json.schemastore.org/sarif-2.1.0.json"
+
+
+class Findings():
+
+    def __init__(self, root=None):
+        self.root = root
+        # {"rule", "level", "path", "line", "message"} in the order found
+        self.results = []
+        self.stats = {}
+        # source -> [(line, target)]
+        self.links = {}
+
+    def add(self, rule, path, line, message, level=None):
+        self.results.append({"rule": rule, "level": level or rules[rule][0],
+                             "path": path, "line": line, "message": message})
+
+    def count(self, rule):
+        return sum(1 for r in self.results if r["rule"] == rule)
+
+    def to_json(self):
+        return {
+            "root": self.root,
+            "stats": self.stats,
+            "links": self.links,
+            "results": self.results,
+        }
+
+    def to_sarif(self):
+        results = []
+        for r in self.results:
+            location = {"artifactLocation": {"uri": urllib.parse.quote(r["path"]),
+                                             "uriBaseId": "ROOT"}}
+            if r["line"]:
+                location["region"] = {"startLine": r["line"]}
+            results.append({
+                "ruleId": r["rule"],
+                "level": r["level"],
+                "message": {"text": r["message"]},
+                "locations": [{"physicalLocation": location}],
+            })
+        driver = {
+            "name": "labnote check",
+            "rules": [{"id": rule, "shortDescription": {"text": text}}
+                      for (rule, (level, text)) in sorted(rules.items())],
+        }
+        run = {"tool": {"driver": driver}, "results": results,
+               "properties": {"stats": self.stats}}
+        if self.root:
+            run["originalUriBaseIds"] = {"ROOT": {"uri": pathlib.Path(self.root).as_uri() + "/"}}
+        return {"$schema": sarif_schema, "version": "2.1.0", "runs": [run]}
+
+
+def handle_rst(f, cd, sd, verbose, exists=os.path.exists, parsed=None, findings=None):
+    # parsed: result of parse_rst, if already done
+    # findings: gets what is wrong with the file
+    # returns [(line, path)] of the referenced files
+
+    filepath = os.path.join(cd, f)
+    if parsed is None:
+        parsed = parse_rst(filepath)
+    if findings is None:
+        findings = Findings()
+    path = os.path.relpath(filepath, sd)
+
+    if parsed["empty"]:
         print("file deleted since walk:", f)
         return []
 
-    rst = handle_spaces(rst)
-    (err, dtree) = rst2dtree(rst)
+    sys.stdout.write(parsed["output"])
+    err = parsed["messages"]
     if err and verbose:
         print("----------")
         print("error while parsing:", filepath)
         print("")
         print(err)
         print("")
+    for (line, level, text) in parse_messages(err or ""):
+        findings.add("parser", path, line, text, message_levels.get(level, "note"))
 
-    if not dtree:
+    found = parsed["refs"]
+    if found is None:
         print("error parsing file:", f)
+        findings.add("parse-failed", path, None, "could not be parsed")
         return []
 
 
     refs = []
-    for elem in dtree.traverse(siblings=True):
-        ref = None
-        if elem.tagname == "reference":
-            ref = elem.get("refuri")
-        if elem.tagname == "image":
-            ref = elem.get("uri")
-
-        if not ref:
-            continue
-
+    for (line, ref) in found:
 
         ignore = ["http://", "https://", "ftp://", "ftps://", "mailto:", "nfs://", "ldap://", "about:"]
 
@@ -149,86 +316,179 @@ def handle_rst(f, cd, sd, verbose):
             print("could not parse", ref)
             continue
 
-        if not os.path.exists(p):
+        if not exists(p):
             print("")
             print(f)
-            print("referenced file in line {} missing: {}".format(elem.parent.line, ref))
+            print("referenced file in line {} missing: {}".format(line, ref))
             print(p)
+            findings.add("missing", path, line, "referenced file missing: " + ref)
             continue
 
-        refs.append(p)
+        refs.append((line, p))
 
 
     return refs
 
 
 
-if __name__ == "__main__":
-
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--verbose", "-v", action="store_true")
-    parser.add_argument("path")
-    args = parser.parse_args()
-    dirpath = args.path
+def check(args, findings):
+    # prints what it finds, and adds it to findings
 
     print("==========")
-    startdir = os.path.abspath(dirpath)
+    startdir = os.path.abspath(args.path)
     print("checking:", startdir)
+    findings.root = startdir
 
+    # --graph is relative to it
+    cwd = os.getcwd()
     os.chdir(startdir)
 
-    refs = []
     nonrst = []
     rst = []
 
-    for cd, subdirs, files in os.walk(startdir):
+    def rel(p):
+        # graph paths are relative to the notes, unless outside of them
+        r = os.path.relpath(p, startdir)
+        return p if r.startswith("..") else r
+
+    graph = LinkGraph()
+
+    # walked once, references are looked up in it
+    registry = Registry(startdir)
+    # sorted, so output is the same for any number of jobs
+    paths = sorted(registry.scan())
+
+    notes = [p for p in paths if p.endswith(".rst") and os.path.basename(p) != ".gitignore"]
+
+    # parser messages are only shown with --verbose, and kept for the other formats
+    messages = args.verbose or args.format != "text"
+
+    cache_file = cache_path(startdir, "check-cache")
+    cache = {} if args.no_cache else load_cache(cache_file)
+    results = {}
+    for p in notes:
+        res = cached(cache.get(p), p, registry, messages)
+        if res is not None:
+            results[p] = res
+
+    # parsed in order, results are handled as they come in
+    changed = [os.path.join(startdir, p) for p in notes if p not in results]
+    parse = functools.partial(parse_rst, messages=messages)
+    if args.jobs > 1 and len(changed) > 1:
+        pool = concurrent.futures.ProcessPoolExecutor(args.jobs)
+        parsed = pool.map(parse, changed, chunksize=4)
+    else:
+        pool = None
+        parsed = map(parse, changed)
+    files = {}
+    # [(path, line, text)], found while parsing
+    todos = []
+    lines = 0
 
-        if ".git" in cd:
-            continue
+    for path in paths:
 
-        for f in files:
+        (cd, f) = os.path.split(os.path.join(startdir, path))
 
-            if f == ".gitignore":
-                continue
+        if f == ".gitignore":
+            continue
 
-            if f.endswith(".rst"):
-                r = handle_rst(f, cd, startdir, args.verbose)
-                refs.extend(r)
-                rst.append(os.path.join(cd, f))
+        if f.endswith(".rst"):
+            if path in results:
+                res = results[path]
+                entry = cache[path]
             else:
-                nonrst.append(os.path.join(cd, f))
+                res = next(parsed)
+                (mtime, size) = registry.stat(path)
+                # the hash of what was parsed, the file may have changed since
+                entry = {"mtime": mtime, "size": size, "hash": res["hash"], "parsed": res}
+            files[path] = entry
+            r = handle_rst(f, cd, startdir, args.verbose, registry.exists, res, findings)
+            graph.set_links(path, [(line, rel(p)) for (line, p) in r])
+            rst.append(os.path.join(cd, f))
+            todos.extend((os.path.join(cd, f), line, text) for (line, text) in res["todos"])
+            lines += res["lines"]
+        else:
+            nonrst.append(os.path.join(cd, f))
+
+    if pool:
+        pool.shutdown()
+
+    try:
+        save_cache(cache_file, files)
+    except OSError as e:
+        print("could not write cache:", e)
 
     print("")
     print("stats")
     print("files", len(rst))
-    print("references", len(refs))
+    print("references", len(graph))
 
     print("")
     print("rst not referenced:")
     for f in rst:
-        if f not in refs:
+        if not graph.linked(rel(f)):
             if f != startdir + "/index.rst":
                 print(f)
+                findings.add("unreferenced", rel(f), None, "note is not referenced")
 
     # check if all nonrst in refs
     print("")
     print("files not referenced:")
     for f in nonrst:
-        if f not in refs:
+        if not graph.linked(rel(f)):
             print(f)
+            findings.add("unreferenced", rel(f), None, "file is not referenced")
 
-    # search for TODO and FIXME
+    if args.graph:
+        with open(os.path.join(cwd, args.graph), "w") as f:
+            graph.dump(f)
+
+    # TODO and FIXME, found while parsing
     print("")
     print("files containing TODO or FIXME:")
-    for fp in rst:
-        with open(fp, "r") as f:
-            for (no, line) in enumerate(f):
-                res = re.search("(TODO|FIXME)", line, re.IGNORECASE)
-                if res:
-                    #print(fp, "#", no, ":", line)
-                    print("{} in line {}: {}".format(fp, no, line))
+    for (fp, no, line) in todos:
+        # counted from 0 in the text output
+        print("{} in line {}: {}".format(fp, no - 1, line))
+        findings.add("todo", rel(fp), no, line.strip())
 
     print("")
     print("==========")
 
+    findings.links = graph.to_json()["links"]
+    findings.stats = {
+        "files": len(rst),
+        "other_files": len(nonrst),
+        "lines": lines,
+        "references": len(graph),
+        "missing": findings.count("missing"),
+        "unreferenced": findings.count("unreferenced"),
+        "todos": len(todos),
+        "messages": findings.count("parser"),
+    }
+
+
+if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--verbose", "-v", action="store_true")
+    parser.add_argument("--jobs", "-j", type=int, default=1,
+                        help="parse files in this many processes")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="parse all files again")
+    parser.add_argument("--graph", metavar="PATH",
+                        help="write links and backlinks as json")
+    parser.add_argument("--format", choices=("text", "json", "sarif"), default="text",
+                        help="write findings as json or sarif instead of text")
+    parser.add_argument("path")
+    args = parser.parse_args()
+
+    findings = Findings()
+    if args.format == "text":
+        check(args, findings)
+    else:
+        # only the findings go to stdout
+        with contextlib.redirect_stdout(io.StringIO()):
+            check(args, findings)
+        data = findings.to_json() if args.format == "json" else findings.to_sarif()
+        json.dump(data, sys.stdout, indent=2)
+        print("")
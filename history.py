@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+
+# Copyright 2016-2019 Thomas Krug
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import datetime
+import logging
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import unittest
+
+from index import literal, odd_folds
+
+log = logging.getLogger(__name__)
+
+
+## history search
+#
+# Every version of every note ever committed, searched like the notes
+# themselves.  The versions are listed once per commit of HEAD by a single
+# git log, their contents are read through one git cat-file --batch process
+# kept running.  A blob never changes, so the matches of a pattern are kept
+# per blob and searching again only reads blobs added since.
+
+# blob of a deleted file
+null_sha = "0" * 40
+
+
+def git(root, *args):
+    # stdout as bytes, None on failure
+    try:
+        proc = subprocess.run(("git",) + args, cwd=root, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL)
+    except OSError:
+        return None
+    if proc.returncode:
+        return None
+    return proc.stdout
+
+
+def versions(root, suffix=".rst"):
+    # [(blob, commit, commit time, path)], newest first, every blob once
+    out = git(root, "log", "--format=%x01%H %ct", "--raw", "--no-abbrev",
+              "--no-renames", "-z")
+    if out is None:
+        return []
+    res = []
+    seen = set()
+    commit = None
+    fields = out.decode(errors="replace").split("\0")
+    i = 0
+    while i < len(fields):
+        field = fields[i].lstrip("\n")
+        i += 1
+        if field.startswith("\x01"):
+            (sha, ct) = field[1:].split()
+            commit = (sha, int(ct))
+        elif field.startswith(":") and i < len(fields):
+            # :mode mode blob blob status, then the path
+            blob = field.split()[3]
+            path = fields[i]
+            i += 1
+            if blob == null_sha or blob in seen or not path.endswith(suffix):
+                continue
+            seen.add(blob)
+            res.append((blob, commit[0], commit[1], path))
+    return res
+
+
+class BlobReader():
+    # contents of blobs through one git cat-file --batch
+
+    def __init__(self, root):
+        self.root = root
+        self.proc = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.proc = subprocess.Popen(["git", "cat-file", "--batch"], cwd=self.root,
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                     stderr=subprocess.DEVNULL)
+
+    def read(self, sha):
+        # bytes of a blob, None if missing, not a blob or git failed
+        # sha: or any name of an object, like commit:path
+        with self.lock:
+            try:
+                if not self.proc or self.proc.poll() is not None:
+                    self.start()
+                self.proc.stdin.write(sha.encode() + b"\n")
+                self.proc.stdin.flush()
+                header = self.proc.stdout.readline().split()
+                if len(header) != 3:
+                    # missing
+                    return None
+                size = int(header[2])
+                data = self.proc.stdout.read(size)
+                # trailing newline
+                self.proc.stdout.read(1)
+                if header[1] != b"blob":
+                    return None
+                return data
+            except (OSError, ValueError) as e:
+                log.warning("cat-file: " + str(e))
+                self.close_()
+                return None
+
+    def close_(self):
+        if self.proc:
+            self.proc.kill()
+            self.proc.wait()
+            self.proc = None
+
+    def close(self):
+        with self.lock:
+            self.close_()
+
+
+class HistorySearch():
+
+    def __init__(self, root, patterns=16):
+        self.root = root
+        self.reader = BlobReader(root)
+        # versions of HEAD
+        self.head = None
+        self.versions = []
+        # pattern -> {blob: [(line number, line)]}, for the last patterns
+        self.cache = collections.OrderedDict()
+        self.patterns = patterns
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        out = git(self.root, "rev-parse", "HEAD")
+        head = out.strip() if out else None
+        if head != self.head:
+            self.versions = versions(self.root) if head else []
+            self.head = head
+
+    def matches(self, pattern):
+        with self.lock:
+            try:
+                self.cache.move_to_end(pattern)
+            except KeyError:
+                self.cache[pattern] = {}
+                if len(self.cache) > self.patterns:
+                    self.cache.popitem(last=False)
+            return self.cache[pattern]
+
+    def grep(self, r, needle, blob):
+        data = self.reader.read(blob)
+        if data is None:
+            return []
+        # most blobs do not contain it at all, see grep_literal
+        if needle and needle not in data.lower():
+            if not any(c in needle for c in b"iks") or not any(odd in data for odd in odd_folds):
+                return []
+        text = data.decode(errors="replace").split("\n")
+        if not text[-1]:
+            text.pop()
+        return [(no + 1, line) for (no, line) in enumerate(text) if r.search(line)]
+
+    def search(self, pattern, cancelled=lambda: False):
+        # yields (blob, commit, commit time, path, line number, line),
+        # newest first, raises re.error
+        r = re.compile(pattern, flags=re.IGNORECASE)
+        needle = literal(pattern)
+        self.refresh()
+        cache = self.matches(pattern)
+        for (blob, commit, ct, path) in self.versions:
+            if cancelled():
+                return
+            try:
+                found = cache[blob]
+            except KeyError:
+                found = self.grep(r, needle, blob)
+                cache[blob] = found
+            for (no, line) in found:
+                yield (blob, commit, ct, path, no, line)
+
+    def read(self, blob):
+        # text of a version
+        data = self.reader.read(blob)
+        return data.decode(errors="replace") if data is not None else None
+
+    def read_file(self, commit, path):
+        # bytes of path as it was in commit, None if it was not there
+        # path: relative to the root
+        if not path or "\n" in path:
+            return None
+        return self.reader.read(commit + ":" + path)
+
+    def close(self):
+        self.reader.close()
+
+
+def describe(commit, ct, path):
+    # shown with the results
+    date = datetime.datetime.fromtimestamp(ct).strftime("%Y-%m-%d")
+    return "{} @ {} {}".format(path, commit[:7], date)
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        if not shutil.which("git"):
+            self.skipTest("git not installed")
+        self.root = tempfile.mkdtemp()
+        git(self.root, "init", "-q")
+        git(self.root, "config", "user.email", "test@example.org")
+        git(self.root, "config", "user.name", "test")
+        self.commit("a b.rst", "hello\nold text\n")
+        self.commit("a b.rst", "hello\nnew text\n")
+        self.commit("sub/c.rst", "Hello from c\n")
+        self.commit("img.txt", "hello\n")
+        os.remove(os.path.join(self.root, "sub", "c.rst"))
+        git(self.root, "commit", "-qam", "remove")
+        self.history = HistorySearch(self.root)
+
+    def tearDown(self):
+        self.history.close()
+        shutil.rmtree(self.root)
+
+    def commit(self, path, text):
+        fp = os.path.join(self.root, path)
+        os.makedirs(os.path.dirname(fp), exist_ok=True)
+        with open(fp, "w") as f:
+            f.write(text)
+        git(self.root, "add", path)
+        git(self.root, "commit", "-qm", path)
+
+    def test_versions(self):
+        vs = versions(self.root)
+        self.assertEqual([v[3] for v in vs], ["sub/c.rst", "a b.rst", "a b.rst"])
+        self.assertEqual(self.history.read(vs[2][0]), "hello\nold text\n")
+
+    def test_search(self):
+        res = [(r[3], r[4], r[5]) for r in self.history.search("hello")]
+        self.assertEqual(res, [("sub/c.rst", 1, "Hello from c"), ("a b.rst", 1, "hello"),
+                               ("a b.rst", 1, "hello")])
+        res = [(r[3], r[5]) for r in self.history.search("o.d t")]
+        self.assertEqual(res, [("a b.rst", "old text")])
+        self.assertEqual(list(self.history.search("missing")), [])
+
+    def test_cache(self):
+        list(self.history.search("text"))
+        # blobs searched before are not read again
+        reads = []
+        read = self.history.reader.read
+        self.history.reader.read = lambda sha: reads.append(sha) or read(sha)
+        self.assertEqual(len(list(self.history.search("text"))), 2)
+        self.assertEqual(reads, [])
+        self.commit("d.rst", "more text\n")
+        self.assertEqual(len(list(self.history.search("text"))), 3)
+        self.assertEqual(len(reads), 1)
+
+    def test_read_file(self):
+        vs = versions(self.root)
+        # c.rst is gone now, but not in the commit of its version
+        (blob, commit, ct, path) = vs[0]
+        self.assertEqual(self.history.read_file(commit, "sub/c.rst"), b"Hello from c\n")
+        self.assertEqual(self.history.read_file(commit, "a b.rst"), b"hello\nnew text\n")
+        self.assertEqual(self.history.read_file(vs[2][1], "a b.rst"), b"hello\nold text\n")
+        self.assertIsNone(self.history.read_file(vs[2][1], "img.txt"))
+        # trees are not files
+        self.assertIsNone(self.history.read_file(commit, "sub"))
+        self.assertIsNone(self.history.read_file(commit, ""))
+
+    def test_reader(self):
+        self.assertIsNone(self.history.reader.read(null_sha))
+        # restarted after it went away
+        self.history.reader.close()
+        blob = versions(self.root)[0][0]
+        self.assertEqual(self.history.read(blob), "Hello from c\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
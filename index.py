@@ -0,0 +1,940 @@
+#!/usr/bin/env python3
+
+# Copyright 2016-2019 Thomas Krug
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import array
+import bisect
+import concurrent.futures
+import heapq
+import logging
+import math
+import mmap
+import multiprocessing
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+
+from links import LinkGraph, centrality, note_links
+from registry import Registry
+from render import adornment
+
+log = logging.getLogger(__name__)
+
+
+## full-text index
+#
+# Lines of every note are split into lowercase tokens (\w+).  The index
+# keeps for every token the files containing it and the line numbers within
+# them, in .labnote/index.sqlite below the notes directory.
+#
+# A search pattern is a regular expression.  Literal parts every match has
+# to contain are taken from the pattern, each word of them is contained in a
+# token of the matching line.  Lines having such tokens for all words are
+# the candidates, only these are read and matched against the pattern.
+# Patterns without usable literals (".", "\d+", "a|b") scan all files.
+#
+# The links of every note are kept as well, for ranking by centrality.
+
+cache_dir = ".labnote"
+
+token_re = re.compile(r"\w+")
+
+# inline flags may change the meaning of the whole pattern
+flags_re = re.compile(r"\(\?[aiLmsux-]")
+
+repeat_re = re.compile(r"\{\d*(,\d*)?\}")
+
+# indexes of an older layout are built again
+version = 2
+
+schema = """
+create table if not exists files (
+    id integer primary key,
+    path text unique,
+    mtime integer,
+    size integer,
+    linked integer default 0
+);
+create table if not exists tokens (
+    token text primary key
+) without rowid;
+create table if not exists postings (
+    token text,
+    file integer,
+    lines blob,
+    primary key (token, file)
+) without rowid;
+create index if not exists postings_file on postings (file);
+create table if not exists links (
+    file integer,
+    line integer,
+    target text
+);
+create index if not exists links_file on links (file);
+create index if not exists links_target on links (target);
+"""
+
+
+def tokenize(lines):
+    # returns token -> line numbers (1-based)
+    res = {}
+    for (no, line) in enumerate(lines):
+        for tok in set(token_re.findall(line.lower())):
+            try:
+                res[tok].append(no + 1)
+            except KeyError:
+                res[tok] = [no + 1]
+    return res
+
+
+def literals(pattern):
+    # substrings every match of pattern contains, [] if unknown
+    if flags_re.search(pattern):
+        return []
+    res = []
+    run = []
+    depth = 0
+    i = 0
+    n = len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == "\\":
+            if i + 1 < n and not pattern[i+1].isalnum():
+                if not depth:
+                    run.append(pattern[i+1])
+            else:
+                # classes (\w, \d, ...), anchors, backreferences
+                res.append("".join(run))
+                run = []
+            i += 2
+            continue
+        if c == "[":
+            # skip the class, "]" right after "[" or "[^" is literal
+            i += 1
+            if i < n and pattern[i] == "^":
+                i += 1
+            if i < n and pattern[i] == "]":
+                i += 1
+            while i < n and pattern[i] != "]":
+                if pattern[i] == "\\":
+                    i += 1
+                i += 1
+            res.append("".join(run))
+            run = []
+            i += 1
+            continue
+        if c == "(":
+            depth += 1
+            res.append("".join(run))
+            run = []
+        elif c == ")":
+            depth -= 1
+        elif c == "|":
+            if not depth:
+                return []
+        elif depth:
+            pass
+        elif c in "*?" or (c == "{" and repeat_re.match(pattern, i)):
+            # previous character is optional
+            if run:
+                run.pop()
+            res.append("".join(run))
+            run = []
+            if c == "{":
+                i = repeat_re.match(pattern, i).end()
+                continue
+        elif c in "+.^$":
+            res.append("".join(run))
+            run = []
+        else:
+            run.append(c)
+        i += 1
+    res.append("".join(run))
+    return [r for r in res if r]
+
+
+def words(pattern):
+    # parts of tokens every matching line contains
+    res = []
+    for lit in literals(pattern):
+        for word in token_re.findall(lit.lower()):
+            if word not in res:
+                res.append(word)
+    return res
+
+
+def cache_path(root, name):
+    # file in the cache directory of the notes, which git ignores
+    d = os.path.join(root, cache_dir)
+    os.makedirs(d, exist_ok=True)
+    ignore = os.path.join(d, ".gitignore")
+    if not os.path.exists(ignore):
+        with open(ignore, "w") as f:
+            f.write("*\n")
+    return os.path.join(d, name)
+
+
+def rst_files(path):
+    # relative paths
+    files = []
+    for parent, dirs, fs in os.walk(path):
+        dirs[:] = [d for d in dirs if d not in (".git", cache_dir)]
+        for f in fs:
+            if f.endswith(".rst"):
+                fp = os.path.join(parent, f)
+                files.append(os.path.relpath(fp, path))
+    return files
+
+
+def read_lines(path):
+    # same line numbers as the editor
+    with open(path) as f:
+        lines = f.read().split("\n")
+    if not lines[-1]:
+        lines.pop()
+    return lines
+
+
+def grep_file(r, path, lines=None):
+    # lines: only look at these (1-based)
+    res = []
+    try:
+        text = read_lines(path)
+    except (OSError, UnicodeDecodeError):
+        return res
+    if lines is None:
+        search = r.search
+        return [(no + 1, line) for (no, line) in enumerate(text) if search(line)]
+    for no in lines:
+        if no <= len(text) and r.search(text[no-1]):
+            res.append((no, text[no-1]))
+    return res
+
+
+## literal fast path
+#
+# Most searches are plain words.  These are looked for case-folded in the
+# bytes of the memory-mapped file, line numbers are counted and lines are
+# decoded only where there is a hit.
+
+special = set(".^$*+?{}[]\\|()")
+
+# non-ASCII characters matching i, k or s with IGNORECASE
+odd_folds = (b"\xc4\xb0", b"\xc4\xb1", b"\xe2\x84\xaa", b"\xc5\xbf")
+
+# bytes folded at once
+window = 1 << 20
+
+
+def literal(pattern):
+    # lowercase bytes if pattern only matches itself (ignoring case), else None
+    if not pattern or not pattern.isascii():
+        return None
+    if any(c in special for c in pattern) or "\n" in pattern:
+        return None
+    return pattern.lower().encode()
+
+
+def find_folded(mm, needle):
+    # offsets of needle in mm, ASCII case-folded
+    res = []
+    size = len(mm)
+    start = 0
+    while start < size:
+        # hits starting in the window, overlapping the next one
+        buf = mm[start:start + window + len(needle) - 1].lower()
+        i = buf.find(needle)
+        while 0 <= i < window:
+            res.append(start + i)
+            i = buf.find(needle, i + 1)
+        start += window
+    return res
+
+
+def grep_literal(needle, path, lines=None):
+    # same as grep_file for a literal, None if the file needs grep_file
+    # lines: only look at these (1-based)
+    try:
+        with open(path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:
+        # empty
+        return []
+    except OSError:
+        return None
+    with mm:
+        # text mode reads \r as line break
+        if mm.find(b"\r") >= 0:
+            return None
+        if any(c in needle for c in b"iks"):
+            for odd in odd_folds:
+                if mm.find(odd) >= 0:
+                    return None
+
+        res = []
+        no = 1
+        pos = 0
+        for hit in find_folded(mm, needle):
+            if hit < pos:
+                # same line
+                continue
+            no += mm[pos:hit].count(b"\n")
+            start = mm.rfind(b"\n", 0, hit) + 1
+            end = mm.find(b"\n", hit)
+            if end < 0:
+                end = len(mm)
+            pos = end
+            if lines is not None and no not in lines:
+                continue
+            try:
+                res.append((no, mm[start:end].decode("utf-8")))
+            except UnicodeDecodeError:
+                return None
+        return res
+
+
+def search_file(pattern, path, lines=None):
+    # [(line number, line)] of lines matching pattern, ignoring case
+    needle = literal(pattern)
+    if needle:
+        res = grep_literal(needle, path, set(lines) if lines is not None else None)
+        if res is not None:
+            return res
+    return grep_file(re.compile(pattern, flags=re.IGNORECASE), path, lines)
+
+
+## worker processes
+#
+# Batches of the global search run in a pool of processes.  The generation
+# of the current search is shared with them, batches of a cancelled search
+# stop at the next file instead of running to the end.
+
+# set in the worker processes
+search_generation = None
+
+
+def init_worker(generation):
+    # generation: multiprocessing.Value
+    global search_generation
+    search_generation = generation
+
+
+def stale(generation):
+    # a newer search started, generation None if not cancellable
+    if generation is None or search_generation is None:
+        return False
+    return search_generation.value != generation
+
+
+def grep_batch(pattern, root, batch, generation=None):
+    # batch: [(path, line numbers or None)], returns [line, path, text]
+    # module level, so it can run in a worker process
+    res = []
+    for (path, lines) in batch:
+        if stale(generation):
+            break
+        for (no, line) in search_file(pattern, os.path.join(root, path), lines):
+            res.append([str(no), path, line.strip()])
+    return res
+
+
+## ranking
+#
+# Ranked search orders the matching lines by
+#
+#   term frequency: matches in the line, matching lines in the note
+#   structure: matches in section titles and field lists weigh more
+#   recency: notes changed lately, fading with the age of the note
+#   centrality: rank of the note in the link graph (see links.py)
+#
+# Every batch only returns its best k lines, the search keeps the best k of
+# all batches.
+
+title_boost = 3.0
+field_boost = 1.5
+
+# days until the recency boost is halved
+half_life = 90
+
+field_re = re.compile(r"\s*:[^:\s][^:]*:(\s|$)")
+
+
+def is_title(text, no):
+    # line no (1-based) of text is underlined
+    line = text[no-1].strip()
+    if not line or adornment.match(line) or no >= len(text):
+        return False
+    under = text[no].rstrip()
+    return bool(adornment.match(under)) and len(under) >= len(line)
+
+
+def score_line(r, text, no, matches):
+    # r: compiled pattern, text: lines of the note
+    line = text[no-1]
+    count = max(1, len(r.findall(line)))
+    score = (1 + math.log(count)) * (1 + math.log(matches))
+    if is_title(text, no):
+        score *= title_boost
+    elif field_re.match(line):
+        score *= field_boost
+    return score
+
+
+def note_score(mtime, rank, now):
+    # rank: centrality of the note, 1 is average
+    age = max(0, now - mtime) / 86400
+    return (1 + 0.5 ** (age / half_life)) * (1 + math.log1p(rank))
+
+
+def rank_batch(pattern, root, batch, ranks, k, now, generation=None):
+    # batch as for grep_batch, ranks: path -> centrality
+    # returns (best k of [score, line, path, text], matching lines)
+    # module level, so it can run in a worker process
+    r = re.compile(pattern, flags=re.IGNORECASE)
+    res = []
+    count = 0
+    for (path, lines) in batch:
+        if stale(generation):
+            break
+        fp = os.path.join(root, path)
+        found = search_file(pattern, fp, lines)
+        if not found:
+            continue
+        count += len(found)
+        try:
+            text = read_lines(fp)
+            mtime = os.stat(fp).st_mtime
+        except (OSError, UnicodeDecodeError):
+            continue
+        note = note_score(mtime, ranks.get(path, 0), now)
+        for (no, line) in found:
+            if no > len(text):
+                continue
+            score = score_line(r, text, no, len(found)) * note
+            res.append([score, str(no), path, line.strip()])
+    return (top(res, k), count)
+
+
+def top(rows, k):
+    # best k by score (all if k is 0), best first, ties in file order
+    key = lambda row: (-row[0], row[2], int(row[1]))
+    if k:
+        return heapq.nsmallest(k, rows, key=key)
+    return sorted(rows, key=key)
+
+
+## buffer search
+#
+# Search in the text of the editor while typing the pattern.  Line offsets
+# and the case-folded text are kept until the text changes, a pattern which
+# extends the previous one only looks at the lines found before.
+
+class BufferSearch():
+
+    def __init__(self):
+        self.invalidate()
+
+    def invalidate(self):
+        # text changed
+        self.text = None
+        self.lines = []
+        self.folded = ""
+        # offsets of the lines in folded, and its length at the end
+        self.offsets = [0]
+        # (needle, line numbers) of the last literal search
+        self.last = (None, [])
+
+    def set_text(self, text):
+        self.invalidate()
+        self.text = text
+        self.lines = text.split("\n")
+        # folding keeps the line breaks
+        self.folded = text.lower()
+        self.offsets = [0]
+        i = self.folded.find("\n")
+        while i >= 0:
+            self.offsets.append(i + 1)
+            i = self.folded.find("\n", i + 1)
+        self.offsets.append(len(self.folded) + 1)
+
+    def fast(self, pattern):
+        # same as literal(), for text
+        if not literal(pattern):
+            return None
+        needle = pattern.lower()
+        if any(c in needle for c in "iks"):
+            if any(c in self.text for c in "\u0130\u0131\u212a\u017f"):
+                return None
+        return needle
+
+    def search(self, pattern):
+        # [(line number, line)], raises re.error
+        needle = self.fast(pattern)
+        if needle is None:
+            r = re.compile(pattern, flags=re.IGNORECASE)
+            self.last = (None, [])
+            return [(no + 1, line) for (no, line) in enumerate(self.lines) if r.search(line)]
+
+        (last, found) = self.last
+        if last is not None and last in needle:
+            # lines containing needle are among those containing last
+            nos = []
+            for no in found:
+                if needle in self.folded[self.offsets[no-1]:self.offsets[no]]:
+                    nos.append(no)
+        else:
+            nos = []
+            i = self.folded.find(needle)
+            while i >= 0:
+                no = bisect.bisect_right(self.offsets, i)
+                nos.append(no)
+                i = self.folded.find(needle, self.offsets[no])
+        self.last = (needle, nos)
+        return [(no, self.lines[no-1]) for no in nos]
+
+
+class Index():
+
+    def __init__(self, root, registry=None):
+        # root is an abs path
+        self.root = root
+        # files are listed by the registry once it is scanned
+        self.registry = registry
+        self.dir = os.path.join(root, cache_dir)
+        # connection is shared by the gtk thread and the updates
+        self.lock = threading.Lock()
+        # queries scan the files until the first refresh is done
+        self.ready = False
+
+        self.db = sqlite3.connect(cache_path(root, "index.sqlite"),
+                                  check_same_thread=False)
+        if self.db.execute("pragma user_version").fetchone()[0] != version:
+            for table in ("files", "tokens", "postings", "links"):
+                self.db.execute("drop table if exists " + table)
+            self.db.execute("pragma user_version = {}".format(version))
+        self.db.executescript(schema)
+        # path -> centrality, None after changes
+        self.ranks = None
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def file_id(self, path):
+        row = self.db.execute("select id from files where path = ?", (path,)).fetchone()
+        return row[0] if row else None
+
+    def remove_(self, fid):
+        cur = self.db.execute("select token from postings where file = ?", (fid,))
+        tokens = [(row[0], row[0]) for row in cur]
+        self.db.execute("delete from postings where file = ?", (fid,))
+        # tokens no other file contains
+        self.db.executemany("delete from tokens where token = ? and not exists "
+                            "(select 1 from postings where token = ?)", tokens)
+        self.db.execute("delete from links where file = ?", (fid,))
+        self.db.execute("delete from files where id = ?", (fid,))
+        self.ranks = None
+
+    def update_(self, path, links=True):
+        # path relative to root
+        # links: extract them as well, else link_ does later
+        fp = os.path.join(self.root, path)
+        fid = self.file_id(path)
+        if fid is not None:
+            self.remove_(fid)
+        try:
+            st = os.stat(fp)
+            lines = read_lines(fp)
+        except (OSError, UnicodeDecodeError):
+            return
+        cur = self.db.execute("insert into files (path, mtime, size) values (?, ?, ?)",
+                              (path, st.st_mtime_ns, st.st_size))
+        fid = cur.lastrowid
+        postings = tokenize(lines)
+        self.db.executemany("insert or ignore into tokens values (?)",
+                            [(tok,) for tok in postings])
+        self.db.executemany("insert into postings values (?, ?, ?)",
+                            [(tok, fid, array.array("I", nos).tobytes())
+                             for (tok, nos) in postings.items()])
+        if links:
+            self.link_(fid, path, lines)
+
+    def link_(self, fid, path, lines=None):
+        # parsing takes much longer than tokenizing
+        try:
+            if lines is None:
+                lines = read_lines(os.path.join(self.root, path))
+            links = note_links(path, "\n".join(lines), self.root)
+        except (OSError, UnicodeDecodeError):
+            links = []
+        except Exception as e:
+            log.warning("links of {}: {}".format(path, e))
+            links = []
+        self.db.executemany("insert into links values (?, ?, ?)",
+                            [(fid, line, target) for (line, target) in links])
+        self.db.execute("update files set linked = 1 where id = ?", (fid,))
+        self.ranks = None
+
+    def rst_files(self):
+        if self.registry and self.registry.scanned:
+            return self.registry.paths(".rst")
+        return rst_files(self.root)
+
+    def update(self, path):
+        # after saving or changing path, relative to root
+        try:
+            st = os.stat(os.path.join(self.root, path))
+            current = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            current = None
+        with self.lock:
+            row = self.db.execute("select mtime, size from files where path = ?",
+                                  (path,)).fetchone()
+            if row and tuple(row) == current:
+                return
+            self.update_(path)
+            self.db.commit()
+
+    def remove(self, path):
+        with self.lock:
+            fid = self.file_id(path)
+            if fid is not None:
+                self.remove_(fid)
+                self.db.commit()
+
+    def refresh(self, batch=100, link_batch=10):
+        # brings the index up to date with the files, by mtime and size
+        # returns the number of files indexed again
+        #
+        # searching uses the index as soon as the tokens are done, the links
+        # follow
+        with self.lock:
+            known = dict((row[0], (row[1], row[2]))
+                         for row in self.db.execute("select path, mtime, size from files"))
+
+        if self.registry and self.registry.scanned:
+            # no need to stat the files again
+            current = self.registry.stats(".rst")
+        else:
+            current = {}
+            for path in rst_files(self.root):
+                try:
+                    st = os.stat(os.path.join(self.root, path))
+                except OSError:
+                    continue
+                current[path] = (st.st_mtime_ns, st.st_size)
+
+        changed = []
+        for (path, stat) in current.items():
+            if known.pop(path, None) != stat:
+                changed.append(path)
+
+        # lock is released between batches, so saving does not wait long
+        with self.lock:
+            for path in known:
+                self.remove_(self.file_id(path))
+            self.db.commit()
+        for i in range(0, len(changed), batch):
+            with self.lock:
+                for path in changed[i:i+batch]:
+                    self.update_(path, links=False)
+                self.db.commit()
+
+        log.debug("index: {} files updated, {} removed".format(len(changed), len(known)))
+        self.ready = True
+
+        with self.lock:
+            unlinked = self.db.execute("select id, path from files where not linked").fetchall()
+        for i in range(0, len(unlinked), link_batch):
+            with self.lock:
+                for (fid, path) in unlinked[i:i+link_batch]:
+                    # unless indexed again or removed meanwhile
+                    if self.file_id(path) == fid:
+                        self.link_(fid, path)
+                self.db.commit()
+        log.debug("index: links of {} files".format(len(unlinked)))
+
+        return len(changed)
+
+    def candidates(self, pattern):
+        # path -> sorted line numbers, None if all lines are candidates
+        ws = words(pattern)
+        if not ws:
+            return None
+        with self.lock:
+            # fewest matching tokens first, the others only narrow it down
+            counts = []
+            for w in ws:
+                cur = self.db.execute("select count(*) from tokens where instr(token, ?) > 0", (w,))
+                counts.append((cur.fetchone()[0], w))
+            counts.sort()
+
+            res = None
+            for (count, w) in counts:
+                if res is not None and count > 1000:
+                    break
+                cur = self.db.execute("select f.path, p.lines from postings p "
+                                      "join files f on f.id = p.file "
+                                      "where p.token in (select token from tokens "
+                                      "where instr(token, ?) > 0)", (w,))
+                found = {}
+                for (path, blob) in cur:
+                    if res is not None and path not in res:
+                        continue
+                    nos = array.array("I")
+                    nos.frombytes(blob)
+                    found.setdefault(path, set()).update(nos)
+                if res is not None:
+                    for path in found:
+                        found[path] &= res[path]
+                res = dict((p, nos) for (p, nos) in found.items() if nos)
+                if not res:
+                    break
+
+        return dict((p, sorted(nos)) for (p, nos) in res.items())
+
+    def files(self, pattern):
+        # [(path, candidate lines or None for all)], sorted by path
+        cands = self.candidates(pattern) if self.ready else None
+        if cands is None:
+            return [(path, None) for path in sorted(self.rst_files())]
+        return sorted(cands.items())
+
+    def search(self, pattern):
+        # [line, path, text], sorted by path
+        return grep_batch(pattern, self.root, self.files(pattern))
+
+    def centrality(self):
+        # path -> centrality of the notes, 1 is average
+        with self.lock:
+            if self.ranks is not None:
+                return self.ranks
+            rows = self.db.execute("select f.path, l.target from links l "
+                                   "join files f on f.id = l.file "
+                                   "where l.target like '%.rst'").fetchall()
+        ranks = centrality(rows)
+        self.ranks = ranks
+        return ranks
+
+    def links(self, path):
+        # [(line, target)] of a note, None until its links are extracted
+        with self.lock:
+            row = self.db.execute("select id, linked from files where path = ?",
+                                  (path,)).fetchone()
+            if not row:
+                return []
+            if not row[1]:
+                return None
+            return self.db.execute("select line, target from links where file = ? "
+                                   "order by rowid", (row[0],)).fetchall()
+
+    def graph(self):
+        # LinkGraph of all notes, complete after refresh
+        graph = LinkGraph()
+        with self.lock:
+            for (source, line, target) in self.db.execute(
+                    "select f.path, l.line, l.target from links l "
+                    "join files f on f.id = l.file order by l.rowid"):
+                graph.add(source, line, target)
+        return graph
+
+    def rank(self, pattern, k=0):
+        # (best k of [score, line, path, text], matching lines)
+        return rank_batch(pattern, self.root, self.files(pattern),
+                          self.centrality(), k, time.time())
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.write("a.rst", "Hello World\nsecond line\n`link <b.rst>`_\n")
+        self.write("sub/b.rst", "hello again\nnothing here\n")
+        self.write("c.txt", "hello\n")
+        self.index = Index(self.root)
+        self.index.refresh()
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.root)
+
+    def write(self, path, text):
+        fp = os.path.join(self.root, path)
+        os.makedirs(os.path.dirname(fp), exist_ok=True)
+        with open(fp, "w") as f:
+            f.write(text)
+
+    def scan(self, pattern):
+        files = [(path, None) for path in sorted(rst_files(self.root))]
+        return grep_batch(pattern, self.root, files)
+
+    def test_literals(self):
+        self.assertEqual(literals("hello"), ["hello"])
+        self.assertEqual(literals("hel+o wor?ld"), ["hel", "o wo", "ld"])
+        self.assertEqual(literals(r"a\.b\w+c"), ["a.b", "c"])
+        self.assertEqual(literals("ab(c|d)ef[gh]i"), ["ab", "ef", "i"])
+        self.assertEqual(literals("a{2}b{x"), ["b{x"])
+        self.assertEqual(literals("a|b"), [])
+        self.assertEqual(literals("(?x) a b"), [])
+        self.assertEqual(words("Hello, World"), ["hello", "world"])
+
+    def test_search(self):
+        for pattern in ("hello", "HELLO", "ell", "^$", "o w", "line$", "b\\.rst", ".",
+                        "nothing|second", "x+", "[hn]", "(?i)hello"):
+            self.assertEqual(self.index.search(pattern), self.scan(pattern), pattern)
+
+    def test_candidates(self):
+        self.assertEqual(self.index.candidates("hello"), {"a.rst": [1], os.path.join("sub", "b.rst"): [1]})
+        self.assertEqual(self.index.candidates("hello world"), {"a.rst": [1]})
+        self.assertEqual(self.index.candidates("zzz"), {})
+        self.assertIsNone(self.index.candidates("."))
+
+    def test_update(self):
+        self.write("a.rst", "changed\n")
+        self.index.update("a.rst")
+        self.assertEqual(self.index.search("hello"), [["1", os.path.join("sub", "b.rst"), "hello again"]])
+        self.assertEqual(self.index.search("changed"), [["1", "a.rst", "changed"]])
+        # tokens follow the files
+        row = self.index.db.execute("select count(*) from tokens where token = 'world'").fetchone()
+        self.assertEqual(row[0], 0)
+        row = self.index.db.execute("select count(*) from tokens where token = 'hello'").fetchone()
+        self.assertEqual(row[0], 1)
+
+    def test_refresh(self):
+        os.remove(os.path.join(self.root, "sub", "b.rst"))
+        self.write("d.rst", "hello from d\n")
+        self.assertEqual(self.index.refresh(), 1)
+        self.assertEqual(self.index.search("hello"), self.scan("hello"))
+        self.assertEqual(self.index.refresh(), 0)
+        row = self.index.db.execute("select count(*) from tokens where token = 'again'").fetchone()
+        self.assertEqual(row[0], 0)
+
+    def test_literal(self):
+        global window
+        self.assertEqual(literal("Hello"), b"hello")
+        self.assertIsNone(literal("a.b"))
+        self.assertIsNone(literal("ä"))
+        samples = ["hello\nHELLO hello\nno\n", "x\r\nhello\r\n", "\u212aey key\n",
+                   "\xe4 hello \xfc\nend", "", "hello", "a\n\nhello\n\n"]
+        window_ = window
+        # hits across windows
+        window = 3
+        try:
+            for (i, text) in enumerate(samples):
+                self.write("l.rst", text)
+                fp = os.path.join(self.root, "l.rst")
+                for pattern in ("hello", "key", "o", "lo\\nh"):
+                    r = re.compile(pattern, flags=re.IGNORECASE)
+                    self.assertEqual(search_file(pattern, fp), grep_file(r, fp), (text, pattern))
+                    self.assertEqual(search_file(pattern, fp, [2]), grep_file(r, fp, [2]))
+        finally:
+            window = window_
+
+    def test_buffer(self):
+        text = "Hello World\nhello\n\nno match\nHELLO again hello\n\u212aey\n"
+        search = BufferSearch()
+        search.set_text(text)
+        lines = text.split("\n")
+
+        def expected(pattern):
+            r = re.compile(pattern, flags=re.IGNORECASE)
+            return [(no + 1, line) for (no, line) in enumerate(lines) if r.search(line)]
+
+        # typing a pattern, each one extends the previous
+        for pattern in ("h", "he", "hel", "hello", "hello ", "hello a", "x"):
+            self.assertEqual(search.search(pattern), expected(pattern), pattern)
+        for pattern in ("k", "ke", "o$", "^$", "o.", "\n"):
+            self.assertEqual(search.search(pattern), expected(pattern), pattern)
+        # cached lines belong to the old text
+        search.set_text("hello\nother hello\n")
+        lines = search.text.split("\n")
+        self.assertEqual(search.search("hello"), expected("hello"))
+
+    def test_registry(self):
+        self.index.close()
+        os.remove(os.path.join(self.root, cache_dir, "index.sqlite"))
+        reg = Registry(self.root)
+        reg.scan()
+        self.index = Index(self.root, reg)
+        self.assertEqual(self.index.refresh(), 2)
+        self.assertEqual(self.index.search("hello"), self.scan("hello"))
+        # unchanged files are not indexed again
+        self.index.update("a.rst")
+        self.assertEqual(self.index.refresh(), 0)
+
+    def test_links(self):
+        # a.rst links to b.rst, which is not a note
+        self.assertEqual(sorted(self.index.centrality()), ["a.rst", "b.rst"])
+        self.write("sub/b.rst", "`back <../a.rst>`_\n")
+        self.index.update(os.path.join("sub", "b.rst"))
+        ranks = self.index.centrality()
+        self.assertEqual(sorted(ranks), ["a.rst", "b.rst", os.path.join("sub", "b.rst")])
+        # linked from sub/b.rst, which nothing links to
+        self.assertGreater(ranks["a.rst"], ranks[os.path.join("sub", "b.rst")])
+        graph = self.index.graph()
+        self.assertEqual(graph.backlinks("a.rst"), [(os.path.join("sub", "b.rst"), 1)])
+        self.assertEqual(self.index.links(os.path.join("sub", "b.rst")), [(1, "a.rst")])
+        self.assertEqual(self.index.links("missing.rst"), [])
+        # older layout
+        self.index.close()
+        db = sqlite3.connect(os.path.join(self.root, cache_dir, "index.sqlite"))
+        db.execute("pragma user_version = 1")
+        db.commit()
+        db.close()
+        self.index = Index(self.root)
+        self.assertEqual(self.index.refresh(), 2)
+
+    def test_rank(self):
+        self.write("notes.rst", "Hello\n=====\n\n:tag: hello\n\nsay hello, hello\nhello\n")
+        self.write("old.rst", "hello\n")
+        os.utime(os.path.join(self.root, "old.rst"), (0, 0))
+        self.index.refresh()
+        (rows, count) = self.index.rank("hello")
+        self.assertEqual(count, 7)
+        self.assertEqual(len(rows), 7)
+        # title, two matches, field list, one match
+        self.assertEqual([(r[1], r[2]) for r in rows[:4]],
+                         [("1", "notes.rst"), ("6", "notes.rst"), ("4", "notes.rst"), ("7", "notes.rst")])
+        self.assertEqual(rows[-1][2], "old.rst")
+        self.assertEqual(sorted(r[1:] for r in rows), sorted(self.scan("hello")))
+        # best k only, same order
+        (best, count) = self.index.rank("hello", 2)
+        self.assertEqual([r[1:] for r in best], [r[1:] for r in rows[:2]])
+        self.assertEqual(count, 7)
+        self.assertEqual(self.index.rank("zzz"), ([], 0))
+
+    def test_stale(self):
+        # batches of a cancelled search stop in the workers
+        ctx = multiprocessing.get_context("spawn")
+        shared = ctx.Value("q", 1)
+        files = [(path, None) for path in sorted(rst_files(self.root))]
+        with concurrent.futures.ProcessPoolExecutor(1, mp_context=ctx, initializer=init_worker,
+                                                    initargs=(shared,)) as pool:
+            self.assertEqual(pool.submit(grep_batch, "hello", self.root, files, 1).result(),
+                             self.scan("hello"))
+            shared.value = 2
+            self.assertEqual(pool.submit(grep_batch, "hello", self.root, files, 1).result(), [])
+            self.assertEqual(pool.submit(rank_batch, "hello", self.root, files, {}, 0, 0, 1).result(),
+                             ([], 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
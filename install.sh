@@ -1,6 +1,16 @@
 #!/bin/sh
 
-sudo install -Dm755 labnote.py /usr/local/bin/labnote
+sudo install -Dm755 labnote.py /usr/local/lib/labnote/labnote.py
+sudo install -Dm644 render.py /usr/local/lib/labnote/render.py
+sudo install -Dm644 preprocess.py /usr/local/lib/labnote/preprocess.py
+sudo install -Dm644 stats.py /usr/local/lib/labnote/stats.py
+sudo install -Dm644 bench.py /usr/local/lib/labnote/bench.py
+sudo install -Dm644 index.py /usr/local/lib/labnote/index.py
+sudo install -Dm644 registry.py /usr/local/lib/labnote/registry.py
+sudo install -Dm644 links.py /usr/local/lib/labnote/links.py
+sudo install -Dm644 quickopen.py /usr/local/lib/labnote/quickopen.py
+sudo install -Dm644 history.py /usr/local/lib/labnote/history.py
+sudo ln -sf /usr/local/lib/labnote/labnote.py /usr/local/bin/labnote
 sudo -k
 
 mkdir -p ~/.config/labnote
@@ -8,4 +18,3 @@ cp config/* ~/.config/labnote/
 
 install -Dm644 labnote.desktop ~/.local/share/applications/labnote.desktop
 update-desktop-database ~/.local/share/applications/
-
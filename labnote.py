@@ -16,16 +16,19 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
+import concurrent.futures
 import configparser
 import datetime
-import io
+import json
 import logging
 import mimetypes
+import multiprocessing
 import os
 import random
 import re
 import shutil
 import signal
+import sqlite3
 import string
 import subprocess
 import sys
@@ -56,25 +59,44 @@ import urllib.parse
 #   fonts-dejavu
 # gir1.2-gspell-1
 
-import gi
-gi.require_version('Gtk', '3.0')
-from gi.repository import Gtk, Gdk, GLib, Gio, Pango
+# labnote bench, see bench.py, runs without gui
+if __name__ == "__main__" and sys.argv[1:2] == ["bench"]:
+    import bench
+    sys.exit(bench.main(sys.argv[2:]))
 
-gi.require_version('WebKit2', '4.0')
-from gi.repository import WebKit2
+# workers of the global search import this file as __mp_main__ (spawn,
+# see GlobalSearch.executor), they only run functions of index.py
+if __name__ != "__mp_main__":
+    import gi
+    gi.require_version('Gtk', '3.0')
+    from gi.repository import Gtk, Gdk, GLib, Gio, Pango
 
-try:
-    gi.require_version('GtkSource', '4')
-except ValueError:
-    gi.require_version('GtkSource', '3.0')
-from gi.repository import GtkSource
+    gi.require_version('WebKit2', '4.0')
+    from gi.repository import WebKit2
 
-gi.require_version("Gspell", "1")
-from gi.repository import Gspell
+    try:
+        gi.require_version('GtkSource', '4')
+    except ValueError:
+        gi.require_version('GtkSource', '3.0')
+    from gi.repository import GtkSource
+
+    gi.require_version("Gspell", "1")
+    from gi.repository import Gspell
 
 import docutils
 import docutils.core
 
+from render import Pipeline, PageCache, page_key, html_writer, split_body, diff_blocks
+from render import LargeDocument
+from render import engine, block_at, uri2path
+from preprocess import rechar, handle_spaces
+from index import Index, BufferSearch, rst_files, grep_batch, rank_batch, top, read_lines
+from index import init_worker
+from registry import Registry
+from quickopen import PathIndex
+from history import HistorySearch, describe
+from links import LinkGraph, note_links
+
 
 class mainwindow():
 
@@ -90,6 +112,21 @@ class mainwindow():
         # callback in webkit thread
         self.update_lock = False
         self.update_deferred = False
+        # rendered in background, waiting for webkit
+        self.update_html = None
+        # blocks of the loaded page, for live updates
+        self.preview = None
+        # first source line of each of these blocks
+        self.block_lines = []
+
+        # rendered pages of visited files
+        self.page_cache = PageCache(self.config["page_cache"])
+        self.restore_scroll = None
+
+        # stylesheets and scripts, renders only produce the body
+        self.shell = self.build_shell()
+        # files are switched within the loaded shell
+        self.shell_loaded = False
 
         self.deferred_line = 0
 
@@ -102,6 +139,67 @@ class mainwindow():
 
         self.extern = ["http", "https", "ftp", "ftps", "mailto"]
 
+        # preprocessing, doctree and html, see render.Pipeline
+        self.pipeline = Pipeline(startdir)
+        self.pipeline.count_nodes = bool(self.config["stats_file"])
+        # time spent in the phases of rendering, milliseconds
+        self.stats = self.pipeline.stats
+        self.load_start = None
+        # pipeline is used from gtk and render thread
+        self.render_lock = threading.Lock()
+        self.scheduler = RenderScheduler(self.render_snapshot, self.render_done,
+                                         self.config["render_delay"])
+
+        # preview of a file above large_document, rendered in chunks
+        self.large = None
+        # renders placeholders of large documents
+        self.lazy_pipeline = Pipeline(startdir, self.stats)
+        self.lazy_pipeline.incremental = False
+        self.lazy = LazyRenderer(self.render_lazy, self.lazy_done)
+
+        # files of the notes directory, walked once and kept current
+        # by file monitors
+        self.registry = Registry(startdir)
+        self.watcher = FileWatcher(self.registry, self.files_changed)
+        # location bar completions, filled after the walk
+        self.quick_open = PathIndex()
+
+        # global search, updated on save and brought up to date at startup
+        try:
+            self.index = Index(startdir, self.registry)
+        except (OSError, sqlite3.Error) as e:
+            log.warning("no search index: " + str(e))
+            self.index = None
+        # local search, on the text of the buffer
+        self.buffer_search = BufferSearch()
+        # "local" or "global", set by the shortcuts
+        self.search_mode = None
+        ranked = self.search_best if self.config["search_ranked"] else None
+        self.global_search = GlobalSearch(self.index, self.registry, self.search_found,
+                                          self.search_done, self.config["search_limit"], ranked)
+        # every committed version of the notes
+        self.history = HistorySearch(startdir) if self.git.git else None
+        self.history_search = RevisionSearch(self.history, self.history_found,
+                                             self.search_done, self.config["search_limit"])
+        # (blob, commit, commit time, path) of the history results
+        self.history_rows = []
+        # open revision windows
+        self.revisions = []
+        # ranked results, shown a page at a time
+        self.search_ranked = []
+        self.search_page = 0
+        self.search_count = 0
+        # links between the notes, built after the walk and updated on
+        # changes, for the backlinks of the current file
+        self.links = LinkGraph()
+        # path -> links, updated before the graph was built
+        self.links_updated = {}
+        self.links_ready = False
+
+        fred = threading.Thread(target=self.scan_files)
+        fred.daemon = True
+        fred.start()
+
 
         self.window = Gtk.Window()
         self.window.connect("delete-event", self.on_delete_event)
@@ -148,6 +246,15 @@ class mainwindow():
 
         self.entry = Gtk.Entry()
         self.entry.connect("activate", self.on_entry_act)
+        self.entry.connect("changed", self.on_entry_changed)
+
+        # results of quick_open, not filtered again
+        self.completions = Gtk.ListStore(str)
+        completion = Gtk.EntryCompletion(model=self.completions)
+        completion.set_text_column(0)
+        completion.set_match_func(lambda *args: True, None)
+        completion.connect("match-selected", self.on_completion)
+        self.entry.set_completion(completion)
 
         toolbox.pack_start(tb_back, False, False, 0)
         toolbox.pack_start(self.entry, True, True, 0)
@@ -250,6 +357,14 @@ class mainwindow():
         # debug
         self.webview.connect("load-failed", self.load_failed)
 
+        # double click in the preview, see build_shell
+        manager = self.webview.get_user_content_manager()
+        manager.connect("script-message-received::sync", self.preview_sync)
+        manager.register_script_message_handler("sync")
+        # placeholder of a large document scrolled into view
+        manager.connect("script-message-received::lazy", self.preview_lazy)
+        manager.register_script_message_handler("lazy")
+
 
         ##
         self.search_results = Gtk.ListStore(str, str, str)
@@ -272,6 +387,26 @@ class mainwindow():
         self.search_results_sw.set_policy(Gtk.PolicyType.AUTOMATIC, Gtk.PolicyType.AUTOMATIC)
         self.search_results_sw.add(self.treeview)
 
+        # notes linking to the current file
+        self.backlinks = Gtk.ListStore(str, str)
+        self.backlinks_view = Gtk.TreeView(model=self.backlinks)
+        self.backlinks_view.set_headers_visible(False)
+
+        for (i, column) in enumerate(["line", "filepath"]):
+            cell = Gtk.CellRendererText()
+            col = Gtk.TreeViewColumn(column, cell, text=i)
+            col.set_sizing(Gtk.TreeViewColumnSizing.AUTOSIZE)
+            if i == 0:
+                col.set_alignment(1.0)
+            self.backlinks_view.append_column(col)
+
+        self.backlinks_view.connect("row-activated", self.on_backlink)
+        self.backlinks_view.connect("key-press-event", self.on_backlinks_key)
+
+        self.backlinks_sw = Gtk.ScrolledWindow()
+        self.backlinks_sw.set_policy(Gtk.PolicyType.AUTOMATIC, Gtk.PolicyType.AUTOMATIC)
+        self.backlinks_sw.add(self.backlinks_view)
+
         hbox = Gtk.Box(orientation=self.config["layout"])
         hbox.set_homogeneous(True)
         if self.config["editor_first"]:
@@ -279,8 +414,10 @@ class mainwindow():
             hbox.pack_start(self.scrolledwindow, True, True, 1)
             hbox.pack_start(self.webview, True, True, 1)
             hbox.pack_start(self.search_results_sw, True, True, 0)
+            hbox.pack_start(self.backlinks_sw, True, True, 0)
         else:
             hbox.pack_start(self.search_results_sw, True, True, 0)
+            hbox.pack_start(self.backlinks_sw, True, True, 0)
             hbox.pack_start(self.webview, True, True, 1)
             hbox.pack_start(self.scrolledwindow, True, True, 1)
         vbox.pack_start(hbox, True, True, 0)
@@ -288,6 +425,7 @@ class mainwindow():
         # search
         self.search = Gtk.SearchEntry()
         self.search.connect("activate", self.on_search)
+        self.search.connect("search-changed", self.on_search_changed)
         self.search.connect("key-press-event", self.on_search_key)
 
         self.searchr = Gtk.Revealer()
@@ -310,6 +448,7 @@ class mainwindow():
         vbox.show_all()
         self.window.show()
         self.search_results_sw.hide()
+        self.backlinks_sw.hide()
         self.textview.grab_focus()
 
 
@@ -346,6 +485,9 @@ class mainwindow():
                         os.makedirs(filedir)
 
                 if save_file(self.current_file, self.tvbuffer.props.text):
+                    self.page_cache.invalidate(self.current_file)
+                    self.quick_open.add(os.path.normpath(self.current_file))
+                    self.update_notes([os.path.normpath(self.current_file)])
                     self.tvbuffer.set_modified(False)
                     self.state.set("file", "saved")
                 else:
@@ -378,6 +520,22 @@ class mainwindow():
                 self.searchr.set_reveal_child(True)
                 self.search.grab_focus()
 
+            if event.keyval == ord("H"):
+                if not self.history:
+                    self.state.set("main", "no history, not a git root")
+                    return True
+                self.search_mode = "history"
+                self.search.set_placeholder_text("search in history")
+                self.searchr.set_reveal_child(True)
+                self.search.grab_focus()
+
+            if event.keyval == ord("B"):
+                if self.backlinks_sw.get_visible():
+                    self.hide_backlinks()
+                else:
+                    self.show_backlinks()
+                return True
+
             if event.keyval == ord("E"):
                 log.debug("start export")
                 self.state.set("main", "exporting")
@@ -473,6 +631,7 @@ class mainwindow():
         # TODO only on file save?
         # add copied file to git
         self.git.add(os.path.join(current_dir, fn))
+        self.quick_open.add(os.path.relpath(os.path.join(current_dir, fn), startdir))
 
         # insert reference
         (typ, enc) = mimetypes.guess_type(fn)
@@ -600,6 +759,10 @@ class mainwindow():
 
     def unlock(self):
         self.update_lock = False
+        if self.update_html:
+            page = self.update_html
+            self.update_html = None
+            self.render_done(page)
         if self.update_deferred:
             self.update_deferred = False
             self.update_textview()
@@ -627,11 +790,17 @@ class mainwindow():
     def load_changed(self, view, event):
         if event == WebKit2.LoadEvent.STARTED:
             self.load_state = 0
+            self.shell_loaded = False
+            self.load_start = time.perf_counter()
         if event == WebKit2.LoadEvent.COMMITTED:
             self.load_state = 1
         if event == WebKit2.LoadEvent.FINISHED:
             self.load_state = 2
+            self.shell_loaded = True
             log.debug("load finished")
+            if self.load_start:
+                self.stats.add("load", (time.perf_counter() - self.load_start) * 1000)
+                self.load_start = None
             if log.isEnabledFor(logging.INFO):
                 self.time_stop = time.clock_gettime(time.CLOCK_MONOTONIC)
                 delta = self.time_stop - self.time_start
@@ -639,6 +808,14 @@ class mainwindow():
             log.debug("----------")
             self.unlock()
 
+            if self.restore_scroll and not self.deferred_line:
+                script = "window.scrollTo(0, {} * (document.body.scrollHeight - window.innerHeight))"
+                self.webview.run_javascript(script.format(self.restore_scroll), None, None, None)
+            self.restore_scroll = None
+
+            self.show_chunks()
+            self.start_lazy()
+
             fred = threading.Thread(target=self.deferred)
             fred.daemon = True
             fred.start()
@@ -678,6 +855,14 @@ class mainwindow():
             if url.scheme in self.extern:
                 self.open_uri(uri)
 
+            return True
+
+        # switch files without reloading the shell
+        if decision_type == WebKit2.PolicyDecisionType.NAVIGATION_ACTION:
+            if self.shell_loaded and url.netloc.startswith("labnote."):
+                decision.ignore()
+                self.switch_file(uri)
+
         return True
 
 
@@ -697,31 +882,6 @@ class mainwindow():
         request.finish_error(err)
 
 
-    def dtree_prep(self, dtree):
-        ## path to uri
-
-        for elem in dtree.traverse(siblings=True):
-            if elem.tagname == "reference" or elem.tagname == "image":
-                try:
-                    if elem.tagname == "reference":
-                        refuri = elem["refuri"]
-                    if elem.tagname == "image":
-                        refuri = elem["uri"]
-                except KeyError:
-                    continue
-
-                refuri = ref2uri(refuri, os.path.dirname(self.current_file))
-                if not refuri:
-                    continue
-
-                if elem.tagname == "reference":
-                    elem["refuri"] = refuri
-                if elem.tagname == "image":
-                    elem["uri"] = refuri
-
-        return dtree
-
-
     def uri_scheme_file(self, request):
 
         if log.isEnabledFor(logging.INFO):
@@ -743,28 +903,20 @@ class mainwindow():
 
         if self.load_state == 0:
 
-            if uri.endswith(".rst") and not ext:
-
-                if self.tvbuffer.get_modified():
-                    log.debug("cancel due to modified")
-                    err = GLib.Error("load cancelled: open file modified")
-                    request.finish_error(err)
-
-                    self.info_bar.ask("No write since last change. Proceed?", request.get_uri(),
-                                      self.load_saved_request, None)
-                    return
-
-                self.state.clear()
-                self.load_rst(uri, request)
-
+            html = self.open_file(uri, ext, request.get_uri())
+            if html is None:
+                err = GLib.Error("load cancelled")
+                request.finish_error(err)
                 return
 
-            self.open_uri(uri)
-            err = GLib.Error("load cancelled: file opened externally")
-            request.finish_error(err)
+            html = (self.shell[0] + html + self.shell[1]).encode()
+
+            stream = Gio.MemoryInputStream.new_from_data(html)
+            request.finish(stream, len(html), "text/html")
             return
 
-        if self.load_state == 1:
+        # images of blocks updated in place are requested after loading
+        if self.load_state >= 1:
             (typ, enc) = mimetypes.guess_type(uri)
             log.debug("filetype: " + str(typ))
             if typ and typ.startswith("image"):
@@ -775,6 +927,89 @@ class mainwindow():
             return
 
 
+    def open_file(self, uri, ext, request_uri):
+        # returns the rendered body or None if not loaded
+
+        if uri.endswith(".rst") and not ext:
+
+            if self.tvbuffer.get_modified():
+                log.debug("cancel due to modified")
+                self.info_bar.ask("No write since last change. Proceed?", request_uri,
+                                  self.load_saved_request, None)
+                return None
+
+            self.state.clear()
+            return self.load_rst(uri)
+
+        self.open_uri(uri)
+        log.debug("file opened externally")
+        return None
+
+
+    def switch_file(self, uri):
+        # load a file into the shell, see load_policy
+
+        if log.isEnabledFor(logging.INFO):
+            self.time_start = time.clock_gettime(time.CLOCK_MONOTONIC)
+
+        log.debug("----------")
+        log.debug("switching")
+        log.debug("URI " + uri)
+
+        (uri_, _, fragment) = uri.partition("#")
+
+        # same as uri_scheme_file
+        path = urllib.parse.unquote(uri_, encoding="utf-8", errors="replace")
+        path = path.replace(rechar, " ")
+        path, ext = uri2path(path, os.path.dirname(self.current_file), startdir)
+
+        if fragment and path == self.current_file:
+            self.jump(fragment)
+            return
+
+        html = self.open_file(path, ext, uri)
+        if html is None:
+            return
+
+        # large documents scroll to the mark
+        pos = None if self.large else 0
+        if self.restore_scroll and not self.deferred_line:
+            pos = self.restore_scroll
+        self.restore_scroll = None
+
+        # relative links in the body resolve against the current file
+        base = "file://labnote.int.abs/" + self.current_file
+        script = "show({}, {}, {})".format(json.dumps(html), json.dumps(pos), json.dumps(base))
+        self.webview.run_javascript(script, None, self.switch_done,
+                                    (html, fragment, time.perf_counter()))
+
+    def switch_done(self, webview, result, data):
+        (html, fragment, start) = data
+        try:
+            webview.run_javascript_finish(result)
+        except GLib.Error as e:  # pylint: disable=catching-non-exception
+            log.debug("switch failed " + str(e))
+            self.load_html(html)
+            return
+
+        self.stats.add("switch", (time.perf_counter() - start) * 1000)
+
+        if log.isEnabledFor(logging.INFO):
+            delta = time.clock_gettime(time.CLOCK_MONOTONIC) - self.time_start
+            log.info(str(delta))
+        log.debug("----------")
+
+        self.start_lazy()
+
+        if fragment:
+            self.jump(fragment)
+        self.deferred()
+
+    def jump(self, fragment):
+        script = "var elem = document.getElementById({}); if (elem) elem.scrollIntoView();"
+        self.webview.run_javascript(script.format(json.dumps(fragment)), None, None, None)
+
+
     def open_uri(self, uri):
         log.debug("opening external: " + uri)
         if log.isEnabledFor(logging.DEBUG):
@@ -800,7 +1035,8 @@ class mainwindow():
             request.finish(stream, -1, None)
 
 
-    def load_rst(self, uri, request):
+    def load_rst(self, uri):
+        # returns the rendered body
         log.debug("load text")
 
         ## history
@@ -823,12 +1059,33 @@ class mainwindow():
         # display root dir on first load
         if not self.current_file:
             self.state.set("main", startdir)
+        else:
+            # remember position
+            cursor_iter = self.tvbuffer.get_iter_at_mark(self.tvbuffer.get_insert())
+            try:
+                scroll = float(self.webview.get_title())
+            except (TypeError, ValueError):
+                scroll = None
+            self.page_cache.set_position(self.current_file, cursor_iter.get_line(), scroll)
 
         # set current file
         self.current_file = uri
         log.debug("current file URI " + uri)
 
         self.entry.set_text(uri)
+        if self.backlinks_sw.get_visible():
+            self.show_backlinks()
+
+        # drop renders of the previous file
+        self.scheduler.cancel()
+        self.lazy.cancel()
+        self.update_html = None
+
+        # links are rewritten relative to the current file
+        with self.render_lock:
+            self.pipeline.set_file(uri)
+            self.lazy_pipeline.set_file(uri)
+            self.large = None
 
         # get contents
         try:
@@ -845,28 +1102,50 @@ class mainwindow():
         self.tvbuffer.end_not_undoable_action()
         self.tvbuffer.set_modified(False)
         self.tvbuffer.handler_unblock_by_func(self.buffer_changed)
+        self.buffer_search.invalidate()
 
-        # place cursor on top
-        it = self.tvbuffer.get_iter_at_line(0)
+        # place cursor on top or where it was left
+        (line, self.restore_scroll) = self.page_cache.position(uri)
+        it = self.tvbuffer.get_iter_at_line(line)
         self.tvbuffer.place_cursor(it)
+        self.textview.scroll_to_mark(self.tvbuffer.get_insert(), 0, True, 0.0, 0.0)
         # focus textview
         self.textview.grab_focus()
 
         self.lock_line = 0
-        html = self.render(txt)
 
-        html = html.encode()
+        # the option is in kilobytes
+        large = self.config["large_document"]
+        if large and len(txt.encode("utf-8", "surrogatepass")) > large:
+            log.debug("large document")
+            with self.render_lock:
+                self.large = LargeDocument(self.pipeline, self.lazy_pipeline)
+                self.large.update(txt, line)
+                html = self.large.html()
+                self.block_lines = self.large.lines
+            self.preview = None
+            # chunk at the cursor is rendered, placeholders have no real height
+            self.restore_scroll = None
+            return html
+
+        key = page_key(uri, txt, self.pipeline.startdir)
+        page = self.page_cache.get(uri, key)
+        if page:
+            log.debug("page cached")
+            (html, lines) = page
+        else:
+            (html, lines) = self.render(txt)
+            self.page_cache.put(uri, key, html, lines)
+        self.preview = split_body(html)
+        self.block_lines = lines
 
-        stream = Gio.MemoryInputStream.new_from_data(html)
-        request.finish(stream, len(html), "text/html")
+        return html
 
 
     def buffer_changed(self, textbuf):
 
-        if not self.lock():
-            return
-
         self.state.set("file", "modified")
+        self.buffer_search.invalidate()
 
         self.update_textview()
 
@@ -882,12 +1161,159 @@ class mainwindow():
 
         rst = self.tvbuffer.props.text
 
-        html = self.render(rst, lock=True)
+        # get current line
+        line = self.lock_line
+        if not line:
+            cursor_mark = self.tvbuffer.get_insert()
+            cursor_iter = self.tvbuffer.get_iter_at_mark(cursor_mark)
+            line = cursor_iter.get_line()
+
+        # rendered in background, see render_done
+        self.scheduler.submit((rst, line))
+
+    def render_snapshot(self, snapshot):
+        # render thread
+        (rst, line) = snapshot
+        with self.render_lock:
+            if self.large:
+                # result is kept by self.large
+                self.large.update(rst, line)
+                return None
+        return self.render(rst, line)
+
+    def render_done(self, page):
+        # gtk thread, only called for the newest snapshot
+
+        if page is None:
+            self.show_chunks(jump=True)
+            self.start_lazy()
+            return
+
+        if self.update_lock:
+            # webkit is still loading, keep only the newest
+            self.update_html = page
+            return
+
+        (html, self.block_lines) = page
+
+        if not self.shell_loaded:
+            self.load_html(html)
+            return
+
+        blocks = split_body(html)
+        script = None
+
+        if self.config["live_update"] and self.preview:
+            diff = diff_blocks(self.preview, blocks)
+            if diff:
+                (first, count, fragment) = diff
+                log.debug("patching {} blocks at {}".format(count, first))
+                script = "patch({}, {}, {}, {})".format(len(self.preview[1]), first, count,
+                                                        json.dumps(fragment))
+
+        if not script:
+            # keeps the shell, only the body is replaced
+            script = "show({}, null)".format(json.dumps(html))
+
+        self.preview = blocks
+        self.webview.run_javascript(script, None, self.patch_done, (html, time.perf_counter()))
+
+    def load_html(self, html):
+        # reloads the shell
+        self.update_lock = True
+        self.shell_loaded = False
+        self.preview = split_body(html)
 
+        html = self.shell[0] + html + self.shell[1]
         base = "file://labnote.int.abs/" + self.current_file
         log.debug("base " + base)
         self.webview.load_html(html, base)
 
+    def patch_done(self, webview, result, data):
+        (html, start) = data
+        try:
+            res = webview.run_javascript_finish(result)
+            ok = res.get_js_value().to_boolean()
+        except GLib.Error as e:  # pylint: disable=catching-non-exception
+            log.debug("patch failed " + str(e))
+            ok = False
+
+        self.stats.add("script", (time.perf_counter() - start) * 1000)
+
+        if log.isEnabledFor(logging.INFO):
+            delta = time.clock_gettime(time.CLOCK_MONOTONIC) - self.time_start
+            log.info(str(delta))
+
+        if not ok:
+            # page does not match, newer patches will fail as well
+            if self.update_lock:
+                return
+            if self.update_html:
+                (html, self.block_lines) = self.update_html
+                self.update_html = None
+            self.load_html(html)
+
+
+    def show_chunks(self, jump=False):
+        # gtk thread, brings the page of a large document up to date
+        # jump: scroll to the mark
+        if not self.large or self.update_lock or not self.shell_loaded:
+            return
+        with self.render_lock:
+            diff = self.large.diff()
+            self.block_lines = self.large.lines
+            html = "".join(self.large.page)
+        if not diff:
+            return
+        (total, first, count, fragment) = diff
+        log.debug("replacing {} chunks at {}".format(count, first))
+        script = "chunks({}, {}, {}, {}, {})".format(total, first, count,
+                                                    json.dumps(fragment), json.dumps(jump))
+        self.webview.run_javascript(script, None, self.patch_done, (html, time.perf_counter()))
+
+    def start_lazy(self):
+        # render placeholders of a large document in the background
+        if not self.large:
+            self.lazy.cancel()
+            return
+        with self.render_lock:
+            keys = self.large.pending()
+        self.lazy.start(keys)
+
+    def render_lazy(self, key):
+        # lazy render thread
+        with self.render_lock:
+            if self.large:
+                return self.large.render_key(key)
+        return False
+
+    def lazy_done(self, rendered):
+        if rendered:
+            self.show_chunks()
+
+    def preview_lazy(self, manager, result):
+        self.lazy.request(result.get_js_value().to_string())
+
+    def jump_preview(self, line):
+        # scroll the preview to the block containing line, without rendering
+        if self.large and not self.large.shown(line):
+            return False
+        n = block_at(self.block_lines, line + 1)
+        if n < 0:
+            return False
+        self.webview.run_javascript("jumpblock({})".format(n), None, None, None)
+        return True
+
+    def preview_sync(self, manager, result):
+        # move the cursor to the block double clicked in the preview
+        n = result.get_js_value().to_int32()
+        if n < 0 or n >= len(self.block_lines):
+            return
+        it = self.tvbuffer.get_iter_at_line(max(self.block_lines[n] - 1, 0))
+        self.tvbuffer.place_cursor(it)
+        self.textview.scroll_to_iter(it, 0, True, 0.0, 0.0)
+        self.textview.grab_focus()
+
 
     def buffer_undo(self, manager):
 
@@ -904,7 +1330,26 @@ class mainwindow():
 
     # load file (location bar)
     def on_entry_act(self, entry):
-        self.load_uri(entry.get_text())
+        path = entry.get_text()
+        # new notes are opened as typed
+        if not self.registry.exists(path) and not path.endswith(".rst"):
+            best = self.quick_open.search(path, 1)
+            if best:
+                path = best[0]
+        self.load_uri(path)
+
+    def on_entry_changed(self, entry):
+        # not when the current file is shown
+        if not entry.has_focus():
+            return
+        self.completions.clear()
+        for path in self.quick_open.search(entry.get_text()):
+            self.completions.append([path])
+
+    def on_completion(self, completion, model, it):
+        self.entry.set_text(model[it][0])
+        self.load_uri(model[it][0])
+        return True
 
 
     # starting search
@@ -916,13 +1361,37 @@ class mainwindow():
         self.search_results.clear()
 
         if self.search_mode == "global":
-            res = grep(pattern, startdir)
+            try:
+                re.compile(pattern)
+            except re.error as e:
+                self.state.set("main", "invalid pattern: " + str(e))
+                return
+            # results are added as they are found, see search_found
+            self.search_ranked = []
+            self.search_page = 0
+            self.state.set("main", "searching")
+            self.global_search.start(pattern)
 
-            for r in res:
-                self.search_results.append(r)
+        if self.search_mode == "history":
+            try:
+                re.compile(pattern)
+            except re.error as e:
+                self.state.set("main", "invalid pattern: " + str(e))
+                return
+            self.history_rows = []
+            self.state.set("main", "searching history")
+            self.history_search.start(pattern)
 
         if self.search_mode == "local":
-            res = search(pattern, self.current_file)
+            # unsaved changes included
+            if self.buffer_search.text is None:
+                self.buffer_search.set_text(self.tvbuffer.props.text)
+            try:
+                res = self.buffer_search.search(pattern)
+            except re.error as e:
+                self.state.set("main", "invalid pattern: " + str(e))
+                return
+            res = [[str(no), "", line.strip()] for (no, line) in res]
 
             for r in res:
                 self.search_results.append(r)
@@ -934,12 +1403,177 @@ class mainwindow():
                 self.tvbuffer.place_cursor(it)
                 self.textview.scroll_to_iter(it, 0, True, 0.0, 0.0)
                 self.lock_line = res_line
-                self.update_textview()
+                if not self.jump_preview(res_line):
+                    self.update_textview()
 
         self.webview.hide()
+        self.backlinks_sw.hide()
         self.search_results_sw.show()
 
 
+    def scan_files(self):
+        # startup thread
+        self.registry.scan()
+        quick_open = PathIndex()
+        for path in self.registry.paths():
+            if not os.path.basename(path).startswith("."):
+                quick_open.add(path)
+        GLib.idle_add(self.set_quick_open, quick_open)
+        GLib.idle_add(self.watcher.start)
+        if self.index:
+            self.index.refresh()
+            graph = self.index.graph()
+        else:
+            graph = LinkGraph()
+            for path in self.registry.paths(".rst"):
+                graph.set_links(path, read_links(path))
+        GLib.idle_add(self.set_links, graph)
+
+    def set_quick_open(self, quick_open):
+        # files saved meanwhile
+        for path in self.quick_open.ids:
+            quick_open.add(path)
+        self.quick_open = quick_open
+        return False
+
+    def set_links(self, graph):
+        # notes saved meanwhile
+        for (path, links) in self.links_updated.items():
+            graph.set_links(path, links)
+        self.links = graph
+        self.links_updated = {}
+        self.links_ready = True
+        if self.backlinks_sw.get_visible():
+            self.show_backlinks()
+        return False
+
+    def update_notes(self, paths):
+        # after saving or changes outside of the editor
+        paths = [p for p in paths if p.endswith(".rst")]
+        if not paths:
+            return
+        def update():
+            for path in paths:
+                if self.index:
+                    self.index.update(path)
+                    links = self.index.links(path)
+                else:
+                    links = read_links(path)
+                if links is not None:
+                    GLib.idle_add(self.note_links_changed, path, links)
+        fred = threading.Thread(target=update)
+        fred.daemon = True
+        fred.start()
+
+    def note_links_changed(self, path, links):
+        self.links.set_links(path, links)
+        if not self.links_ready:
+            self.links_updated[path] = links
+        if self.backlinks_sw.get_visible():
+            self.show_backlinks()
+        return False
+
+    def show_backlinks(self):
+        # lookup by target, no need to parse other notes
+        self.backlinks.clear()
+        target = os.path.normpath(self.current_file)
+        for (source, line) in self.links.backlinks(target):
+            self.backlinks.append([str(line or ""), source])
+        if self.links_ready:
+            self.state.set("main", "{} backlinks".format(len(self.backlinks)))
+        else:
+            self.state.set("main", "collecting links")
+        self.webview.hide()
+        self.search_results_sw.hide()
+        self.backlinks_sw.show()
+
+    def hide_backlinks(self):
+        self.backlinks_sw.hide()
+        self.webview.show()
+        self.textview.grab_focus()
+
+    def on_backlink(self, treeview, path, column):
+        it = self.backlinks.get_iter(path)
+        line = self.backlinks.get_value(it, 0)
+        self.deferred_line = int(line) - 1 if line else 0
+        self.load_uri(self.backlinks.get_value(it, 1))
+
+    def on_backlinks_key(self, widget, event):
+        if event.keyval == Gdk.KEY_Escape:
+            self.hide_backlinks()
+            return True
+        return False
+
+    def files_changed(self, paths):
+        # changed outside of the editor as well
+        for path in paths:
+            if os.path.basename(path).startswith("."):
+                continue
+            if self.registry.exists(path):
+                self.quick_open.add(path)
+            else:
+                self.quick_open.remove(path)
+        self.update_notes(paths)
+
+    def on_search_changed(self, entry):
+        # local search follows typing, global search waits for enter
+        if self.search_mode != "local":
+            return
+        if not entry.get_text():
+            self.search_results.clear()
+            return
+        self.on_search(entry)
+
+    def search_found(self, rows):
+        for r in rows:
+            self.search_results.append(r)
+
+    def search_best(self, rows):
+        # ranked results, replace the ones found so far
+        self.search_ranked = rows
+        self.show_search_page(0)
+
+    def history_found(self, rows):
+        for (blob, commit, ct, path, no, line) in rows:
+            self.history_rows.append((blob, commit, ct, path))
+            self.search_results.append([str(no), describe(commit, ct, path), line.strip()])
+
+    def search_done(self, count, limited):
+        if self.config["search_ranked"] and self.search_mode == "global":
+            self.search_count = count
+            self.search_status()
+            return
+        if limited:
+            self.state.set("main", "showing first {} results".format(count))
+        else:
+            self.state.set("main", "{} results".format(count))
+
+    def page_size(self):
+        return self.config["search_page"] or max(1, len(self.search_ranked))
+
+    def show_search_page(self, page):
+        size = self.page_size()
+        pages = max(1, (len(self.search_ranked) + size - 1) // size)
+        self.search_page = max(0, min(page, pages - 1))
+        self.search_results.clear()
+        first = self.search_page * size
+        for r in self.search_ranked[first:first+size]:
+            self.search_results.append(r)
+        self.search_status()
+
+    def search_status(self):
+        kept = len(self.search_ranked)
+        if not kept:
+            self.state.set("main", "{} results".format(self.search_count))
+            return
+        first = self.search_page * self.page_size()
+        last = min(kept, first + self.page_size())
+        msg = "{} results, best {}-{}".format(max(self.search_count, kept), first + 1, last)
+        if last < kept:
+            msg += " (Alt-PageDown for more)"
+        self.state.set("main", msg)
+
+
     # search result activated
     def on_search_result(self, treeview, it, path):
         selection = treeview.get_selection()
@@ -952,17 +1586,42 @@ class mainwindow():
             self.deferred_line = res_line
             self.load_uri(res_file)
 
+        if self.search_mode == "history":
+            self.show_revision(*self.history_rows[pathlist[0].get_indices()[0]])
+
         if self.search_mode == "local":
             it_ = self.tvbuffer.get_iter_at_line(res_line)
             self.tvbuffer.place_cursor(it_)
             self.textview.scroll_to_iter(it_, 0, True, 0.0, 0.0)
 
             self.lock_line = res_line
-            self.update_textview()
+            if not self.jump_preview(res_line):
+                self.update_textview()
 
 
+    def show_revision(self, blob, commit, ct, path):
+        # read-only, the editor keeps the current file
+        rst = self.history.read(blob)
+        if rst is None:
+            self.state.set("main", "revision not found")
+            return
+        view = RevisionView(self.shell, describe(commit, ct, path), rst2html(rst),
+                            self.history, commit, path)
+        view.window.connect("destroy", lambda w: self.revisions.remove(view))
+        self.revisions.append(view)
+
     def on_search_key(self, widget, event):
+        if event.state & Gdk.ModifierType.MOD1_MASK and self.search_ranked:
+            if event.keyval == Gdk.KEY_Page_Down:
+                self.show_search_page(self.search_page + 1)
+                return True
+            if event.keyval == Gdk.KEY_Page_Up:
+                self.show_search_page(self.search_page - 1)
+                return True
+
         if event.keyval == Gdk.KEY_Escape:
+            self.global_search.cancel()
+            self.history_search.cancel()
             self.lock_line = 0
             self.searchr.set_reveal_child(False)
             self.search_results_sw.hide()
@@ -989,16 +1648,52 @@ class mainwindow():
     def shutdown_final(self, userdata=None):
         self.webview.run_javascript("window.close()", None, None)
 
+        self.dump_stats()
+        self.global_search.shutdown()
+        self.history_search.cancel()
+        if self.history:
+            self.history.close()
+
         self.git.commit()
         self.git.push()
 
         loop.quit()
 
 
-    def render(self, rst, lock=False):
+    def on_sigusr1(self):
+        # from the main loop, a python signal handler could interrupt
+        # Stats.add and wait for its lock forever
+        self.dump_stats()
+        return True
+
+    def dump_stats(self):
+        # on exit and SIGUSR1
+        path = self.config["stats_file"]
+        if not path:
+            return
+        log.debug("writing stats to " + path)
+        try:
+            self.stats.dump(path)
+        except OSError as e:
+            log.error("could not write stats: " + str(e))
+
+
+    def render(self, rst, line=None):
+        # line: place scroll mark in front of this line
+
+        with self.render_lock:
+            (html, lines) = self.pipeline.render(rst, line)
+
+        # debug output
+        if log.isEnabledFor(logging.DEBUG):
+            with open("/tmp/labnote.html", "w") as f:
+                f.write(self.shell[0] + html + self.shell[1])
+
+        return (html, lines)
 
-        # docutils: imho a bug
-        rst = handle_spaces(rst)
+    def build_shell(self):
+        # page around the rendered body, loaded once
+        # returns (head, tail)
 
         args = {
             "_disable_config": True,
@@ -1014,160 +1709,207 @@ class mainwindow():
             if mathstyle:
                 args["math_output"] = "HTML " + os.path.join(os.path.dirname(stylepath), mathstyle)
 
+        # math stylesheet is only added for documents containing math
+        dtree = docutils.core.publish_doctree(":math:`x`",
+                    settings_overrides={"_disable_config": True, "warning_stream": False})
+        writer = html_writer()
+        docutils.core.publish_from_doctree(dtree, writer=writer,
+                                           settings_overrides=dict(args, warning_stream=False))
+        parts = writer.parts
 
-        if lock or self.lock_line:
-            # get current line
-            cursor_mark = self.tvbuffer.get_insert()
-            cursor_iter = self.tvbuffer.get_iter_at_mark(cursor_mark)
-            line = cursor_iter.get_line()
-            if not line:
-                line = 0
+        script = r"""
+        function update()
+        {
+            var max = document.body.scrollHeight - window.innerHeight;
+            document.title = window.pageYOffset / max;
+        }
 
-            if self.lock_line:
-                line = self.lock_line
+        function scroll()
+        {
+            var mark = document.getElementById('btj0m1ve');
+            if (mark)
+                mark.scrollIntoView();
+        }
 
-            mark = "<a id='btj0m1ve'></a>"
-            node_mark = docutils.nodes.raw(mark, mark, format="html")
+        // number of the block containing node, see block_lines
+        function block(node)
+        {
+            var n = -1;
+            var walker = document.createTreeWalker(document.body, NodeFilter.SHOW_COMMENT, null, false);
+            while (walker.nextNode()) {
+                var start = walker.currentNode;
+                if (start.data != "lnb")
+                    continue;
+                if (!(start.compareDocumentPosition(node) & Node.DOCUMENT_POSITION_FOLLOWING))
+                    break;
+                n++;
+            }
+            return n;
+        }
 
-        # docutils: should really use logging
-        with devnull():
-            try:
-                pargs = {"_disable_config": True, "doctitle_xform": False}
-                dtree = docutils.core.publish_doctree(rst, settings_overrides=pargs)
-            except docutils.utils.SystemMessage as e:
-                return "<body>Error<br>" + str(e) + "</body>"
-
-        dtree = self.dtree_prep(dtree)
-
-        # scroll to current edit
-        if lock or self.lock_line:
-
-            elements = []
-            for elem in dtree.traverse(siblings=True):
-                if not elem.line:
-                    continue
-                # currently edited line is <= to start line of element
-                if elem.line > line:
-                    break
-                elements.append(elem)
-
-            # we want to insert scroll mark in front of currently edited elemet
-            if elements:
-                elements.pop()
-            # appending can not work
-            blacklist = ["comment", "math_block", "section",
-                         "field", "line_block", "footnote",
-                         "bullet_list", "enumerated_list",
-                         "definition_list_item", "substitution_definition"]
-
-            for elem in reversed(elements):
-                if elem.tagname in blacklist:
-                    continue
-                log.debug("append mark to: " + elem.tagname)
-                elem += node_mark
-                break
+        function jumpblock(n)
+        {
+            var i = 0;
+            var walker = document.createTreeWalker(document.body, NodeFilter.SHOW_COMMENT, null, false);
+            while (walker.nextNode()) {
+                var start = walker.currentNode;
+                if (start.data != "lnb")
+                    continue;
+                if (i++ < n)
+                    continue;
+                var elem = start.nextSibling;
+                while (elem && elem.nodeType != Node.ELEMENT_NODE)
+                    elem = elem.nextSibling;
+                if (elem)
+                    elem.scrollIntoView();
+                return true;
+            }
+            return false;
+        }
 
-        # more debug
-        if log.isEnabledFor(logging.DEBUG):
-            pretty = docutils.core.publish_from_doctree(dtree, writer_name="pseudoxml")
-            with open("/tmp/labnote.dtree", "w") as f:
-                f.write(pretty.decode())
+        document.addEventListener("dblclick", function(event) {
+            window.webkit.messageHandlers.sync.postMessage(block(event.target));
+        });
 
-        with devnull():
-            try:
-                html = docutils.core.publish_from_doctree(dtree, writer_name="html4css1",
-                            settings_overrides=args)
+        // replace the whole body, pos: scroll position or null for the mark
+        function show(html, pos, base)
+        {
+            document.body.innerHTML = html;
+            observe();
+            if (base) {
+                var elem = document.querySelector("base");
+                if (!elem) {
+                    elem = document.createElement("base");
+                    document.head.appendChild(elem);
+                }
+                elem.href = base;
+            }
+            if (pos === null)
+                scroll();
+            else
+                window.scrollTo(0, pos * (document.body.scrollHeight - window.innerHeight));
+            return true;
+        }
 
-            except docutils.utils.SystemMessage as e:
-                html = "<body>Error<br>" + str(e) + "</body>"
-            except AttributeError as e:
-                # docutils: parser should support optionally omitting broken nodes
-                html = "<body>Error<br>" + str(e) + "</body>"
+        // placeholders of large documents are rendered when they come
+        // close to the viewport, see render.LargeDocument
+        var lazy = new IntersectionObserver(function(entries) {
+            entries.forEach(function(entry) {
+                if (entry.isIntersecting)
+                    window.webkit.messageHandlers.lazy.postMessage(entry.target.dataset.key);
+            });
+        }, {rootMargin: "100% 0px"});
 
-        script = "<head>\n<script>"
-        body = '<body onscroll="update()"'
+        function observe()
+        {
+            lazy.disconnect();
+            var elems = document.getElementsByClassName("lnlazy");
+            for (var i = 0; i < elems.length; i++)
+                lazy.observe(elems[i]);
+        }
 
-        script += r"""
-        function update()
+        // replace count chunks starting at first by html
+        // jump: scroll to the mark, otherwise the view stays where it is
+        function chunks(total, first, count, html, jump)
         {
-            var max = document.body.scrollHeight - window.innerHeight;
-            document.title = window.pageYOffset / max;
+            var elems = document.querySelectorAll("body > .lnchunk");
+            if (elems.length != total)
+                return false;
+
+            // chunks above the view change their height
+            var anchor = null;
+            var top = 0;
+            if (!jump && first + count < total) {
+                anchor = elems[first + count];
+                top = anchor.getBoundingClientRect().top;
+                if (top > 0)
+                    anchor = null;
+            }
+
+            var range = document.createRange();
+            if (count) {
+                range.setStartBefore(elems[first]);
+                range.setEndAfter(elems[first + count - 1]);
+                range.deleteContents();
+            } else if (first < total) {
+                range.setStartBefore(elems[first]);
+                range.collapse(true);
+            } else if (total) {
+                range.setStartAfter(elems[total - 1]);
+                range.collapse(true);
+            } else {
+                range.selectNodeContents(document.body);
+                range.collapse(false);
+            }
+            if (html)
+                range.insertNode(range.createContextualFragment(html));
+
+            if (anchor)
+                window.scrollBy(0, anchor.getBoundingClientRect().top - top);
+            observe();
+            if (jump)
+                scroll();
+            return true;
         }
         """
 
-        if lock or self.lock_line:
-            body += 'onload="scroll()"'
-
+        if self.config["live_update"]:
+            # replace count blocks starting at first by html
             script += r"""
-            function scroll() {
-              document.getElementById('btj0m1ve').scrollIntoView();
+            function patch(total, first, count, html)
+            {
+                var starts = [];
+                var ends = [];
+                var walker = document.createTreeWalker(document.body, NodeFilter.SHOW_COMMENT, null, false);
+                while (walker.nextNode()) {
+                    var node = walker.currentNode;
+                    if (node.data == "lnb")
+                        starts.push(node);
+                    if (node.data == "/lnb")
+                        ends.push(node);
+                }
+                if (starts.length != total || ends.length != total)
+                    return false;
+
+                var range = document.createRange();
+                if (count) {
+                    range.setStartBefore(starts[first]);
+                    range.setEndAfter(ends[first + count - 1]);
+                    range.deleteContents();
+                } else if (!html) {
+                    // nothing changed
+                } else if (first < total) {
+                    range.setStartBefore(starts[first]);
+                    range.collapse(true);
+                } else {
+                    range.setStartAfter(ends[first - 1]);
+                    range.collapse(true);
+                }
+                if (html)
+                    range.insertNode(range.createContextualFragment(html));
+
+                scroll();
+                return true;
             }
             """
 
-        body += '>'
-        html = re.sub(r'<body>', body, html, re.M)
-
-        script += "\n</script>"
-        html = re.sub(r'<head>', script, html, re.M)
-
-        # debug output
-        if log.isEnabledFor(logging.DEBUG):
-            with open("/tmp/labnote.html", "w") as f:
-                f.write(html)
-
-        return html
-
-
-def ref2uri(refuri, curdir):
-    ## path to uri
+        head = parts["head_prefix"] + parts["head"] + parts["stylesheet"]
+        head += "<script>" + script + "\n</script>\n</head>\n"
+        head += '<body onscroll="update()" onload="scroll(); observe()">\n'
+        tail = "</body>\n</html>\n"
 
-    if "://" in refuri:
-        if not refuri.startswith("file://"):
-            return None
-
-    if refuri.startswith("file://"):
-        a = "ext"
-        refuri = refuri[7:]
-    else:
-        a = "int"
+        return (head, tail)
 
-    if refuri.startswith("/"):
-        b = "abs"
-        refuri = refuri[1:]
-    else:
-        b = "rel"
-
-    if refuri.startswith("..") and b == "rel":
-        if a == "int":
-            refuri = curdir + "/" + refuri
-            refuri = os.path.normpath(refuri)
-            b = "abs"
-        if a == "ext":
-            refuri = startdir + "/" + refuri
-            refuri = os.path.normpath(refuri)
-            refuri = refuri[1:]
-            b = "abs"
-
-    refuri = "file://labnote.{}.{}/{}".format(a, b, refuri)
-    return refuri
-
-def uri2path(uri, curdir, startdir):
-    ## uri to path
-    uri_ = uri[23:]
-
-    if uri[15:18] == "ext":
-        ext = True
-        if uri[19:22] == "rel":
-            uri_ = startdir + "/" + uri_
-        else:
-            uri_ = "/" + uri_
-    else:
-        ext = False
-        if uri[19:22] == "rel":
-            if curdir:
-                uri_ = curdir + "/" + uri_
 
-    return uri_, ext
+def read_links(path):
+    # [(line, target)] of a note, without the index
+    try:
+        return note_links(path, "\n".join(read_lines(path)), startdir)
+    except (OSError, UnicodeDecodeError):
+        return []
+    except Exception as e:
+        log.warning("links of {}: {}".format(path, e))
+        return []
 
 
 def rst2tex(rst, meta, conf):
@@ -1183,19 +1925,34 @@ def rst2tex(rst, meta, conf):
     preamble += "\\fancyfoot[L]{" + meta["rev"]   + "}\n"
     preamble += "\\fancyfoot[R]{" + meta["dt"] + "}\n"
 
-    args = {"latex_preamble": preamble,
-            "doctitle_xform": False}
+    args = {"doctitle_xform": False, "warning_stream": False}
 
-    with devnull():
-        try:
-            tex = docutils.core.publish_string(rst, writer_name='latex',
-                                               settings_overrides=args)
-        except NotImplementedError:
-            log.error("could not convert to tex")
-            return None
+    try:
+        # preamble changes with every export, settings do not
+        tex = engine("string", "latex", args).publish(rst, latex_preamble=preamble)
+    except NotImplementedError:
+        log.error("could not convert to tex")
+        return None
 
     return tex.decode()
 
+def rst2html(rst):
+    # body of a note shown outside of the editor, links as written
+
+    args = {
+        "_disable_config": True,
+        "embed_stylesheet": False,
+        "stylesheet_path": "",
+        "stylesheet": "",
+        "math_output": "HTML",
+        "output_encoding": "unicode",
+        "warning_stream": False,
+    }
+
+    e = engine("string", html_writer, args)
+    e.publish(handle_spaces(rst))
+    return e.parts["html_body"].replace(rechar, "%20")
+
 def tex2pdf(tex, srcdir, pdfpath, cb):
     srcdir = os.path.abspath(srcdir)
     pdfpath = os.path.abspath(pdfpath)
@@ -1273,33 +2030,6 @@ def save_file(fp, txt):
     return True
 
 
-def search(pattern, filepath):
-    r = re.compile(pattern, flags=re.IGNORECASE)
-    res = []
-    with open(filepath) as f:
-        for (lineno, line) in enumerate(f):
-            if r.search(line):
-                res.append([str(lineno+1), "", line.strip()])
-    return res
-
-def grep(pattern, dirpath):
-    r = re.compile(pattern, flags=re.IGNORECASE)
-    res = []
-    for parent, dirs, files in os.walk(dirpath):
-        for f in files:
-            filepath = os.path.join(parent, f)
-            if os.path.isfile(filepath) and filepath.endswith(".rst"):
-                with open(filepath) as f:
-                    for (lineno, line) in enumerate(f):
-                        if r.search(line):
-                            # remove startdir from filepath
-                            filepath = os.path.normpath(filepath)
-                            filepath = filepath.replace(startdir, "", 1)
-                            if filepath[0] == "/":
-                                filepath = filepath[1:]
-                            res.append([str(lineno+1), filepath, line.strip()])
-    return res
-
 
 def run(cmd, stdin=None, cwd=None):
     # blocking!
@@ -1316,29 +2046,6 @@ def run(cmd, stdin=None, cwd=None):
     return proc.returncode, ret
 
 
-def handle_spaces(rstin):
-    rstout = ""
-    reg = re.compile("`.*<.* .*>`_")
-    for line in rstin.splitlines():
-        mat = reg.search(line)
-        if mat:
-            state = 0
-            tl = ""
-            for (i, c) in enumerate(line):
-                if state == 0 and c == '`':
-                    state = 1
-                if state == 1 and c == '<':
-                    state = 2
-                if state == 2 and c == '`':
-                    state = 0
-                if state == 2 and c == ' ':
-                    c = rechar
-                tl += c
-            line = tl
-        rstout += line + "\n"
-    return rstout
-
-
 class Git():
 
     def __init__(self, d, log=None):
@@ -1508,17 +2215,444 @@ class InfoBar():
         self.done()
 
 
-class devnull():
-    def __init__(self):
-        self.devnull = io.StringIO()
+class RenderScheduler():
+    # renders buffer snapshots in a worker thread
+    #
+    # snapshots submitted within delay are coalesced, only the newest is
+    # rendered and results outdated by a newer snapshot are dropped
+
+    def __init__(self, render, done, delay):
+        self.render = render
+        self.done = done
+        # seconds
+        self.delay = delay
+
+        self.cond = threading.Condition()
+        self.snapshot = None
+        self.submitted = 0
+        self.generation = 0
+
+        worker = threading.Thread(target=self.run)
+        worker.daemon = True
+        worker.start()
+
+    def submit(self, snapshot):
+        with self.cond:
+            self.snapshot = snapshot
+            self.submitted = time.monotonic()
+            self.generation += 1
+            self.cond.notify()
+
+    def cancel(self):
+        with self.cond:
+            self.snapshot = None
+            self.generation += 1
+
+    def run(self):
+        while True:
+            with self.cond:
+                while True:
+                    if self.snapshot is None:
+                        self.cond.wait()
+                        continue
+                    # wait for typing to pause
+                    remaining = self.submitted + self.delay - time.monotonic()
+                    if remaining > 0:
+                        self.cond.wait(remaining)
+                        continue
+                    break
+                snapshot = self.snapshot
+                generation = self.generation
+                self.snapshot = None
+
+            try:
+                res = self.render(snapshot)
+            except Exception as e:
+                log.error("rendering failed: " + str(e))
+                continue
+
+            GLib.idle_add(self.finish, generation, res)
+
+    def finish(self, generation, res):
+        # gtk thread
+        if generation == self.generation:
+            self.done(res)
+        else:
+            log.debug("dropping outdated render")
+        return False
+
+
+class LazyRenderer():
+    # renders placeholders of large documents in a worker thread
+    #
+    # requested keys (scrolled into view) are rendered first, then the
+    # others in the order given to start
+
+    def __init__(self, render, done):
+        self.render = render
+        self.done = done
+
+        self.cond = threading.Condition()
+        self.keys = []
+        self.generation = 0
+
+        worker = threading.Thread(target=self.run)
+        worker.daemon = True
+        worker.start()
+
+    def start(self, keys):
+        with self.cond:
+            self.keys = list(keys)
+            self.generation += 1
+            self.cond.notify()
+
+    def request(self, key):
+        with self.cond:
+            if key in self.keys:
+                self.keys.remove(key)
+            self.keys.insert(0, key)
+            self.cond.notify()
+
+    def cancel(self):
+        self.start([])
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.keys:
+                    self.cond.wait()
+                key = self.keys.pop(0)
+                generation = self.generation
+
+            try:
+                res = self.render(key)
+            except Exception as e:
+                log.error("rendering failed: " + str(e))
+                continue
+
+            GLib.idle_add(self.finish, generation, res)
+
+    def finish(self, generation, res):
+        # gtk thread
+        if generation == self.generation:
+            self.done(res)
+        return False
+
+
+class FileWatcher():
+    # keeps a Registry current
+    #
+    # A Gio.FileMonitor (inotify) watches a single directory, so there is
+    # one per directory.  Events are collected for a moment, editors and git
+    # touch many files at once.
+
+    def __init__(self, registry, changed, delay=200):
+        self.registry = registry
+        # called with the changed files
+        self.changed = changed
+        # milliseconds
+        self.delay = delay
+
+        # relative directory -> monitor
+        self.monitors = {}
+        self.pending = set()
+        self.timeout = None
+
+    def start(self):
+        # gtk thread, after the registry is scanned
+        self.sync()
+        log.debug("watching {} directories".format(len(self.monitors)))
+        return False
+
+    def sync(self):
+        # one monitor for every known directory
+        with self.registry.lock:
+            dirs = set(self.registry.dirs)
+        for d in list(self.monitors):
+            if d not in dirs:
+                self.monitors.pop(d).cancel()
+        for d in dirs:
+            if d in self.monitors:
+                continue
+            gfile = Gio.File.new_for_path(os.path.join(self.registry.root, d))
+            try:
+                monitor = gfile.monitor_directory(Gio.FileMonitorFlags.WATCH_MOVES, None)
+            except GLib.Error as e:  # pylint: disable=catching-non-exception
+                log.warning("can not watch " + d + ": " + str(e))
+                continue
+            monitor.connect("changed", self.on_changed)
+            self.monitors[d] = monitor
+
+    def on_changed(self, monitor, gfile, other, event):
+        for f in (gfile, other):
+            if f and f.get_path():
+                self.pending.add(f.get_path())
+        if self.timeout is None:
+            self.timeout = GLib.timeout_add(self.delay, self.flush)
+
+    def flush(self):
+        self.timeout = None
+        paths = sorted(self.pending)
+        self.pending = set()
+
+        changed = []
+        for path in paths:
+            changed.extend(self.registry.update(path))
+        # directories created or removed
+        self.sync()
+        if changed:
+            log.debug("files changed: " + str(len(changed)))
+            self.changed(changed)
+        return False
+
+
+class GlobalSearch():
+    # searches the notes in a worker thread, files are matched by a pool of
+    # processes, results are passed to found in batches in file order
+    #
+    # ranked: called once at the end with the best limit results, best
+    # first (see index.py), they replace the ones passed to found
+    #
+    # a new search cancels the running one, at most limit results are found
+
+    # files per task
+    batch = 32
+
+    def __init__(self, index, registry, found, done, limit, ranked=None):
+        # index: Index or None to scan all files
+        self.index = index
+        self.registry = registry
+        self.found = found
+        self.done = done
+        self.limit = limit
+        self.ranked = ranked
+
+        self.lock = threading.Lock()
+        self.generation = 0
+        # started on the first search of many files
+        self.pool = None
+        # generation shared with the workers, see index.init_worker
+        self.shared = None
+
+    def start(self, pattern):
+        with self.lock:
+            generation = self.next_generation()
+        fred = threading.Thread(target=self.run, args=(pattern, generation))
+        fred.daemon = True
+        fred.start()
+
+    def cancel(self):
+        with self.lock:
+            self.next_generation()
+
+    def next_generation(self):
+        # with the lock held
+        self.generation += 1
+        if self.shared:
+            # batches of the previous search stop in the workers
+            self.shared.value = self.generation
+        return self.generation
+
+    def cancelled(self, generation):
+        return generation != self.generation
+
+    def executor(self):
+        with self.lock:
+            if not self.pool:
+                # forking a gtk process is not safe
+                ctx = multiprocessing.get_context("spawn")
+                self.shared = ctx.Value("q", self.generation)
+                self.pool = concurrent.futures.ProcessPoolExecutor(
+                    mp_context=ctx, initializer=init_worker, initargs=(self.shared,))
+            return self.pool
+
+    def shutdown(self):
+        self.cancel()
+        if self.pool:
+            self.pool.shutdown(wait=False, cancel_futures=True)
 
-    def __enter__(self):
-        sys.stdout = self.devnull
-        sys.stderr = self.devnull
+    def run(self, pattern, generation):
+        start = time.perf_counter()
 
-    def __exit__(self, type_, value, traceback):
-        sys.stdout = sys.__stdout__
-        sys.stderr = sys.__stderr__
+        if self.index:
+            files = self.index.files(pattern)
+        else:
+            if self.registry.scanned:
+                paths = self.registry.paths(".rst")
+            else:
+                paths = sorted(rst_files(startdir))
+            files = [(path, None) for path in paths]
+        batches = [files[i:i+self.batch] for i in range(0, len(files), self.batch)]
+
+        if self.ranked:
+            ranks = self.index.centrality() if self.index else {}
+            now = time.time()
+            func = rank_batch
+            # only the ranks of the notes in the batch are passed
+            args = [(pattern, startdir, b, dict((p, ranks[p]) for (p, l) in b if p in ranks),
+                     self.limit, now, generation) for b in batches]
+        else:
+            func = grep_batch
+            args = [(pattern, startdir, b, generation) for b in batches]
+
+        if len(batches) > 2:
+            pool = self.executor()
+            tasks = [pool.submit(func, *a) for a in args]
+            results = (t.result() for t in tasks)
+        else:
+            tasks = []
+            results = (func(*a) for a in args)
+
+        count = 0
+        shown = 0
+        limited = False
+        best = []
+        try:
+            for rows in results:
+                if self.cancelled(generation):
+                    break
+                if self.ranked:
+                    (rows, found) = rows
+                    count += found
+                    best = top(best + rows, self.limit)
+                    # shown in file order while the other batches are ranked
+                    rows = [r[1:] for r in sorted(rows, key=lambda r: (r[2], int(r[1])))]
+                if self.limit and shown + len(rows) > self.limit:
+                    rows = rows[:self.limit - shown]
+                    limited = True
+                shown += len(rows)
+                if rows:
+                    GLib.idle_add(self.finish, generation, self.found, rows)
+                if limited and not self.ranked:
+                    break
+        except Exception as e:
+            log.error("search failed: " + str(e))
+        for t in tasks:
+            t.cancel()
+
+        if self.ranked:
+            limited = count > len(best)
+            GLib.idle_add(self.finish, generation, self.ranked, [r[1:] for r in best])
+        else:
+            count = shown
+
+        log.debug("search: {} results in {:.3f} s".format(count, time.perf_counter() - start))
+        GLib.idle_add(self.finish, generation, self.done, count, limited)
+
+    def finish(self, generation, cb, *args):
+        # gtk thread
+        if not self.cancelled(generation):
+            cb(*args)
+        return False
+
+
+class RevisionSearch():
+    # searches the history in a worker thread, results are passed to found
+    # in batches, newest versions first
+    #
+    # a new search cancels the running one, at most limit results are found
+
+    # results per batch
+    batch = 50
+
+    def __init__(self, history, found, done, limit):
+        self.history = history
+        self.found = found
+        self.done = done
+        self.limit = limit
+
+        self.lock = threading.Lock()
+        self.generation = 0
+
+    def start(self, pattern):
+        with self.lock:
+            self.generation += 1
+            generation = self.generation
+        fred = threading.Thread(target=self.run, args=(pattern, generation))
+        fred.daemon = True
+        fred.start()
+
+    def cancel(self):
+        with self.lock:
+            self.generation += 1
+
+    def cancelled(self, generation):
+        return generation != self.generation
+
+    def run(self, pattern, generation):
+        start = time.perf_counter()
+        count = 0
+        limited = False
+        rows = []
+        try:
+            for row in self.history.search(pattern, lambda: self.cancelled(generation)):
+                if self.limit and count == self.limit:
+                    limited = True
+                    break
+                rows.append(row)
+                count += 1
+                if len(rows) == self.batch:
+                    GLib.idle_add(self.finish, generation, self.found, rows)
+                    rows = []
+        except Exception as e:
+            log.error("history search failed: " + str(e))
+        if rows:
+            GLib.idle_add(self.finish, generation, self.found, rows)
+
+        log.debug("history: {} results in {:.3f} s".format(count, time.perf_counter() - start))
+        GLib.idle_add(self.finish, generation, self.done, count, limited)
+
+    def finish(self, generation, cb, *args):
+        # gtk thread
+        if not self.cancelled(generation):
+            cb(*args)
+        return False
+
+
+class RevisionView():
+    # rendered version of a note in a window of its own, links are not
+    # followed
+    #
+    # images and other files of the note come from the same commit, as
+    # labnote-rev://<commit>/<path>, absolute paths are below the notes as
+    # well.  file:// links point outside of the notes and are not loaded.
+
+    scheme = "labnote-rev"
+
+    def __init__(self, shell, title, body, history, commit, path):
+        self.history = history
+        self.window = Gtk.Window(title=title)
+        self.window.set_default_size(800, 600)
+
+        context = WebKit2.WebContext.new_ephemeral()
+        context.register_uri_scheme(self.scheme, self.uri_scheme_rev)
+        self.webview = WebKit2.WebView.new_with_context(context)
+        self.webview.connect("decide-policy", self.load_policy)
+        d = os.path.dirname(path)
+        base = "{}://{}/{}".format(self.scheme, commit, urllib.parse.quote(d + "/" if d else ""))
+        self.webview.load_html(shell[0] + body + shell[1], base)
+
+        self.window.add(self.webview)
+        self.window.show_all()
+
+    def uri_scheme_rev(self, request):
+        uri = urllib.parse.urlsplit(request.get_uri())
+        path = urllib.parse.unquote(uri.path, encoding="utf-8", errors="replace").lstrip("/")
+        data = self.history.read_file(uri.netloc, path)
+        if data is None:
+            request.finish_error(GLib.Error("not in this revision: " + path))
+            return
+        (typ, enc) = mimetypes.guess_type(path)
+        stream = Gio.MemoryInputStream.new_from_data(data)
+        request.finish(stream, len(data), typ or "application/octet-stream")
+
+    def load_policy(self, webview, decision, decision_type):
+        if decision_type == WebKit2.PolicyDecisionType.NAVIGATION_ACTION:
+            nav = decision.get_navigation_action()
+            if nav.get_navigation_type() == WebKit2.NavigationType.LINK_CLICKED:
+                decision.ignore()
+                return True
+        return False
 
 
 class ConfigParser():
@@ -1534,6 +2668,14 @@ class ConfigParser():
         layout_vertical = False
         editor_first = False
         latex_preamble = 
+        render_delay = 50
+        live_update = True
+        page_cache = 32
+        large_document = 512
+        search_limit = 1000
+        search_ranked = True
+        search_page = 100
+        stats_file = 
         """
         self.parser = configparser.ConfigParser()
         self.config = {}
@@ -1591,6 +2733,33 @@ class ConfigParser():
 
         self.config["editor_first"] = self.parser.getboolean("labnote", "editor_first")
 
+        # milliseconds
+        self.config["render_delay"] = self.parser.getint("labnote", "render_delay") / 1000
+
+        self.config["live_update"] = self.parser.getboolean("labnote", "live_update")
+
+        # megabytes
+        self.config["page_cache"] = self.parser.getint("labnote", "page_cache") * 1024 * 1024
+
+        # kilobytes, larger files are rendered in chunks, 0 to disable
+        self.config["large_document"] = self.parser.getint("labnote", "large_document") * 1024
+
+        # results of a global search, 0 for no limit
+        self.config["search_limit"] = self.parser.getint("labnote", "search_limit")
+
+        # best results first, the limit applies to the ranked results
+        self.config["search_ranked"] = self.parser.getboolean("labnote", "search_ranked")
+
+        # ranked results shown at once, 0 for all
+        self.config["search_page"] = self.parser.getint("labnote", "search_page")
+
+        # render statistics are written here, see mainwindow.dump_stats
+        stats = self.parser.get("labnote", "stats_file")
+        if stats:
+            self.config["stats_file"] = os.path.expanduser(stats)
+        else:
+            self.config["stats_file"] = None
+
         tex = self.parser.get("labnote", "latex_preamble")
         if tex:
             self.config["latex_preamble"] = os.path.join(config_dir, tex)
@@ -1602,9 +2771,6 @@ class ConfigParser():
 
 if __name__ == "__main__":
 
-    global rechar
-    rechar = u"\u02FD"
-
     parser = argparse.ArgumentParser()
     parser.add_argument("-v", "--verbose", action="count")
     parser.add_argument("path", nargs="?")
@@ -1667,6 +2833,7 @@ if __name__ == "__main__":
 
     signal.signal(signal.SIGHUP, signal.SIG_IGN)
     signal.signal(signal.SIGINT, window.on_sigint)
+    GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGUSR1, window.on_sigusr1)
 
     window.history_home = startfile
     window.load_uri(startfile)
@@ -0,0 +1,1135 @@
+#!/usr/bin/env python3
+
+# Copyright 2016-2019 Thomas Krug
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import re
+import threading
+import unittest
+
+from docutils.languages import get_language
+from docutils.nodes import fully_normalize_name
+from docutils.parsers.rst import directives, states
+from docutils.parsers.rst.directives.images import Image
+from docutils.parsers.rst.languages import en
+from docutils.utils import column_width, escape2null, split_escaped_whitespace, unescape
+from docutils.utils import urischemes
+
+from preprocess import handle_spaces, rechar
+from render import engine
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+## links between notes
+#
+# References (`text <target>`_, .. _name: target) and images of a note,
+# resolved to paths relative to the notes directory.  Links to other sites
+# and to files outside of the notes directory are left out.
+
+# schemes (http:, mailto:, ...), file:// is a path
+scheme_re = re.compile(r"[a-zA-Z][a-zA-Z0-9+.-]*:")
+
+settings = {
+    "_disable_config": True,
+    "report_level": 5,
+    "halt_level": 5,
+    "warning_stream": False,
+}
+
+# the engine is shared by the threads updating links
+parse_lock = threading.Lock()
+
+
+def node_line(node):
+    # references have no line of their own
+    while node is not None:
+        if node.line:
+            return node.line
+        node = node.parent
+    return None
+
+
+def doctree_refs(dtree):
+    # [(line, target)] as written, in document order
+    res = []
+    for elem in dtree.traverse(siblings=True):
+        if elem.tagname == "reference":
+            ref = elem.get("refuri")
+        elif elem.tagname == "image":
+            ref = elem.get("uri")
+        else:
+            continue
+        if ref:
+            res.append((node_line(elem), ref))
+    return res
+
+
+def parse_refs(rst):
+    # [(line, target)], rst is the text of a note
+    with parse_lock:
+        e = engine("string", "null", settings)
+        e.publish(handle_spaces(rst))
+        refs = doctree_refs(e.document)
+    return [(line, ref.replace(rechar, " ")) for (line, ref) in refs]
+
+
+def resolve(ref, curdir, root):
+    # path relative to root, None for other sites and files outside of root
+    # curdir: directory of the note relative to root
+    ref = ref.split("#")[0]
+    if not ref:
+        return None
+    if ref.startswith("file://"):
+        ref = ref[7:]
+        path = ref if os.path.isabs(ref) else os.path.join(root, ref)
+    elif scheme_re.match(ref):
+        return None
+    elif os.path.isabs(ref):
+        path = os.path.join(root, ref[1:])
+    else:
+        path = os.path.join(root, curdir, ref)
+    path = os.path.relpath(os.path.normpath(path), root)
+    if path == "." or path.startswith(".."):
+        return None
+    return path
+
+
+def note_links(path, rst, root):
+    # [(line, target path)] of a note, path relative to root
+    curdir = os.path.dirname(path)
+    res = []
+    for (line, ref) in find_refs(rst):
+        target = resolve(ref, curdir, root)
+        if target:
+            res.append((line, target))
+    return res
+
+
+## fast extraction
+#
+# parse_refs runs the whole parser and its transforms for a few attributes.
+# scan_refs follows the block structure line by line the way the states of
+# the docutils parser do and reads inline markup with the regular
+# expressions of its inliner, then resolves named and anonymous references
+# like the transforms.  Constructs it does not follow (tables, line blocks,
+# indirect targets, other directives and roles, ...) make it give up if
+# they may hold a link, find_refs then asks docutils.  Only local references
+# are kept, images are at the line of their directive.
+
+class Unknown(Exception):
+    pass
+
+
+class Settings():
+    # what the inliner reads of the document settings
+    character_level_inline_markup = False
+    pep_references = False
+    rfc_references = False
+
+
+inliner = states.Inliner()
+inliner.init_customizations(Settings())
+
+body_patterns = [(name, re.compile(states.Body.patterns[name]))
+                 for name in states.Body.initial_transitions]
+line_re = re.compile(states.Body.patterns["line"])
+field_re = re.compile(states.Body.patterns["field_marker"])
+constructs = [(method.__name__, pattern) for (method, pattern) in states.Body.explicit.constructs]
+target_re = states.Body.explicit.patterns.target
+substitution_re = states.Body.explicit.patterns.substitution
+attribution_re = states.Body.attribution_pattern
+literal_end_re = re.compile(r"(?<!\\)(\\\\)*::$")
+quoted_re = re.compile(r"[!-/:-@[-`{-~]")
+# targets and images with a target, internal targets before them get their uri
+chain_re = re.compile(r"\.\. +(_|image ?::)|__( |$)", re.IGNORECASE)
+
+# text without these has no references
+inline_re = re.compile(r"[_`]|file:", re.IGNORECASE)
+# parts that are skipped if they have none of these
+link_re = re.compile(r"_(?!\w)|\.\. |::|file:", re.IGNORECASE)
+
+# roles without references
+plain_roles = {"abbreviation", "acronym", "code", "emphasis", "literal", "math",
+               "strong", "subscript", "superscript", "title-reference"}
+bibliographic = set(get_language("en").bibliographic_fields)
+
+# directives by what is done with them, the others are left to docutils
+directive_names = {
+    # body elements as content
+    "nested": ("attention", "caution", "danger", "error", "hint", "important", "note",
+               "tip", "warning", "admonition", "container", "compound"),
+    # the same, but only outside of body elements
+    "topic": ("topic", "sidebar"),
+    "image": ("image",),
+    "figure": ("figure",),
+    # content is not parsed
+    "literal": ("code", "math", "raw"),
+    # nothing with links
+    "other": ("rubric", "contents", "sectnum", "title", "meta"),
+}
+# names of elements, targets without uri
+name_options = {"name", "figname"}
+
+# conflicting targets of the same name
+conflict = object()
+
+
+def local(ref):
+    # paths and file:// uris, resolve() may still leave them out
+    return ref.startswith("file://") or not scheme_re.match(ref)
+
+
+def normalize(name):
+    return fully_normalize_name(unescape(name))
+
+
+def nonblank(block):
+    # block without leading and trailing blank lines
+    start = 0
+    end = len(block)
+    while start < end and not block[start][1]:
+        start += 1
+    while end > start and not block[end - 1][1]:
+        end -= 1
+    return block[start:end]
+
+
+def indented(lines, start, first_indent=None, block_indent=None,
+             until_blank=False, strip_indent=True):
+    # StringList.get_indented on [(line number, text)],
+    # returns (block, index after it)
+    indent = block_indent
+    if block_indent is not None and first_indent is None:
+        first_indent = block_indent
+    end = start + 1 if first_indent is not None else start
+    while end < len(lines):
+        line = lines[end][1]
+        if line and (line[0] != " " or (block_indent is not None
+                                        and line[:block_indent].strip())):
+            break
+        stripped = line.lstrip()
+        if not stripped:
+            if until_blank:
+                break
+        elif block_indent is None:
+            line_indent = len(line) - len(stripped)
+            indent = line_indent if indent is None else min(indent, line_indent)
+        end += 1
+    block = lines[start:end]
+    if first_indent is not None and block:
+        block[0] = (block[0][0], block[0][1][first_indent:])
+    if indent and strip_indent:
+        skip = 1 if first_indent is not None else 0
+        block[skip:] = [(no, line[indent:]) for (no, line) in block[skip:]]
+    return (block, end)
+
+
+def directive_class(name):
+    # None if docutils does not know it
+    try:
+        return directives.directive(name, en, None)[0]
+    except AttributeError:
+        # it would report to the document
+        raise Unknown
+
+
+directive_kinds = dict((directive_class(name), kind)
+                       for (kind, names) in directive_names.items() for name in names)
+
+
+class RefScanner():
+
+    def __init__(self, lines):
+        # [(line number, text)] of the document
+        self.lines = lines
+        # (line, kind, value) in document order, kind is "uri", "name" or
+        # "anonymous" (value None)
+        self.refs = []
+        # name -> uri, None for internal targets, or conflict
+        self.targets = {}
+        # uris of the anonymous targets, None for internal ones
+        self.anonymous_targets = []
+        # title styles by level, docutils stops at inconsistent ones
+        self.styles = []
+        self.level = 0
+        # targets with the name of one before
+        self.duplicates = 0
+
+    def result(self):
+        # [(line, uri)] of the local references
+        count = sum(1 for ref in self.refs if ref[1] == "anonymous")
+        # all anonymous references fail if the numbers do not match
+        anonymous = iter(self.anonymous_targets if count == len(self.anonymous_targets) else [None] * count)
+        res = []
+        for (line, kind, value) in self.refs:
+            if kind == "name":
+                uri = self.targets.get(value)
+            elif kind == "anonymous":
+                uri = next(anonymous)
+            else:
+                uri = value
+            if uri and uri is not conflict and local(uri):
+                res.append((line, uri))
+        return res
+
+    def target(self, name, uri):
+        # explicit target, uri None if internal
+        if name not in self.targets:
+            self.targets[name] = uri
+            return
+        self.duplicates += 1
+        if uri is None or self.targets[name] != uri:
+            self.targets[name] = conflict
+
+    def body(self, lines, titles=False):
+        # titles: at the top of the document, where sections can start
+        i = 0
+        while i < len(lines):
+            (no, line) = lines[i]
+            if not line:
+                i += 1
+            elif line[0] == " ":
+                i = self.block_quote(lines, i)
+            else:
+                for (name, pattern) in body_patterns:
+                    m = pattern.match(line)
+                    if m:
+                        i = getattr(self, name)(lines, i, m, titles)
+                        break
+
+    def opaque(self, block):
+        # parts that are not followed
+        for (no, line) in block:
+            if link_re.search(line):
+                raise Unknown
+
+    def block_quote(self, lines, i):
+        (block, end) = indented(lines, i)
+        # attributions are split off
+        for k in range(1, len(block)):
+            if not block[k - 1][1] and attribution_re.match(block[k][1]):
+                self.opaque(block)
+                return end
+        self.body(block)
+        return end
+
+    def bullet(self, lines, i, m, titles):
+        return self.list_item(lines, i, m.end())
+
+    def list_item(self, lines, i, indent):
+        if lines[i][1][indent:]:
+            (block, end) = indented(lines, i, block_indent=indent)
+        else:
+            (block, end) = indented(lines, i, first_indent=indent)
+        self.body(block)
+        return end
+
+    def enumerator(self, lines, i, m, titles):
+        # the methods only read the enumeration tables of the class
+        body = states.Body
+        (fmt, sequence, text, ordinal) = body.parse_enumerator(body, m)
+        if ordinal is None:
+            return self.text(lines, i, m, titles)
+        if i + 1 < len(lines) and lines[i + 1][1][:1].strip():
+            # a paragraph, unless the next line is the next item
+            res = body.make_enumerator(body, ordinal + 1, sequence, fmt)
+            try:
+                item = res and lines[i + 1][1].startswith(res)
+            except TypeError:
+                item = False
+            if not item:
+                return self.text(lines, i, m, titles)
+        return self.list_item(lines, i, m.end())
+
+    def field_marker(self, lines, i, m, titles):
+        name = m.group()[1:]
+        name = name[:name.rfind(":")]
+        (block, end) = indented(lines, i, first_indent=m.end())
+        if inline_re.search(name):
+            raise Unknown
+        if titles and normalize(name) in bibliographic:
+            # may become docinfo, without lines
+            self.opaque(block)
+        self.body(block)
+        return end
+
+    def option_marker(self, lines, i, m, titles):
+        (block, end) = indented(lines, i, first_indent=m.end())
+        if not nonblank(block):
+            return self.text(lines, i, m, titles)
+        self.body(block)
+        return end
+
+    def doctest(self, lines, i, m, titles):
+        while i < len(lines) and lines[i][1]:
+            i += 1
+        return i
+
+    def line_block(self, lines, i, m, titles):
+        start = i
+        while i < len(lines) and lines[i][1]:
+            i += 1
+        self.opaque(lines[start:i])
+        return i
+
+    grid_table_top = line_block
+
+    def simple_table_top(self, lines, i, m, titles):
+        # up to the border followed by a blank line, or the third one
+        border = re.compile(r"=+( +=+)+ *$")
+        found = 0
+        for k in range(i + 1, len(lines)):
+            if border.match(lines[k][1]):
+                found += 1
+                if found == 2 or k + 1 == len(lines) or not lines[k + 1][1]:
+                    self.opaque(lines[i:k + 1])
+                    return k + 1
+        self.opaque(lines[i:])
+        return len(lines)
+
+    def line(self, lines, i, m, titles):
+        # transitions and overlined titles
+        marker = lines[i][1]
+        if not titles or i + 1 == len(lines) or not lines[i + 1][1]:
+            if len(marker.strip()) < 4:
+                return self.text(lines, i, m, titles)
+            if not titles:
+                raise Unknown
+            return i + 1
+        (title, under) = (lines[i + 1], lines[i + 2][1] if i + 2 < len(lines) else None)
+        if under is None or not line_re.match(under) or under != marker or line_re.match(title[1]):
+            if len(marker) < 4:
+                return self.text(lines, i, m, titles)
+            raise Unknown
+        if column_width(title[1]) > len(marker) and len(marker) < 4:
+            return self.text(lines, i, m, titles)
+        self.section((marker[0], under[0]))
+        self.inline(title[1].strip(), title[0])
+        return i + 3
+
+    def section(self, style):
+        if style in self.styles:
+            level = self.styles.index(style) + 1
+        elif len(self.styles) == self.level:
+            self.styles.append(style)
+            level = len(self.styles)
+        else:
+            level = self.level + 2
+        if level > self.level + 1:
+            raise Unknown
+        self.level = level
+
+    def text(self, lines, i, m, titles):
+        (no, line) = lines[i]
+        if i + 1 < len(lines) and lines[i + 1][1]:
+            (next_no, next_line) = lines[i + 1]
+            if next_line[0] == " ":
+                # definition list item
+                (block, end) = indented(lines, i + 1)
+                self.inline(line, no)
+                self.body(block)
+                return end
+            if line_re.match(next_line) and not (column_width(line) > len(next_line)
+                                                 and len(next_line) < 4):
+                if not titles:
+                    raise Unknown
+                self.section(next_line[0])
+                self.inline(line, next_no)
+                return i + 2
+        return self.paragraph(lines, i)
+
+    def paragraph(self, lines, i):
+        end = i + 1
+        while end < len(lines) and lines[end][1] and lines[end][1][0] != " ":
+            end += 1
+        data = "\n".join(line for (no, line) in lines[i:end])
+        if not literal_end_re.search(data):
+            self.inline(data, lines[i][0])
+            return end
+        if len(data) > 2:
+            self.inline(data[:-3].rstrip() if data[-3] in " \n" else data[:-1], lines[i][0])
+        return self.literal_block(lines, end)
+
+    def literal_block(self, lines, i):
+        (block, end) = indented(lines, i)
+        if nonblank(block) or end == len(lines) or not quoted_re.match(lines[end][1]):
+            return end
+        # quoted, by the first character of the line
+        quote = lines[end][1][0]
+        while end < len(lines) and lines[end][1][:1] == quote:
+            end += 1
+        return end
+
+    ## explicit markup
+
+    def explicit_markup(self, lines, i, m, titles):
+        line = lines[i][1]
+        for (name, pattern) in constructs:
+            m = pattern.match(line)
+            if m:
+                end = getattr(self, name)(lines, i, m, titles)
+                if end is not None:
+                    return end
+                break
+        return self.comment(lines, i, m)
+
+    def comment(self, lines, i, m):
+        end = m.end() if m else 2
+        if not lines[i][1][end:].strip() and (i + 1 == len(lines) or not lines[i + 1][1]):
+            # empty comment, the indented lines after it are a block quote
+            return i + 1
+        return indented(lines, i, first_indent=end)[1]
+
+    def footnote(self, lines, i, m, titles):
+        name = normalize(m.group(1))
+        if name[0] == "#":
+            name = name[1:]
+        if name and name != "*":
+            self.target(name, None)
+        (block, end) = indented(lines, i, first_indent=m.end())
+        self.body(block)
+        return end
+
+    citation = footnote
+
+    def hyperlink_target(self, lines, i, m, titles):
+        # None if malformed, it is a comment then
+        (block, end) = indented(lines, i, first_indent=m.end(), until_blank=True,
+                                strip_indent=False)
+        block = [escape2null(line) for (no, line) in block]
+        escaped = block[0]
+        k = 0
+        while True:
+            tm = target_re.match(escaped)
+            if tm:
+                break
+            k += 1
+            if k == len(block):
+                return None
+            escaped += block[k]
+        del block[:k]
+        block[0] = (block[0] + " ")[tm.end() - len(escaped) - 1:].strip()
+        uri = self.target_uri(block) or self.internal(lines, end)
+        if tm.group("name") is None:
+            self.anonymous_targets.append(uri)
+        else:
+            self.target(normalize(tm.group("name")), uri and inliner.adjust_uri(uri))
+        return end
+
+    def internal(self, lines, i):
+        # None, for a target without uri at lines[i:]
+        while i < len(lines) and not lines[i][1]:
+            i += 1
+        if i < len(lines) and chain_re.match(lines[i][1]):
+            raise Unknown
+        if i == len(lines) and lines is not self.lines:
+            # the next element is after the one it is in
+            raise Unknown
+        return None
+
+    def target_uri(self, block):
+        # uri of a hyperlink target, "" for internal ones
+        if block and block[-1].strip()[-1:] == "_":
+            # indirect, to another target
+            raise Unknown
+        parts = split_escaped_whitespace(" ".join(block))
+        return " ".join("".join(unescape(part).split()) for part in parts)
+
+    def anonymous(self, lines, i, m, titles):
+        (block, end) = indented(lines, i, first_indent=m.end(), until_blank=True)
+        block = [escape2null(line) for (no, line) in block]
+        self.anonymous_targets.append(self.target_uri(block) or self.internal(lines, end))
+        return end
+
+    def substitution_def(self, lines, i, m, titles):
+        # replace::, unicode:: and date:: without links are left alone
+        (block, end) = indented(lines, i, first_indent=m.end())
+        text = " ".join(line.strip() for (no, line) in block)
+        d = re.search(r"\| +([\w.:+-]+) ?::( |$)", text)
+        if inline_re.search(text) or (d and d.group(1).lower() not in ("replace", "unicode", "date")):
+            raise Unknown
+        return end
+
+    def directive(self, lines, i, m, titles):
+        (block, end) = indented(lines, i, first_indent=m.end())
+        cls = directive_class(m.group(1))
+        if cls is None:
+            # an error, with nothing else
+            return end
+        kind = directive_kinds.get(cls)
+        if kind is None:
+            raise Unknown
+        if kind == "topic" and not titles:
+            # not allowed in body elements
+            self.opaque(block)
+            return end
+        try:
+            (arguments, options, content) = self.directive_block(block, cls)
+            if kind == "image" and options.get("align", "left") not in Image.align_h_values:
+                raise ValueError
+        except ValueError:
+            # an error instead of the directive
+            self.opaque(block)
+            return end
+        for (key, value) in options.items():
+            if key in name_options:
+                self.target(normalize(value), None)
+        if kind == "literal":
+            pass
+        elif kind in ("image", "figure"):
+            self.image(kind, lines[i][0], arguments, options, content)
+        else:
+            if inline_re.search(" ".join(arguments + [options.get("subtitle", "")])):
+                raise Unknown
+            if kind == "other":
+                self.opaque(content)
+            else:
+                self.body(content)
+        return end
+
+    def directive_block(self, block, cls):
+        # (arguments, options, content) the way parse_directive_block splits
+        # them, ValueError for errors
+        block = list(block)
+        if block and not block[0][1].strip():
+            del block[0]
+        while block and not block[-1][1].strip():
+            block.pop()
+        spec = cls.option_spec
+        has_arguments = cls.required_arguments or cls.optional_arguments
+        i = 0
+        if block and (has_arguments or spec):
+            while i < len(block) and block[i][1].strip():
+                i += 1
+            arg_block = block[:i]
+            content = block[i + 1:]
+        else:
+            arg_block = []
+            content = block
+        options = {}
+        if spec:
+            for (k, (no, line)) in enumerate(arg_block):
+                if field_re.match(line):
+                    options = self.directive_options(arg_block[k:], spec)
+                    arg_block = arg_block[:k]
+                    break
+        if arg_block and not has_arguments:
+            content = arg_block + block[i:]
+            arg_block = []
+        content = nonblank(content)
+        if content and not cls.has_content:
+            raise ValueError
+        arguments = []
+        if has_arguments:
+            text = "\n".join(line for (no, line) in arg_block)
+            arguments = text.split()
+            count = cls.required_arguments + cls.optional_arguments
+            if len(arguments) < cls.required_arguments:
+                raise ValueError
+            if len(arguments) > count:
+                if not cls.final_argument_whitespace:
+                    raise ValueError
+                arguments = text.split(None, count - 1)
+        return (arguments, options, content)
+
+    def directive_options(self, block, spec):
+        # a field list of options, checked like extract_extension_options
+        options = {}
+        k = 0
+        while k < len(block):
+            m = field_re.match(block[k][1])
+            if not m:
+                raise ValueError
+            name = m.group()[1:]
+            name = name[:name.rfind(":")].lower()
+            (body, k) = indented(block, k, first_indent=m.end())
+            body = nonblank(body)
+            if any(not line for (no, line) in body) or len(name.split()) != 1:
+                raise ValueError
+            value = "\n".join(line for (no, line) in body) or None
+            if value and re.search(r"[`*|\\]|_(?!\w)", value):
+                # inline markup, the option is the text of the paragraph
+                raise Unknown
+            if name in options or name not in spec:
+                raise ValueError
+            try:
+                options[name] = spec[name](value)
+            except TypeError:
+                raise ValueError
+        return options
+
+    def image(self, kind, line, arguments, options, content):
+        if "target" in options:
+            block = escape2null(options["target"]).splitlines()
+            self.refs.append((line, "uri", self.target_uri(block)))
+        self.refs.append((line, "uri", directives.uri(arguments[0])))
+        if kind == "image" or not content:
+            return
+        # a caption paragraph, else an error
+        if content[0][1][:1] == " " or any(p.match(content[0][1]) for (n, p) in body_patterns[:-1]) \
+                or (len(content) > 1 and content[1][1][:1] == " "):
+            self.opaque(content)
+            return
+        before = (len(self.refs), len(self.targets), self.duplicates)
+        self.body(content)
+        if (len(self.refs), len(self.targets), self.duplicates) != before:
+            # a target with the name of another one, or of a section title,
+            # gets a message before the caption and docutils 0.18 drops the
+            # caption then.  Titles have no names here, so leave references
+            # in captions to docutils.
+            raise Unknown
+
+    ## inline markup
+
+    def inline(self, text, line):
+        # Inliner.parse, references go to self.refs
+        if not inline_re.search(text):
+            return
+        remaining = escape2null(text)
+        unprocessed = []
+        while remaining:
+            m = inliner.patterns.initial.search(remaining)
+            if not m:
+                break
+            groups = m.groupdict()
+            start = groups["start"] or groups["backquote"] or groups["refend"] or groups["fnend"]
+            (before, found, remaining) = getattr(self, inline_dispatch[start])(m)
+            unprocessed.append(before)
+            if found is not None:
+                self.refs.extend((line, "uri", ref) for ref in self.implicit("".join(unprocessed)))
+                self.refs.extend((line, kind, value) for (kind, value) in found)
+                unprocessed = []
+        remaining = "".join(unprocessed) + remaining
+        self.refs.extend((line, "uri", ref) for ref in self.implicit(remaining))
+
+    def implicit(self, text):
+        # standalone uris, Inliner.implicit_inline
+        if "file:" not in text.lower():
+            # nothing local
+            return []
+        m = inliner.patterns.uri.search(text)
+        if not m:
+            return []
+        scheme = m.group("scheme")
+        if scheme and scheme.lower() not in urischemes.schemes:
+            # the rest is text
+            return []
+        uri = ("mailto:" if m.group("email") else "") + unescape(m.group("whole"))
+        return self.implicit(text[:m.start()]) + [uri] + self.implicit(text[m.end():])
+
+    def inline_obj(self, m, end_pattern):
+        # (before, text or None, remaining, end string)
+        string = m.string
+        start = m.start("start")
+        end = m.end("start")
+        if inliner.quoted_start(m):
+            return (string[:end], None, string[end:], "")
+        em = end_pattern.search(string[end:])
+        if em and em.start(1):
+            return (string[:start], string[end:end + em.start(1)],
+                    string[end + em.end(1):], em.group(1))
+        # problematic
+        return (string[:start], "", string[end:], "")
+
+    def markup(self, m):
+        # emphasis, strong and literals, without references
+        pattern = {"*": inliner.patterns.emphasis, "**": inliner.patterns.strong,
+                   "``": inliner.patterns.literal}[m.group("start")]
+        (before, text, remaining, end) = self.inline_obj(m, pattern)
+        return (before, None if text is None else [], remaining)
+
+    def inline_target(self, m):
+        (before, text, remaining, end) = self.inline_obj(m, inliner.patterns.target)
+        if text:
+            self.target(normalize(text), None)
+        return (before, None if text is None else [], remaining)
+
+    def substitution(self, m):
+        (before, text, remaining, end) = self.inline_obj(m, inliner.patterns.substitution_ref)
+        if text is None:
+            return (before, None, remaining)
+        if not text or end[-1:] != "_":
+            return (before, [], remaining)
+        if end[-2:] == "__":
+            return (before, [("anonymous", None)], remaining)
+        return (before, [("name", normalize(text))], remaining)
+
+    def interpreted(self, m):
+        string = m.string
+        start = m.start("backquote")
+        end = m.end("backquote")
+        rolestart = m.start("role")
+        role = m.group("role")
+        if role:
+            role = role[1:-1]
+        elif inliner.quoted_start(m):
+            return (string[:end], None, string[end:])
+        em = inliner.patterns.interpreted_or_phrase_ref.search(string[end:])
+        if not em or not em.start(1):
+            # problematic
+            return (string[:start], [], string[end:])
+        textend = end + em.end()
+        if em.group("role"):
+            if role:
+                return (string[:rolestart], [], string[textend:])
+            role = em.group("suffix")[1:-1]
+        escaped = em.string[:em.start(1)]
+        rawsource = unescape(string[start:textend], True)
+        if rawsource[-1:] == "_":
+            if role:
+                return (string[:rolestart], [], string[textend:])
+            return (string[:start], self.phrase_ref(rawsource, escaped), string[textend:])
+        if role and en.roles.get(role.lower(), role.lower()) not in plain_roles:
+            raise Unknown
+        return (string[:rolestart], [], string[textend:])
+
+    def phrase_ref(self, rawsource, escaped):
+        m = inliner.patterns.embedded_link.search(escaped)
+        uri = None
+        text = escaped
+        if m:
+            text = escaped[:m.start(0)]
+            alias = m.group(2)
+            if alias.endswith("_") and not (unescape(alias, True).endswith("\\_")
+                                            or inliner.patterns.uri.match(alias)):
+                # to another target
+                raise Unknown
+            parts = split_escaped_whitespace(alias)
+            uri = " ".join("".join(part.split()) for part in parts)
+            uri = inliner.adjust_uri(unescape(uri))
+            if uri.endswith("\\_"):
+                uri = uri[:-2] + "_"
+            if not text:
+                text = uri
+        if rawsource[-2:] == "__":
+            return [("uri", uri)] if uri else [("anonymous", None)]
+        if uri:
+            self.target(normalize(text), uri)
+            return [("uri", uri)]
+        return [("name", normalize(text))]
+
+    def reference(self, m):
+        string = m.string
+        kind = "anonymous" if m.group("refend") == "__" else "name"
+        return (string[:m.start("whole")], [(kind, normalize(m.group("refname")))],
+                string[m.end("whole"):])
+
+    def footnote_reference(self, m):
+        string = m.string
+        return (string[:m.start("whole")], [], string[m.end("whole"):])
+
+
+inline_dispatch = {
+    "*": "markup",
+    "**": "markup",
+    "``": "markup",
+    "_`": "inline_target",
+    "|": "substitution",
+    "`": "interpreted",
+    "_": "reference",
+    "__": "reference",
+    "]_": "footnote_reference",
+}
+
+
+def scan_refs(rst):
+    # [(line, target)] of the local references, like parse_refs,
+    # None if only docutils can tell
+    rst = re.sub("[\v\f]", " ", handle_spaces(rst))
+    lines = [(no + 1, line.expandtabs(8).rstrip()) for (no, line) in enumerate(rst.splitlines())]
+    scanner = RefScanner(lines)
+    try:
+        scanner.body(lines, True)
+    except Unknown:
+        return None
+    return [(line, ref.replace(rechar, " ")) for (line, ref) in scanner.result()]
+
+
+def find_refs(rst):
+    # [(line, target)] of the local references, parsed if scanning fails
+    refs = scan_refs(rst)
+    if refs is None:
+        refs = [(line, ref) for (line, ref) in parse_refs(rst) if local(ref)]
+    return refs
+
+
+## link graph
+#
+# Links by source and by target, both with the line of the link in the
+# source.  Paths are relative to the notes directory, files outside of it
+# are absolute.  Used by check.py and for the backlinks of the editor,
+# exported as json for other tools.
+
+class LinkGraph():
+
+    def __init__(self):
+        # source -> [(line, target)] in document order
+        self.forward = {}
+        # target -> {(source, line)}
+        self.backward = {}
+
+    def add(self, source, line, target):
+        self.forward.setdefault(source, []).append((line, target))
+        self.backward.setdefault(target, set()).add((source, line))
+
+    def set_links(self, source, links):
+        # replaces the links of source, links: [(line, target)]
+        self.remove(source)
+        for (line, target) in links:
+            self.add(source, line, target)
+
+    def remove(self, source):
+        for (line, target) in self.forward.pop(source, []):
+            back = self.backward[target]
+            back.discard((source, line))
+            if not back:
+                del self.backward[target]
+
+    def __len__(self):
+        return sum(len(links) for links in self.forward.values())
+
+    def links(self, source):
+        return list(self.forward.get(source, []))
+
+    def backlinks(self, target):
+        # [(source, line)], sorted, line is None if unknown
+        return sorted(self.backward.get(target, ()), key=lambda b: (b[0], b[1] or 0))
+
+    def linked(self, target):
+        return target in self.backward
+
+    def unlinked(self, paths):
+        # paths nothing links to, in the given order
+        return [p for p in paths if p not in self.backward]
+
+    def to_json(self):
+        return {
+            "links": dict((s, [list(l) for l in links])
+                          for (s, links) in sorted(self.forward.items())),
+            "backlinks": dict((t, [list(b) for b in self.backlinks(t)])
+                              for t in sorted(self.backward)),
+        }
+
+    def dump(self, f):
+        json.dump(self.to_json(), f, sort_keys=True)
+        f.write("\n")
+
+    @classmethod
+    def from_json(cls, data):
+        graph = cls()
+        for (source, links) in data["links"].items():
+            for (line, target) in links:
+                graph.add(source, line, target)
+        return graph
+
+
+## centrality
+#
+# PageRank over the links between notes: a note linked from many notes, or
+# from notes which are linked a lot themselves, ranks higher.  Notes without
+# outgoing links spread their rank evenly.
+
+def pagerank(n, edges, damping=0.85, iterations=100, tol=1e-9):
+    # n nodes, edges: (source, target) node numbers, returns [score]
+    # scores sum up to 1
+    edges = set((s, t) for (s, t) in edges if s != t)
+    if not n:
+        return []
+    if numpy is not None:
+        return pagerank_numpy(n, edges, damping, iterations, tol)
+
+    out = [0] * n
+    for (s, t) in edges:
+        out[s] += 1
+    rank = [1 / n] * n
+    for i in range(iterations):
+        new = [0.0] * n
+        for (s, t) in edges:
+            new[t] += rank[s] / out[s]
+        dangling = sum(r for (r, o) in zip(rank, out) if not o)
+        base = (1 - damping) / n + damping * dangling / n
+        new = [base + damping * r for r in new]
+        delta = sum(abs(a - b) for (a, b) in zip(new, rank))
+        rank = new
+        if delta < tol:
+            break
+    return rank
+
+
+def pagerank_numpy(n, edges, damping, iterations, tol):
+    # same as pagerank, one iteration is two bincounts
+    if edges:
+        (src, dst) = numpy.array(sorted(edges), dtype=numpy.intp).T
+    else:
+        src = dst = numpy.zeros(0, dtype=numpy.intp)
+    out = numpy.bincount(src, minlength=n).astype(float)
+    dangling = out == 0
+    # share of the rank passed along each edge
+    weight = 1 / out[src]
+    rank = numpy.full(n, 1 / n)
+    for i in range(iterations):
+        new = numpy.bincount(dst, weights=rank[src] * weight, minlength=n)
+        base = (1 - damping) / n + damping * rank[dangling].sum() / n
+        new = base + damping * new
+        delta = numpy.abs(new - rank).sum()
+        rank = new
+        if delta < tol:
+            break
+    return rank.tolist()
+
+
+def centrality(links):
+    # links: [(source path, target path)], returns path -> score
+    # scaled so that the average note scores 1
+    nodes = {}
+    for (s, t) in links:
+        nodes.setdefault(s, len(nodes))
+        nodes.setdefault(t, len(nodes))
+    edges = [(nodes[s], nodes[t]) for (s, t) in links]
+    rank = pagerank(len(nodes), edges)
+    return dict((path, rank[i] * len(nodes)) for (path, i) in nodes.items())
+
+
+class Tests(unittest.TestCase):
+
+    def test_refs(self):
+        rst = ("Title\n=====\n\n`b <sub/b.rst>`_ and `web <http://x.org>`_\n\n"
+               ".. image:: img/a b.png\n\n"
+               "see `c`_\n\n.. _c: /c.rst#part\n\n"
+               "`up <../../outside.rst>`_ `mail <mailto:a@b.c>`_ `f <file://d.rst>`_\n")
+        links = note_links("notes/a.rst", rst, "/root")
+        self.assertEqual([t for (line, t) in links],
+                         ["notes/sub/b.rst", "notes/img/ab.png", "c.rst", "d.rst"])
+        self.assertEqual(links[0][0], 4)
+        self.assertEqual(links[3][0], 12)
+
+    def test_scan(self):
+        demo = os.path.join(os.path.dirname(os.path.abspath(__file__)), "demo")
+        scanned = 0
+        for (dirpath, dirnames, filenames) in os.walk(demo):
+            for name in filenames:
+                if not name.endswith(".rst"):
+                    continue
+                with open(os.path.join(dirpath, name)) as f:
+                    rst = f.read()
+                refs = scan_refs(rst)
+                if refs is None:
+                    continue
+                scanned += 1
+                parsed = [(line, ref) for (line, ref) in parse_refs(rst) if local(ref)]
+                self.assertEqual([ref for (line, ref) in refs], [ref for (line, ref) in parsed], name)
+                # docutils has no line for images
+                for ((line, ref), (pline, pref)) in zip(refs, parsed):
+                    if pline is not None:
+                        self.assertEqual(line, pline, name)
+        self.assertGreater(scanned, 3)
+
+    def test_scan_cases(self):
+        cases = [
+            ("`a <a.rst>`_ `w <http://x.org>`_ `b`_ `c`_\n\n.. _b: b.rst\n", [(1, "a.rst"), (1, "b.rst")]),
+            # anonymous references only resolve if the numbers match
+            ("`a`__\n\n__ x.rst\n", [(1, "x.rst")]),
+            ("`a`__ `b`__\n\n__ x.rst\n", []),
+            # duplicate targets
+            ("`a`_\n\n.. _a: x.rst\n.. _a: y.rst\n", []),
+            ("`a`_\n\n.. _a: x.rst\n.. _a: x.rst\n", [(1, "x.rst")]),
+            (":code:`x.rst` `y <y.rst>`_\n", [(1, "y.rst")]),
+            ("code::\n\n    `x <x.rst>`_\n\n`y <y.rst>`_\n", [(5, "y.rst")]),
+            ("Title\n=====\n\n- item `x <x y.rst>`_\n", [(4, "x y.rst")]),
+            ("see file:///tmp/x.rst here\n", [(1, "file:///tmp/x.rst")]),
+            ("text\n\n.. image:: a b.png\n   :target: b.rst\n", [(3, "b.rst"), (3, "ab.png")]),
+            ("C\n---\n\n.. figure:: x.png\n\n   caption\n", [(4, "x.png")]),
+        ]
+        for (rst, refs) in cases:
+            self.assertEqual(scan_refs(rst), refs, rst)
+            self.assertEqual(sorted(ref for (line, ref) in find_refs(rst)),
+                             sorted(ref for (line, ref) in parse_refs(rst) if local(ref)), rst)
+        # left to docutils
+        for rst in (":doc:`x`\n", "`a`_\n\n.. _a:\n.. _b: x.rst\n", "`a`_\n\n.. _a: b_\n",
+                    "+---+\n| `x <x.rst>`_ |\n+---+\n", ".. include:: x.rst\n"):
+            self.assertIsNone(scan_refs(rst), rst)
+        self.assertEqual(find_refs("`a`_\n\n.. _a:\n.. _b: x.rst\n"), [(1, "x.rst")])
+        # the implicit name of the title makes docutils drop the caption
+        rst = "C\n---\n\n.. figure:: x.png\n\n   caption `c <m.rst>`_\n"
+        self.assertIsNone(scan_refs(rst))
+        self.assertEqual(find_refs(rst), [ref for ref in parse_refs(rst) if local(ref[1])])
+
+    def test_resolve(self):
+        self.assertEqual(resolve("b.rst", "", "/r"), "b.rst")
+        self.assertEqual(resolve("../b.rst", "x/y", "/r"), os.path.join("x", "b.rst"))
+        self.assertEqual(resolve("file:///r/b.rst", "x", "/r"), "b.rst")
+        self.assertIsNone(resolve("file:///elsewhere/b.rst", "", "/r"))
+        self.assertIsNone(resolve("https://x.org/a.rst", "", "/r"))
+        self.assertIsNone(resolve("#top", "", "/r"))
+
+    def check_rank(self, rank):
+        self.assertAlmostEqual(sum(rank), 1)
+        # 2 is linked from everywhere, 3 from nowhere
+        self.assertEqual(max(range(4), key=lambda i: rank[i]), 2)
+        self.assertEqual(min(range(4), key=lambda i: rank[i]), 3)
+
+    def test_pagerank(self):
+        global numpy
+        edges = [(0, 2), (1, 2), (3, 2), (2, 0), (0, 1), (1, 1)]
+        numpy_ = numpy
+        numpy = None
+        try:
+            plain = pagerank(4, edges)
+        finally:
+            numpy = numpy_
+        self.check_rank(plain)
+        # dangling nodes only
+        self.assertEqual(pagerank(2, []), [0.5, 0.5])
+        if numpy is None:
+            self.skipTest("numpy not installed")
+        vec = pagerank(4, edges)
+        for (a, b) in zip(plain, vec):
+            self.assertAlmostEqual(a, b)
+
+    def test_graph(self):
+        graph = LinkGraph()
+        graph.set_links("a.rst", [(3, "b.rst"), (5, "img.png"), (9, "b.rst")])
+        graph.set_links("c.rst", [(1, "b.rst"), (None, "img.png")])
+        self.assertEqual(len(graph), 5)
+        self.assertEqual(graph.backlinks("img.png"), [("a.rst", 5), ("c.rst", None)])
+        self.assertEqual(graph.backlinks("b.rst"), [("a.rst", 3), ("a.rst", 9), ("c.rst", 1)])
+        self.assertEqual(graph.unlinked(["a.rst", "b.rst", "c.rst", "img.png"]), ["a.rst", "c.rst"])
+        graph.set_links("a.rst", [(4, "c.rst")])
+        self.assertTrue(graph.linked("img.png"))
+        self.assertEqual(graph.backlinks("b.rst"), [("c.rst", 1)])
+        data = json.loads(json.dumps(graph.to_json()))
+        self.assertEqual(data["backlinks"]["c.rst"], [["a.rst", 4]])
+        copy = LinkGraph.from_json(data)
+        self.assertEqual(copy.forward, graph.forward)
+        self.assertEqual(copy.backward, graph.backward)
+        graph.remove("a.rst")
+        graph.remove("c.rst")
+        self.assertEqual((graph.forward, graph.backward), ({}, {}))
+
+    def test_centrality(self):
+        scores = centrality([("a.rst", "index.rst"), ("b.rst", "index.rst"), ("index.rst", "a.rst")])
+        self.assertAlmostEqual(sum(scores.values()), 3)
+        self.assertGreater(scores["index.rst"], scores["a.rst"])
+        self.assertGreater(scores["a.rst"], scores["b.rst"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+
+# Copyright 2016-2019 Thomas Krug
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import random
+import re
+import unittest
+
+
+## spaces in links
+#
+# docutils: imho a bug
+# `text <some file.rst>`_ drops the space from the target, so spaces in
+# targets are replaced by rechar before parsing and restored when the uri
+# is resolved.
+#
+# Starting at a backtick everything up to the next "<" belongs to the text,
+# everything after it up to the next backtick to the target.  Only lines
+# which look like a link (`...<... ...>`_) are touched.
+
+rechar = u"\u02FD"
+
+target_re = re.compile(r"`[^<]*<[^`]*`?")
+
+# str.splitlines splits at these as well
+linebreaks = "\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029"
+
+
+def is_link(line):
+    # same as re.search("`.*<.* .*>`_", line), without backtracking
+    i = line.find("`")
+    if i < 0:
+        return False
+    i = line.find("<", i + 1)
+    if i < 0:
+        return False
+    i = line.find(" ", i + 1)
+    if i < 0:
+        return False
+    return line.find(">`_", i + 1) >= 0
+
+
+def replace_target(mat):
+    text = mat.group(0)
+    i = text.index("<")
+    return text[:i] + text[i:].replace(" ", rechar)
+
+
+def handle_line(line):
+    if not is_link(line):
+        return line
+    return target_re.sub(replace_target, line)
+
+
+def normalize(rstin):
+    # lines end with \n, as str.splitlines and join would do
+    for c in linebreaks:
+        if c in rstin:
+            break
+    else:
+        if not rstin or rstin.endswith("\n"):
+            return rstin
+    lines = rstin.splitlines()
+    if not lines:
+        return ""
+    return "\n".join(lines) + "\n"
+
+
+def handle_text(rst):
+    # rst is normalized, the result has the same length
+    # links always contain >`_, so only those lines are looked at
+    out = []
+    pos = 0
+    i = rst.find(">`_")
+    while i >= 0:
+        start = rst.rfind("\n", 0, i) + 1
+        end = rst.find("\n", i)
+        if end < 0:
+            end = len(rst)
+        out.append(rst[pos:start])
+        out.append(handle_line(rst[start:end]))
+        pos = end
+        i = rst.find(">`_", end)
+    out.append(rst[pos:])
+    return "".join(out)
+
+
+def handle_spaces(rstin):
+    return handle_text(normalize(rstin))
+
+
+## incremental
+
+step = 4096
+
+
+def common_prefix(a, b):
+    # compared in chunks, slicing and comparing is done in C
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i:i+step] == b[i:i+step]:
+        i += step
+    if i >= n:
+        return n
+    lo = i
+    hi = min(i + step, n)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[i:mid] == b[i:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def common_suffix(a, b, n):
+    # at most n characters
+    la = len(a)
+    lb = len(b)
+    i = 0
+    while i < n:
+        k = min(i + step, n)
+        if a[la-k:la-i] != b[lb-k:lb-i]:
+            break
+        i = k
+    if i >= n:
+        return n
+    lo = i
+    hi = k
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[la-mid:la-i] == b[lb-mid:lb-i]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+class Preprocessor():
+    # handle_spaces for a buffer which changes a few lines at a time,
+    # only lines between the unchanged head and tail are handled again
+
+    def __init__(self):
+        self.src = ""
+        self.out = ""
+
+    def __call__(self, rstin):
+        rst = normalize(rstin)
+        old = self.src
+
+        # first changed line
+        p = common_prefix(old, rst)
+        p = rst.rfind("\n", 0, p) + 1
+        # unchanged lines at the end, the line break in front has to be
+        # unchanged as well
+        s = common_suffix(old, rst, min(len(old), len(rst)) - p)
+        i = rst.find("\n", len(rst) - s)
+        if i < 0 or s == 0:
+            i = len(rst)
+        else:
+            i += 1
+        j = len(old) - (len(rst) - i)
+
+        self.out = self.out[:p] + handle_text(rst[p:i]) + self.out[j:]
+        self.src = rst
+        return self.out
+
+
+def handle_spaces_(rstin):
+    # previous implementation, reference for the tests
+    rstout = ""
+    reg = re.compile("`.*<.* .*>`_")
+    for line in rstin.splitlines():
+        mat = reg.search(line)
+        if mat:
+            state = 0
+            tl = ""
+            for (i, c) in enumerate(line):
+                if state == 0 and c == '`':
+                    state = 1
+                if state == 1 and c == '<':
+                    state = 2
+                if state == 2 and c == '`':
+                    state = 0
+                if state == 2 and c == ' ':
+                    c = rechar
+                tl += c
+            line = tl
+        rstout += line + "\n"
+    return rstout
+
+
+class Tests(unittest.TestCase):
+
+    samples = [
+        "",
+        "\n",
+        "text\n",
+        "no newline at the end",
+        "`link <file.rst>`_\n",
+        "`link <some file.rst>`_\n",
+        "see `some link <dir/some file.rst>`_ and `other <a b.png>`_ here\n",
+        "`text with spaces <no spaces.rst>`_ `second one <with space.rst>`_\n",
+        "`unclosed <some file.rst\n",
+        "`a` b `c <d e>`_\n",
+        "`a <b c> d`_ trailing text\n",
+        "``literal`` <a b>`_\n",
+        "`x` < y z >`_ `q\n",
+        "`a <b c>`__\n",
+        "<a b>`_ `c\n",
+        ".. image:: some image.png\n",
+        "`link <file.rst>`_ no space in target\n",
+        "first\r\nsecond `x <y z>`_\r\n",
+        "tab\tand `x\t<y z>`_\n",
+        "`a <b c>`_\n\n`d <e f>`_\n\n\n",
+        "äöü `ü <ä ö>`_\n",
+    ]
+
+    def test_samples(self):
+        for rst in self.samples:
+            self.assertEqual(handle_spaces_(rst), handle_spaces(rst), repr(rst))
+
+    def test_combined(self):
+        rst = "".join(self.samples)
+        self.assertEqual(handle_spaces_(rst), handle_spaces(rst))
+
+    def test_random(self):
+        rnd = random.Random(0)
+        chars = "`<> _ab"
+        for i in range(2000):
+            rst = "".join(rnd.choice(chars) for j in range(rnd.randint(0, 30)))
+            self.assertEqual(handle_spaces_(rst), handle_spaces(rst), repr(rst))
+
+    def test_incremental(self):
+        rnd = random.Random(1)
+        lines = [rnd.choice(self.samples).rstrip("\n") for i in range(50)]
+        prep = Preprocessor()
+        for i in range(200):
+            pos = rnd.randint(0, len(lines))
+            op = rnd.randint(0, 2)
+            if op == 0:
+                lines.insert(pos, rnd.choice(self.samples).rstrip("\n"))
+            elif op == 1 and pos < len(lines):
+                del lines[pos]
+            elif pos < len(lines):
+                lines[pos] = lines[pos] + " `x <y z>`_"
+            rst = "\n".join(lines) + "\n"
+            self.assertEqual(handle_spaces_(rst), prep(rst))
+
+    def test_incremental_chars(self):
+        global step
+        rnd = random.Random(2)
+        chars = "`<> _a\n"
+        step_ = step
+        # small chunks to get edits across chunk borders
+        step = 3
+        try:
+            for i in range(100):
+                prep = Preprocessor()
+                rst = "".join(rnd.choice(chars) for j in range(rnd.randint(0, 80)))
+                for j in range(20):
+                    pos = rnd.randint(0, len(rst))
+                    if rnd.randint(0, 1):
+                        new = "".join(rnd.choice(chars) for k in range(rnd.randint(1, 5)))
+                        rst = rst[:pos] + new + rst[pos:]
+                    else:
+                        rst = rst[:pos] + rst[pos+rnd.randint(1, 5):]
+                    self.assertEqual(handle_spaces_(rst), prep(rst), repr(rst))
+        finally:
+            step = step_
+
+
+if __name__ == "__main__":
+    unittest.main()
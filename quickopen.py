@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+# Copyright 2016-2019 Thomas Krug
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import array
+import heapq
+import itertools
+import time
+import unittest
+
+
+## quick open
+#
+# Paths below the notes directory by trigrams of their lowercase text, for
+# completing the location bar.  Every word of the query is cut into
+# trigrams, a path matches if it has all of them, or all but a few if there
+# are not enough such paths (typos).  Words shorter than three characters
+# have to be contained as they are, a query of such words only finds paths
+# with a file or directory name starting with the first one.
+#
+# Paths with all trigrams are among those of the rarest one.  A path
+# missing at most e of them has one of any e + 1, so only the paths of the
+# e + 1 rarest trigrams are looked at.  Broad queries ("a", "rst") stop
+# after the first matches, typing more narrows them down.  Removed paths
+# stay in the lists until there are as many of them as paths.
+
+# matches scored at most
+limit = 2000
+
+
+def trigrams(text):
+    return set(text[i:i+3] for i in range(len(text) - 2))
+
+
+def keys(low):
+    # trigrams and first characters of the names, low starts with "/"
+    res = trigrams(low)
+    i = low.find("/")
+    while 0 <= i < len(low) - 1:
+        res.add(low[i:i+2])
+        i = low.find("/", i + 1)
+    return res
+
+
+class PathIndex():
+
+    def __init__(self):
+        # id -> path and lowercase path with a leading "/", None if removed
+        self.paths = []
+        self.lows = []
+        # path -> id
+        self.ids = {}
+        # trigram -> ids, ascending
+        self.grams = {}
+        self.removed = 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, path):
+        if path in self.ids:
+            return
+        pid = len(self.paths)
+        self.paths.append(path)
+        self.lows.append("/" + path.lower())
+        self.ids[path] = pid
+        for g in keys(self.lows[pid]):
+            try:
+                self.grams[g].append(pid)
+            except KeyError:
+                self.grams[g] = array.array("I", [pid])
+
+    def remove(self, path):
+        pid = self.ids.pop(path, None)
+        if pid is None:
+            return
+        self.paths[pid] = None
+        self.lows[pid] = None
+        self.removed += 1
+        if self.removed > 1000 and self.removed > len(self.ids):
+            self.rebuild()
+
+    def rebuild(self):
+        paths = list(self.ids)
+        self.paths = []
+        self.lows = []
+        self.ids = {}
+        self.grams = {}
+        self.removed = 0
+        for path in paths:
+            self.add(path)
+
+    def match(self, ids, words, grams, misses, res):
+        # adds pid -> score of the matching ids to res
+        short = [w for w in words if len(w) < 3]
+        whole = " ".join(words)
+        need = len(grams) - misses
+        count = 0
+        for pid in ids:
+            low = self.lows[pid]
+            if low is None or pid in res:
+                continue
+            if any(w not in low for w in short):
+                continue
+            hits = sum(1 for g in grams if g in low)
+            if hits < need:
+                continue
+            name = low[low.rfind("/")+1:]
+            score = hits - len(grams)
+            if whole in low:
+                score += 2
+            # words in the file name count more than in the directories
+            score += sum(1 for w in words if w in name)
+            if name.startswith(words[0]):
+                score += 1
+            if low.endswith(".rst"):
+                score += 0.5
+            res[pid] = score
+            count += 1
+            if count >= limit:
+                break
+
+    def search(self, query, k=20):
+        # best k paths, best first
+        words = query.lower().split()
+        if not words:
+            return []
+        grams = set()
+        for w in words:
+            grams |= trigrams(w)
+        if grams:
+            lists = sorted((self.grams.get(g, ()) for g in grams), key=len)
+        else:
+            lists = [self.grams.get("/" + words[0][:2], ())]
+
+        res = {}
+        self.match(lists[0], words, grams, 0, res)
+        # a typo costs up to four trigrams
+        misses = len(grams) // 2
+        if len(res) < k and misses:
+            ids = itertools.chain.from_iterable(lists[:misses+1])
+            self.match(ids, words, grams, misses, res)
+
+        # shorter paths first, then by name
+        best = heapq.nsmallest(k, ((-score, len(self.paths[pid]), self.paths[pid])
+                                   for (pid, score) in res.items()))
+        return [path for (s, n, path) in best]
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.index = PathIndex()
+        for path in ("index.rst", "projects/labnote/index.rst", "projects/labnote/notes.rst",
+                     "projects/labnote/img/screenshot.png", "meetings/2019-05-03.rst",
+                     "recipes/pizza.rst", "recipes/img/pizza.jpg"):
+            self.index.add(path)
+
+    def test_search(self):
+        self.assertEqual(self.index.search("pizza"), ["recipes/pizza.rst", "recipes/img/pizza.jpg"])
+        self.assertEqual(self.index.search("labnote ind")[0], "projects/labnote/index.rst")
+        self.assertEqual(self.index.search("index")[0], "index.rst")
+        # typo
+        self.assertEqual(self.index.search("screenhsot"), ["projects/labnote/img/screenshot.png"])
+        self.assertEqual(self.index.search("2019 05"), ["meetings/2019-05-03.rst"])
+        self.assertEqual(self.index.search("zzzz"), [])
+        self.assertEqual(self.index.search(""), [])
+        self.assertEqual(self.index.search("s"), ["projects/labnote/img/screenshot.png"])
+        self.assertEqual(len(self.index.search("p", k=3)), 3)
+
+    def test_update(self):
+        self.index.remove("recipes/pizza.rst")
+        self.index.add("recipes/pizza.rst")
+        self.index.add("recipes/pizza.rst")
+        self.assertEqual(len(self.index), 7)
+        self.index.remove("recipes/img/pizza.jpg")
+        self.assertEqual(self.index.search("pizza"), ["recipes/pizza.rst"])
+        self.index.rebuild()
+        self.assertEqual(self.index.search("pizza"), ["recipes/pizza.rst"])
+        self.assertEqual(len(self.index.paths), 6)
+
+    def test_large(self):
+        # completions while typing, 100k paths
+        index = PathIndex()
+        for i in range(100000):
+            index.add("area{}/topic{}/note{}.rst".format(i % 20, i % 700, i))
+        index.add("area3/topic5/labnote setup.rst")
+        for query in ("l", "labnote", "labnote setup", "labnoet", "note123", "topic5 setup", "rst"):
+            start = time.perf_counter()
+            res = index.search(query)
+            delta = time.perf_counter() - start
+            self.assertTrue(res, query)
+            self.assertLess(delta, 0.1, query)
+        self.assertEqual(index.search("labnote setup")[0], "area3/topic5/labnote setup.rst")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+
+# Copyright 2016-2019 Thomas Krug
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+
+## file registry
+#
+# Files below the notes directory with mtime, size and content hash.  The
+# tree is walked once, afterwards the editor keeps the registry current from
+# file monitor events (see FileWatcher in labnote.py), so searching and
+# checking links do not walk the tree again.  Hashes are computed when they
+# are asked for and kept until the file changes.
+
+# version control and the search index
+ignored_dirs = (".git", ".labnote")
+
+
+def is_ignored(path):
+    # path relative to the root
+    parts = path.split(os.sep)
+    return any(part in ignored_dirs for part in parts) or parts[0] == ".."
+
+
+class Registry():
+
+    def __init__(self, root):
+        # root is an abs path
+        self.root = root
+        # relative path -> [mtime_ns, size, sha1 or None]
+        self.files = {}
+        # relative paths of the directories, "" is the root
+        self.dirs = set()
+        self.lock = threading.Lock()
+        # set when the first walk is done
+        self.scanned = False
+
+    def scan(self, sub=""):
+        # walks the tree below sub, returns the files found
+        found = []
+        for parent, dirs, files in os.walk(os.path.join(self.root, sub)):
+            dirs[:] = [d for d in dirs if d not in ignored_dirs]
+            rel = os.path.relpath(parent, self.root)
+            rel = "" if rel == "." else rel
+            entries = {}
+            for f in files:
+                try:
+                    st = os.stat(os.path.join(parent, f))
+                except OSError:
+                    continue
+                entries[os.path.join(rel, f)] = [st.st_mtime_ns, st.st_size, None]
+            with self.lock:
+                self.dirs.add(rel)
+                self.files.update(entries)
+            found.extend(entries)
+        self.scanned = True
+        return found
+
+    def relative(self, path):
+        # None for paths outside of the root
+        if os.path.isabs(path):
+            path = os.path.relpath(path, self.root)
+        path = os.path.normpath(path)
+        if path == ".":
+            return ""
+        if is_ignored(path):
+            return None
+        return path
+
+    def update(self, path):
+        # after a change of path (file or directory), returns changed files
+        rel = self.relative(path)
+        if rel is None:
+            return []
+        fp = os.path.join(self.root, rel)
+        if os.path.isdir(fp):
+            with self.lock:
+                known = rel in self.dirs
+            if known:
+                return []
+            return self.scan(rel)
+
+        try:
+            st = os.stat(fp)
+        except OSError:
+            return self.remove(rel)
+        with self.lock:
+            entry = self.files.get(rel)
+            if entry and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+                return []
+            self.files[rel] = [st.st_mtime_ns, st.st_size, None]
+        return [rel]
+
+    def remove(self, rel):
+        # file or directory, returns removed files
+        prefix = rel + os.sep
+        with self.lock:
+            gone = [p for p in self.files if p == rel or p.startswith(prefix)]
+            for p in gone:
+                del self.files[p]
+            self.dirs = set(d for d in self.dirs if d != rel and not d.startswith(prefix))
+        return gone
+
+    def stat(self, path):
+        # (mtime_ns, size) or None
+        rel = self.relative(path)
+        with self.lock:
+            entry = self.files.get(rel)
+        return tuple(entry[:2]) if entry else None
+
+    def exists(self, path):
+        rel = self.relative(path)
+        if rel is None or not self.scanned:
+            return os.path.exists(os.path.join(self.root, path))
+        with self.lock:
+            return rel in self.files or rel in self.dirs
+
+    def hash(self, path):
+        # sha1 of the content, None if path is unknown
+        rel = self.relative(path)
+        with self.lock:
+            entry = self.files.get(rel)
+            if not entry:
+                return None
+            if entry[2]:
+                return entry[2]
+        h = hashlib.sha1()
+        try:
+            with open(os.path.join(self.root, rel), "rb") as f:
+                for block in iter(lambda: f.read(1 << 16), b""):
+                    h.update(block)
+        except OSError:
+            return None
+        with self.lock:
+            # only if it did not change meanwhile
+            if self.files.get(rel) is entry:
+                entry[2] = h.hexdigest()
+        return h.hexdigest()
+
+    def paths(self, suffix=""):
+        # sorted relative paths
+        with self.lock:
+            return sorted(p for p in self.files if p.endswith(suffix))
+
+    def stats(self, suffix=""):
+        # relative path -> (mtime_ns, size)
+        with self.lock:
+            return dict((p, tuple(e[:2])) for (p, e) in self.files.items() if p.endswith(suffix))
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.write("a.rst", "a")
+        self.write("sub/b.rst", "b")
+        self.write("sub/img.png", "png")
+        self.write(".git/config", "")
+        self.write(".labnote/index.sqlite", "")
+        self.reg = Registry(self.root)
+        self.reg.scan()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self, path, text):
+        fp = os.path.join(self.root, path)
+        os.makedirs(os.path.dirname(fp), exist_ok=True)
+        with open(fp, "w") as f:
+            f.write(text)
+
+    def test_scan(self):
+        self.assertEqual(self.reg.paths(), ["a.rst", "sub/b.rst", "sub/img.png"])
+        self.assertEqual(self.reg.paths(".rst"), ["a.rst", "sub/b.rst"])
+        self.assertEqual(self.reg.dirs, set(["", "sub"]))
+        self.assertTrue(self.reg.exists("sub"))
+        self.assertTrue(self.reg.exists(os.path.join(self.root, "sub/img.png")))
+        self.assertFalse(self.reg.exists("c.rst"))
+        self.assertEqual(self.reg.stat("a.rst")[1], 1)
+
+    def test_update(self):
+        self.assertEqual(self.reg.update("a.rst"), [])
+        self.write("a.rst", "changed")
+        self.assertEqual(self.reg.update(os.path.join(self.root, "a.rst")), ["a.rst"])
+        self.write("new/c.rst", "c")
+        self.assertEqual(self.reg.update("new"), ["new/c.rst"])
+        self.assertIn("new", self.reg.dirs)
+        self.assertEqual(self.reg.update(".git/config"), [])
+
+    def test_remove(self):
+        shutil.rmtree(os.path.join(self.root, "sub"))
+        self.assertEqual(sorted(self.reg.update("sub")), ["sub/b.rst", "sub/img.png"])
+        self.assertEqual(self.reg.dirs, set([""]))
+        os.remove(os.path.join(self.root, "a.rst"))
+        self.assertEqual(self.reg.update("a.rst"), ["a.rst"])
+        self.assertEqual(self.reg.paths(), [])
+
+    def test_hash(self):
+        h = self.reg.hash("a.rst")
+        self.assertEqual(h, hashlib.sha1(b"a").hexdigest())
+        self.write("a.rst", "bb")
+        self.reg.update("a.rst")
+        self.assertEqual(self.reg.hash("a.rst"), hashlib.sha1(b"bb").hexdigest())
+        self.assertIsNone(self.reg.hash("missing.rst"))
+
+
+if __name__ == "__main__":
+    unittest.main()
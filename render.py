@@ -0,0 +1,1098 @@
+#!/usr/bin/env python3
+
+# Copyright 2016-2019 Thomas Krug
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import bisect
+import collections
+import hashlib
+import logging
+import os
+import re
+import time
+
+import docutils
+import docutils.core
+import docutils.io
+import docutils.nodes
+import docutils.readers.doctree
+import docutils.utils
+import docutils.writers.html4css1
+
+from preprocess import Preprocessor
+from stats import Stats
+
+log = logging.getLogger(__name__)
+
+
+## incremental rendering
+#
+# The buffer is split into top-level blocks (a line in column 0 following a
+# blank line starts a new block).  Blocks which can be parsed on their own
+# without changing the result ("local" blocks, e.g. plain paragraphs, images,
+# code) are parsed separately and cached by content hash.  Everything else
+# (section titles, targets, footnotes, substitutions, tables, ...) goes into
+# a "skeleton" document, in which every local block is replaced by a
+# placeholder paragraph.  The skeleton is parsed once and only again if one
+# of its blocks changes.  For every render the skeleton is copied and the
+# placeholders are swapped for the cached block doctrees.
+#
+# Document-global constructs (roles, classes, includes, ...) or any doubt
+# about the assembled tree fall back to a full parse.
+
+# affect parsing of following blocks
+global_directive = re.compile(r"^ *\.\. +(role|default-role|class|include|target-notes)::", re.M)
+
+# anonymous targets and references are matched by order over the document
+global_anonymous = re.compile(r"(^ *\.\. +__:|^ *__( |$)|\w__\b|[^>]`__)", re.M)
+
+local_directive = re.compile(r"\.\. +(image|figure|code|code-block|sourcecode|math|raw|"
+                             r"parsed-literal|csv-table|list-table|container|compound|"
+                             r"rubric|attention|caution|danger|error|hint|important|"
+                             r"note|tip|warning|admonition)::")
+
+list_start = re.compile(r"([-*+•‣⁃]|\(?(\d+|#|[a-zA-Z]|[ivxlcdmIVXLCDM]+)[.)])( |$)")
+
+# explicit markup, line blocks, field lists, literal, doctest, anonymous
+# targets, grid tables, option lists
+markup_start = re.compile(r"(\.\.( |$)|\||:|>>>|__( |$)|\+[-=]|--?\w|/\w)")
+
+# line blocks, field lists, option lists
+list_like = re.compile(r"(\||:|--?\w|/\w)")
+
+# section title adornment, transition or table border
+adornment = re.compile(r"([!-/:-@\[-`{-~])\1+ *$")
+
+# placeholders are never nested, so they have to show up as direct
+# children of the document or a section, the nonce of the renderer keeps
+# them apart from text of the note
+placeholder = "labnoteblock{}x{}"
+placeholder_re = re.compile(r"labnoteblock([0-9a-f]+)x(\d+)$")
+separator = ".. labnoteblock"
+
+list_nodes = (docutils.nodes.bullet_list, docutils.nodes.enumerated_list,
+              docutils.nodes.definition_list, docutils.nodes.field_list,
+              docutils.nodes.option_list, docutils.nodes.line_block)
+
+# references to other parts of the document or global state
+global_nodes = (docutils.nodes.system_message, docutils.nodes.section,
+                docutils.nodes.transition, docutils.nodes.target,
+                docutils.nodes.footnote, docutils.nodes.footnote_reference,
+                docutils.nodes.citation, docutils.nodes.citation_reference,
+                docutils.nodes.substitution_definition,
+                docutils.nodes.substitution_reference,
+                docutils.nodes.pending, docutils.nodes.decoration,
+                docutils.nodes.docinfo, docutils.nodes.title)
+
+
+def split_blocks(rst):
+    # returns list of (first line, lines)
+    blocks = []
+    lines = rst.splitlines()
+    start = 0
+    for (no, line) in enumerate(lines):
+        if not no:
+            continue
+        if line and not line[0].isspace() and not lines[no-1].strip():
+            blocks.append((start, lines[start:no]))
+            start = no
+    if lines:
+        blocks.append((start, lines[start:]))
+    return blocks
+
+
+def first_line(lines):
+    for line in lines:
+        if line.strip():
+            return line
+    return ""
+
+def last_line(lines):
+    for line in reversed(lines):
+        if line.strip():
+            return line
+    return ""
+
+def is_list(lines):
+    line = first_line(lines)
+    if list_start.match(line) or list_like.match(line):
+        return True
+    # definition list
+    for (no, line) in enumerate(lines[:-1]):
+        if line.strip() and not line[0].isspace():
+            if lines[no+1].strip() and lines[no+1][0].isspace():
+                return True
+    return False
+
+def is_local(lines, prev, nxt):
+    line = first_line(lines)
+    if not line or line[0].isspace():
+        return False
+
+    # quoted literal block
+    if prev and last_line(prev).rstrip().endswith("::"):
+        return False
+
+    for l in lines:
+        if adornment.match(l):
+            return False
+
+    if local_directive.match(line):
+        return True
+
+    if list_start.match(line):
+        # lists merge with neighbouring lists
+        if prev and is_list(prev):
+            return False
+        if nxt and is_list(nxt):
+            return False
+        return True
+
+    if markup_start.match(line):
+        return False
+
+    if is_list(lines):
+        return False
+
+    return True
+
+
+def has_messages(dtree):
+    # messages from transforms are added to the tree by the writer
+    if dtree.transform_messages:
+        return True
+    for node in dtree.traverse(docutils.nodes.system_message):
+        return True
+    return False
+
+def nodes_are_local(nodes):
+    if not nodes:
+        return False
+    for child in nodes:
+        # bullet and enumerated lists are checked against their neighbours
+        if isinstance(child, list_nodes):
+            if not isinstance(child, (docutils.nodes.bullet_list, docutils.nodes.enumerated_list)):
+                return False
+        for node in child.traverse(docutils.nodes.Element):
+            if isinstance(node, global_nodes):
+                return False
+            if node["ids"] or node["names"]:
+                return False
+            if "refname" in node or "refid" in node or node.get("anonymous"):
+                return False
+    return True
+
+
+def digest(lines):
+    h = hashlib.sha1()
+    for line in lines:
+        h.update(line.encode("utf-8", "surrogatepass"))
+        h.update(b"\n")
+    return h.digest()
+
+
+class BlockRenderer():
+
+    def __init__(self, settings, prep=None):
+        # engine is reused, setting it up costs more than parsing a block
+        self.engine = Engine("string", "null", settings)
+        # applied to every parsed doctree (blocks and skeleton)
+        self.prep = prep
+        self.nonce = os.urandom(8).hex()
+        self.reset()
+
+    def reset(self):
+        # hash -> list of nodes or None if block is not local
+        # line numbers are relative to the block
+        self.blocks = {}
+        # (hash, doctree), line numbers refer to the skeleton,
+        # doctree is None if the skeleton can not be used
+        self.skeleton = (None, None)
+        # the last full parse had messages, a skeleton would have them too
+        self.messages = False
+
+    def parse(self, rst):
+        self.engine.publish(rst)
+        dtree = self.engine.document
+        if self.prep:
+            dtree = self.prep(dtree)
+        return dtree
+
+    def parse_block(self, lines):
+        try:
+            dtree = self.parse("\n".join(lines) + "\n")
+        except docutils.utils.SystemMessage:
+            return None
+        if has_messages(dtree) or not nodes_are_local(dtree.children):
+            return None
+        return dtree.children
+
+    def parse_blocks(self, blocks):
+        # local blocks do not interact, so they can be parsed in one go,
+        # separated by comments
+        text = []
+        starts = []
+        for lines in blocks:
+            starts.append(len(text))
+            text.extend(lines)
+            if lines[-1].strip():
+                text.append("")
+            text.extend([separator, ""])
+        try:
+            dtree = self.parse("\n".join(text) + "\n")
+        except docutils.utils.SystemMessage:
+            dtree = None
+
+        if dtree is None or dtree.transform_messages:
+            return [self.parse_block(lines) for lines in blocks]
+
+        res = []
+        nodes = []
+        for child in dtree.children:
+            if isinstance(child, docutils.nodes.comment) and child.astext() == separator[3:]:
+                res.append(nodes)
+                nodes = []
+            else:
+                nodes.append(child)
+        if nodes or len(res) != len(blocks):
+            return [self.parse_block(lines) for lines in blocks]
+
+        for (i, nodes) in enumerate(res):
+            if not nodes_are_local(nodes):
+                res[i] = None
+                continue
+            for child in nodes:
+                child.parent = None
+                for elem in child.traverse(docutils.nodes.Element):
+                    if elem.line:
+                        elem.line -= starts[i]
+        return res
+
+    def full(self, rst):
+        log.debug("render: full")
+        dtree = self.parse(rst)
+        self.messages = has_messages(dtree)
+        return dtree
+
+    def fallback(self, rst, key):
+        # the skeleton of key is not used again
+        self.skeleton = (key, None)
+        return self.full(rst)
+
+    def doctree(self, rst):
+
+        # parsing blocks and skeleton would only add to the full parse,
+        # until the messages are gone
+        if self.messages or global_directive.search(rst) or global_anonymous.search(rst):
+            return self.full(rst)
+
+        blocks = split_blocks(rst)
+
+        ## parse changed blocks
+        cache = {}
+        local = []
+        missing = {}
+        for (i, (start, lines)) in enumerate(blocks):
+            prev = blocks[i-1][1] if i else None
+            nxt = blocks[i+1][1] if i+1 < len(blocks) else None
+            key = None
+            if is_local(lines, prev, nxt):
+                key = digest(lines)
+                if key in self.blocks:
+                    cache[key] = self.blocks[key]
+                elif key not in cache:
+                    missing[key] = lines
+            local.append(key)
+        if missing:
+            log.debug("render: {} blocks".format(len(missing)))
+            keys = list(missing)
+            for (key, nodes) in zip(keys, self.parse_blocks([missing[k] for k in keys])):
+                cache[key] = nodes
+        # drop blocks which are gone
+        self.blocks = cache
+        local = [cache[key] if key else None for key in local]
+
+        ## skeleton
+        skel = []
+        linemap = []
+        n = 0
+        for ((start, lines), nodes) in zip(blocks, local):
+            if nodes is None:
+                skel.extend(lines)
+                linemap.extend(range(start, start + len(lines)))
+            else:
+                skel.append(placeholder.format(self.nonce, n))
+                skel.append("")
+                linemap.extend([start, start])
+                n += 1
+        key = digest(skel)
+
+        if key != self.skeleton[0]:
+            log.debug("render: skeleton")
+            try:
+                dtree = self.parse("\n".join(skel) + "\n")
+            except docutils.utils.SystemMessage:
+                return self.fallback(rst, key)
+            if has_messages(dtree):
+                # line numbers in messages do not match the buffer
+                return self.fallback(rst, key)
+            self.skeleton = (key, dtree)
+        elif self.skeleton[1] is None:
+            return self.full(rst)
+
+        dtree = self.skeleton[1].deepcopy()
+        for node in dtree.traverse(docutils.nodes.Element):
+            # line numbers are 1-based
+            if node.line and node.line <= len(linemap):
+                node.line = linemap[node.line-1] + 1
+
+        ## assemble
+        fragments = [(b[0], d) for (b, d) in zip(blocks, local) if d is not None]
+        found = 0
+        for node in list(dtree.traverse(docutils.nodes.paragraph)):
+            mat = placeholder_re.match(node.astext())
+            if not mat or mat.group(1) != self.nonce:
+                continue
+            if not isinstance(node.parent, (docutils.nodes.document, docutils.nodes.section)):
+                return self.fallback(rst, key)
+            i = int(mat.group(2))
+            if i >= len(fragments):
+                return self.fallback(rst, key)
+            (start, fragment) = fragments[i]
+            nodes = []
+            for child in fragment:
+                child = child.deepcopy()
+                for elem in child.traverse(docutils.nodes.Element):
+                    if elem.line:
+                        elem.line += start
+                nodes.append(child)
+            node.parent.replace(node, nodes)
+            found += 1
+
+        if found != len(fragments):
+            return self.fallback(rst, key)
+
+        return dtree
+
+
+## page cache
+#
+# Rendered pages of visited files, so going back and forth between files
+# does not render them again.  Positions are kept for every visited file.
+
+def page_key(path, rst, startdir):
+    # None if the page should not be cached
+    # the body depends on the text, and on path and startdir, links are
+    # rewritten against them (Pipeline.dtree_prep), stylesheets are part
+    # of the shell
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    h = hashlib.sha1(rst.encode("utf-8", "surrogatepass")).digest()
+    return (st.st_mtime_ns, st.st_size, h, startdir)
+
+
+class PageCache():
+
+    def __init__(self, size):
+        # characters of html
+        self.size = size
+        self.used = 0
+        # path -> (key, html, lines of the blocks)
+        self.pages = collections.OrderedDict()
+        # path -> (line, scroll)
+        self.positions = {}
+
+    def get(self, path, key):
+        if key is None or path not in self.pages:
+            return None
+        self.pages.move_to_end(path)
+        (key_, html, lines) = self.pages[path]
+        if key_ != key:
+            self.invalidate(path)
+            return None
+        return (html, lines)
+
+    def put(self, path, key, html, lines):
+        if key is None:
+            return
+        self.invalidate(path)
+        if len(html) > self.size:
+            return
+        self.pages[path] = (key, html, lines)
+        self.used += len(html)
+        while self.used > self.size:
+            (path_, (key_, html_, lines_)) = self.pages.popitem(last=False)
+            self.used -= len(html_)
+
+    def invalidate(self, path):
+        if path in self.pages:
+            (key, html, lines) = self.pages.pop(path)
+            self.used -= len(html)
+
+    def position(self, path):
+        return self.positions.get(path, (0, None))
+
+    def set_position(self, path, line, scroll):
+        self.positions[path] = (line, scroll)
+
+
+## live update
+#
+# Top-level blocks (children of the document or a section) are wrapped in
+# comments by BlockTranslator.  Comparing the blocks of two renders gives
+# the range of blocks which has to be replaced in the loaded page, as long
+# as the sections around them did not change.
+
+block_start = "<!--lnb-->"
+block_end = "<!--/lnb-->"
+block_re = re.compile(r"<!--/?lnb-->")
+
+
+def is_block(node):
+    if isinstance(node, (docutils.nodes.section, docutils.nodes.title)):
+        return False
+    return isinstance(node.parent, (docutils.nodes.document, docutils.nodes.section))
+
+
+class BlockTranslator(docutils.writers.html4css1.HTMLTranslator):
+
+    def dispatch_visit(self, node):
+        if not is_block(node):
+            return docutils.writers.html4css1.HTMLTranslator.dispatch_visit(self, node)
+
+        self.body.append(block_start)
+        try:
+            docutils.writers.html4css1.HTMLTranslator.dispatch_visit(self, node)
+        except (docutils.nodes.SkipNode, docutils.nodes.SkipDeparture):
+            # departure is not called
+            self.body.append(block_end)
+            raise
+
+    def dispatch_departure(self, node):
+        docutils.writers.html4css1.HTMLTranslator.dispatch_departure(self, node)
+        if is_block(node):
+            self.body.append(block_end)
+
+
+def html_writer(blocks=False):
+    writer = docutils.writers.html4css1.Writer()
+    if blocks:
+        writer.translator_class = BlockTranslator
+    return writer
+
+
+def split_body(html):
+    # html: body fragment
+    # returns (separators, blocks)
+    # separators[i] is in front of blocks[i], the last one after all blocks
+    parts = block_re.split(html)
+    return (parts[0::2], parts[1::2])
+
+
+def diff_blocks(old, new):
+    # returns (first block, number of old blocks, html of new blocks)
+    # or None if the page has to be reloaded
+    (old_sep, old_blocks) = old
+    (new_sep, new_blocks) = new
+    no = len(old_blocks)
+    nn = len(new_blocks)
+
+    p = 0
+    while p < no and p < nn:
+        if old_blocks[p] != new_blocks[p] or old_sep[p] != new_sep[p]:
+            break
+        p += 1
+
+    q = 0
+    while q < no - p and q < nn - p:
+        if old_blocks[no-q-1] != new_blocks[nn-q-1] or old_sep[no-q] != new_sep[nn-q]:
+            break
+        q += 1
+
+    if p == no and p == nn and old_sep[no] == new_sep[nn]:
+        # unchanged
+        return (p, 0, "")
+
+    if not no:
+        return None
+
+    # blocks in between have to share the same parent
+    inner = old_sep[p+1:no-q] + new_sep[p+1:nn-q]
+    for sep in inner:
+        if sep.strip():
+            return None
+
+    outer = [old_sep[p], new_sep[p], old_sep[no-q], new_sep[nn-q]]
+    if old_sep[p] != new_sep[p] or old_sep[no-q] != new_sep[nn-q]:
+        return None
+    if p == no - q:
+        # insertion, the position is only known between two blocks
+        for sep in outer:
+            if sep.strip():
+                return None
+
+    html = []
+    for i in range(p, nn-q):
+        if i != p:
+            html.append(new_sep[i])
+        html.extend([block_start, new_blocks[i], block_end])
+
+    return (p, no - p - q, "".join(html))
+
+
+## line index
+#
+# Source lines of the nodes of a doctree.  Line numbers of nodes in document
+# order are not sorted (e.g. the title of a section carries the line of its
+# underline), the running maximum is.  The first node with a line greater
+# than the cursor line is the first one whose running maximum is greater,
+# so lookups are a bisection.
+
+class LineIndex():
+
+    def __init__(self, dtree):
+        # nodes with line info in document order
+        self.nodes = []
+        # lines[i] is the greatest line of nodes[:i+1]
+        self.lines = []
+        line = 0
+        for elem in dtree.traverse(siblings=True):
+            if not elem.line:
+                continue
+            line = max(line, elem.line)
+            self.nodes.append(elem)
+            self.lines.append(line)
+
+    def node_before(self, line, skip):
+        # node in front of the last one starting at or before line,
+        # nodes with a tagname in skip are passed over
+        i = bisect.bisect_right(self.lines, line) - 2
+        while i >= 0:
+            if self.nodes[i].tagname not in skip:
+                return self.nodes[i]
+            i -= 1
+        return None
+
+
+def first_node_line(node):
+    # line of node or of its first descendant having one
+    if node.line:
+        return node.line
+    for child in node.children:
+        line = first_node_line(child)
+        if line:
+            return line
+    return None
+
+
+def block_lines(dtree):
+    # first line of every top level block, in the order of the block
+    # comments in the html (see BlockTranslator), running maximum
+    # writing removes nodes (e.g. filtered messages), call it afterwards
+    lines = []
+    line = 0
+    stack = list(reversed(dtree.children))
+    while stack:
+        node = stack.pop()
+        if isinstance(node, docutils.nodes.section):
+            stack.extend(reversed(node.children))
+            continue
+        if isinstance(node, docutils.nodes.title):
+            continue
+        line = max(line, first_node_line(node) or 0)
+        lines.append(line)
+    return lines
+
+
+def block_at(lines, line):
+    # block containing line (same numbering as node.line), -1 if none
+    return bisect.bisect_right(lines, line) - 1
+
+
+## publishing
+#
+# Setting up a publisher (option parser, settings validation, reader, parser
+# and writer) costs more than rendering a small document.  An engine keeps
+# one publisher per configuration and reuses it for every document.
+
+class Engine():
+
+    def __init__(self, source, writer, settings):
+        # source: "string" (rst text) or "doctree"
+        # writer: writer name or writer instance
+        if source == "doctree":
+            reader = docutils.readers.doctree.Reader(parser_name="null")
+            self.publisher = docutils.core.Publisher(reader, None, None,
+                                                     destination_class=docutils.io.StringOutput)
+        else:
+            self.publisher = docutils.core.Publisher(source_class=docutils.io.StringInput,
+                                                     destination_class=docutils.io.StringOutput)
+            self.publisher.set_reader("standalone", None, "restructuredtext")
+        if isinstance(writer, str):
+            self.publisher.set_writer(writer)
+        else:
+            self.publisher.writer = writer
+        self.source = source
+        self.publisher.process_programmatic_settings(None, settings, None)
+
+    def publish(self, source, **overrides):
+        # overrides: string settings which need no validation,
+        # they stay set for following calls
+        for (key, value) in overrides.items():
+            setattr(self.publisher.settings, key, value)
+        if self.source == "doctree":
+            self.publisher.source = docutils.io.DocTreeInput(source)
+        else:
+            self.publisher.set_source(source, None)
+        self.publisher.set_destination(None, None)
+        return self.publisher.publish()
+
+    @property
+    def document(self):
+        return self.publisher.document
+
+    @property
+    def parts(self):
+        return self.publisher.writer.parts
+
+
+# (source, writer, settings) -> Engine
+engines = {}
+
+
+def engine(source, writer, settings):
+    # engines are only rebuilt when the configuration changes
+    # writer: writer name or function returning a writer instance
+    key = (source, writer, tuple(sorted(settings.items())))
+    try:
+        return engines[key]
+    except KeyError:
+        pass
+    if not isinstance(writer, str):
+        writer = writer()
+    e = Engine(source, writer, settings)
+    engines[key] = e
+    return e
+
+
+def block_writer():
+    return html_writer(blocks=True)
+
+
+## uris
+#
+# Links and images are rewritten to file://labnote.{int,ext}.{abs,rel}/...,
+# so the editor can tell notes (int) from other files (ext) when loading.
+
+def ref2uri(refuri, curdir, startdir):
+    ## path to uri
+
+    if "://" in refuri:
+        if not refuri.startswith("file://"):
+            return None
+
+    if refuri.startswith("file://"):
+        a = "ext"
+        refuri = refuri[7:]
+    else:
+        a = "int"
+
+    if refuri.startswith("/"):
+        b = "abs"
+        refuri = refuri[1:]
+    else:
+        b = "rel"
+
+    if refuri.startswith("..") and b == "rel":
+        if a == "int":
+            refuri = curdir + "/" + refuri
+            refuri = os.path.normpath(refuri)
+            b = "abs"
+        if a == "ext":
+            refuri = startdir + "/" + refuri
+            refuri = os.path.normpath(refuri)
+            refuri = refuri[1:]
+            b = "abs"
+
+    refuri = "file://labnote.{}.{}/{}".format(a, b, refuri)
+    return refuri
+
+
+def uri2path(uri, curdir, startdir):
+    ## uri to path
+    uri_ = uri[23:]
+
+    if uri[15:18] == "ext":
+        ext = True
+        if uri[19:22] == "rel":
+            uri_ = startdir + "/" + uri_
+        else:
+            uri_ = "/" + uri_
+    else:
+        ext = False
+        if uri[19:22] == "rel":
+            if curdir:
+                uri_ = curdir + "/" + uri_
+
+    return uri_, ext
+
+
+## pipeline
+#
+# Everything between the text of a note and the html of the preview, used by
+# the editor and by "labnote bench".
+
+# placed in front of the edited element, see scroll() in the shell
+scroll_mark = "<a id='btj0m1ve'></a>"
+
+
+class Pipeline():
+
+    def __init__(self, startdir, stats=None):
+        # startdir is an abs path
+        self.startdir = startdir
+        # relative to startdir including filename
+        self.current_file = ""
+
+        # caches parsed blocks of the current file
+        # messages are in the doctree, not on stderr
+        pargs = {"_disable_config": True, "doctitle_xform": False, "warning_stream": False}
+        self.renderer = BlockRenderer(pargs, self.dtree_prep)
+        # spaces in links, only changed lines are handled
+        self.preprocess = Preprocessor()
+
+        # time spent in the phases of rendering, milliseconds
+        if stats is None:
+            stats = Stats()
+        self.stats = stats
+        # counting needs a traversal of the whole doctree
+        self.count_nodes = False
+        # parse only changed blocks, off for text which is rendered once
+        self.incremental = True
+        # time in dtree_prep during the current render, seconds
+        self.prep_time = 0
+
+    def set_file(self, path):
+        # links are rewritten relative to the current file
+        self.current_file = path
+        self.renderer.reset()
+        self.preprocess = Preprocessor()
+
+    def dtree_prep(self, dtree):
+        ## path to uri
+
+        start = time.perf_counter()
+
+        for elem in dtree.traverse(siblings=True):
+            if elem.tagname == "reference" or elem.tagname == "image":
+                try:
+                    if elem.tagname == "reference":
+                        refuri = elem["refuri"]
+                    if elem.tagname == "image":
+                        refuri = elem["uri"]
+                except KeyError:
+                    continue
+
+                refuri = ref2uri(refuri, os.path.dirname(self.current_file), self.startdir)
+                if not refuri:
+                    continue
+
+                if elem.tagname == "reference":
+                    elem["refuri"] = refuri
+                if elem.tagname == "image":
+                    elem["uri"] = refuri
+
+        self.prep_time += time.perf_counter() - start
+
+        return dtree
+
+    def render(self, rst, line=None):
+        # line: place scroll mark in front of this line
+        # returns the body fragment and the first source line of each block
+
+        with self.stats.timer("render"):
+            return self.render_(rst, line)
+
+    def render_(self, rst, line):
+
+        self.stats.add("size", len(rst))
+
+        # docutils: imho a bug
+        with self.stats.timer("preprocess"):
+            rst = self.preprocess(rst)
+
+        if line is not None:
+            node_mark = docutils.nodes.raw(scroll_mark, scroll_mark, format="html")
+
+        self.prep_time = 0
+        start = time.perf_counter()
+        try:
+            if self.incremental:
+                # only parses changed blocks
+                dtree = self.renderer.doctree(rst)
+            else:
+                dtree = self.renderer.full(rst)
+        except docutils.utils.SystemMessage as e:
+            return ("Error<br>" + str(e), [])
+        self.stats.add("parse", (time.perf_counter() - start - self.prep_time) * 1000)
+        self.stats.add("prep", self.prep_time * 1000)
+
+        if self.count_nodes:
+            self.stats.add("nodes", sum(1 for node in dtree.traverse()))
+
+        # scroll to current edit
+        if line is not None:
+            start = time.perf_counter()
+
+            # appending can not work
+            blacklist = ["comment", "math_block", "section",
+                         "field", "line_block", "footnote",
+                         "bullet_list", "enumerated_list",
+                         "definition_list_item", "substitution_definition"]
+
+            # we want to insert scroll mark in front of currently edited elemet
+            elem = LineIndex(dtree).node_before(line, blacklist)
+            if elem:
+                log.debug("append mark to: " + elem.tagname)
+                elem += node_mark
+
+            self.stats.add("mark", (time.perf_counter() - start) * 1000)
+
+        # more debug
+        if log.isEnabledFor(logging.DEBUG):
+            pretty = docutils.core.publish_from_doctree(dtree, writer_name="pseudoxml")
+            with open("/tmp/labnote.dtree", "w") as f:
+                f.write(pretty.decode())
+
+        # stylesheets are part of the shell
+        args = {
+            "_disable_config": True,
+            "embed_stylesheet": False,
+            "stylesheet_path": "",
+            "stylesheet": "",
+            "math_output": "HTML",
+            "output_encoding": "unicode",
+            "warning_stream": False,
+        }
+
+        start = time.perf_counter()
+        try:
+            # reused as long as the configuration does not change,
+            # blocks are marked for live updates and jumps
+            engine_ = engine("doctree", block_writer, args)
+            engine_.publish(dtree)
+            html = engine_.parts["html_body"]
+            # writing removes nodes, the blocks match the html now
+            lines = block_lines(dtree)
+
+        except docutils.utils.SystemMessage as e:
+            html = "Error<br>" + str(e)
+            lines = []
+        except AttributeError as e:
+            # docutils: parser should support optionally omitting broken nodes
+            html = "Error<br>" + str(e)
+            lines = []
+        self.stats.add("write", (time.perf_counter() - start) * 1000)
+
+        return (html, lines)
+
+
+## large documents
+#
+# Above a configured size the preview is split into chunks at top-level
+# sections, long sections at their blocks.  Opening a file renders only the
+# chunk at the cursor, the others are shown as placeholders and rendered
+# when they are scrolled into view or in the background, so the first paint
+# does not depend on the size of the file.
+#
+# Chunks are rendered on their own.  Explicit targets and substitutions are
+# copied into every chunk, other references across chunks (section titles,
+# footnotes) are not resolved.
+
+# characters
+chunk_size = 16384
+
+# explicit targets and substitution definitions, not anonymous targets
+definition_start = re.compile(r"\.\. +(_[^_:]|\|[^|]+\| )")
+
+chunk_container = '<div class="lnchunk">{}</div>\n'
+# placeholder, about as high as the rendered chunk
+lazy_container = '<div class="lnchunk lnlazy" data-key="{}" style="min-height: {:.1f}em"></div>\n'
+
+
+def title_style(lines):
+    # adornment of a section title block, None if it is none
+    if len(lines) >= 3 and adornment.match(lines[0]) and adornment.match(lines[2]):
+        return (lines[0][0], True)
+    if len(lines) >= 2 and lines[0].strip() and adornment.match(lines[1]):
+        return (lines[1][0], False)
+    return None
+
+
+def split_chunks(rst, size):
+    # returns list of (first line, lines, definitions)
+    chunks = []
+    top = None
+    current = (0, [], [])
+    length = 0
+    after_title = False
+    for (start, lines) in split_blocks(rst):
+        style = title_style(lines)
+        if style and top is None:
+            top = style
+        if current[1] and not after_title:
+            if length >= size or (style and style == top and length >= size // 4):
+                chunks.append(current)
+                current = (start, [], [])
+                length = 0
+        current[1].extend(lines)
+        if definition_start.match(lines[0]):
+            current[2].append("\n".join(lines) + "\n")
+        length += sum(len(line) + 1 for line in lines)
+        # a title stays with its section
+        after_title = bool(style)
+    if current[1]:
+        chunks.append(current)
+    return chunks
+
+
+class LargeDocument():
+    # preview of a large document, see split_chunks
+    #
+    # The chunk at the cursor is rendered by the incremental pipeline of the
+    # editor, placeholders by a pipeline doing full parses.  Rendered chunks
+    # are cached by content, the page keeps chunks which are not up to date
+    # until they are rendered again.
+
+    def __init__(self, pipeline, lazy, size=chunk_size):
+        self.pipeline = pipeline
+        self.lazy = lazy
+        self.size = size
+        # (first line, number of lines, text, key, definitions of the others)
+        self.chunks = []
+        # key -> (html, block lines relative to the chunk, definitions)
+        self.cache = {}
+        # (index, html) of the chunk at the cursor, html contains the mark
+        self.cursor = None
+
+        # containers on the loaded page
+        self.page = []
+        # first source line of each rendered block on the page
+        self.lines = []
+        # (first line, end) of the rendered chunks on the page
+        self.ranges = []
+
+    def update(self, rst, line):
+        # splits rst and renders the chunk containing line
+        chunks = split_chunks(rst, self.size)
+        defs = [d for (start, lines, own) in chunks for d in own]
+        self.chunks = []
+        for (start, lines, own) in chunks:
+            own = set(own)
+            other = "".join(d for d in defs if d not in own)
+            text = "\n".join(lines) + "\n"
+            key = digest(lines).hex()
+            self.chunks.append((start, len(lines), text, key, other))
+
+        # drop chunks which are gone
+        keys = set(chunk[3] for chunk in self.chunks)
+        self.cache = dict((k, v) for (k, v) in self.cache.items() if k in keys)
+
+        self.cursor = None
+        starts = [chunk[0] for chunk in self.chunks]
+        i = bisect.bisect_right(starts, line) - 1
+        if i >= 0:
+            html = self.render(self.pipeline, i, line - starts[i])
+            self.cursor = (i, html)
+
+    def render(self, pipeline, i, line=None):
+        (start, count, text, key, other) = self.chunks[i]
+        (html, lines) = pipeline.render(text + "\n" + other, line)
+        # blocks of the copied definitions belong to the end of the chunk
+        lines = [min(n, count) for n in lines]
+        self.cache[key] = (html.replace(scroll_mark, ""), lines, other)
+        return html
+
+    def render_key(self, key):
+        # renders a placeholder, False if there is nothing to do
+        for (i, chunk) in enumerate(self.chunks):
+            if chunk[3] != key:
+                continue
+            if key in self.cache and self.cache[key][2] == chunk[4]:
+                return False
+            self.render(self.lazy, i)
+            return True
+        return False
+
+    def pending(self):
+        # keys of chunks which are not up to date, closest to the cursor first
+        cur = self.cursor[0] if self.cursor else 0
+        keys = []
+        for i in sorted(range(len(self.chunks)), key=lambda i: abs(i - cur)):
+            (start, count, text, key, other) = self.chunks[i]
+            if key in keys:
+                continue
+            if key not in self.cache or self.cache[key][2] != other:
+                keys.append(key)
+        return keys
+
+    def layout(self):
+        # containers, block lines and rendered ranges of the page as it should be
+        page = []
+        lines = []
+        ranges = []
+        line = 0
+        for (i, (start, count, text, key, other)) in enumerate(self.chunks):
+            if key not in self.cache:
+                page.append(lazy_container.format(key, count * 1.3))
+                continue
+            (html, rel, other_) = self.cache[key]
+            if self.cursor and self.cursor[0] == i:
+                html = self.cursor[1]
+            page.append(chunk_container.format(html))
+            for n in rel:
+                line = max(line, start + n)
+                lines.append(line)
+            ranges.append((start, start + count))
+        return (page, lines, ranges)
+
+    def html(self):
+        # body of the page
+        (self.page, self.lines, self.ranges) = self.layout()
+        return "".join(self.page)
+
+    def diff(self):
+        # returns (number of chunks on the page, first, count, html of new chunks)
+        # or None if the page is up to date
+        old = self.page
+        (new, self.lines, self.ranges) = self.layout()
+        self.page = new
+
+        p = 0
+        while p < len(old) and p < len(new) and old[p] == new[p]:
+            p += 1
+        q = 0
+        while q < len(old) - p and q < len(new) - p and old[-q-1] == new[-q-1]:
+            q += 1
+        if p == len(old) and p == len(new):
+            return None
+        return (len(old), p, len(old) - p - q, "".join(new[p:len(new)-q]))
+
+    def shown(self, line):
+        # whether the chunk containing line is rendered on the page
+        i = bisect.bisect_right(self.ranges, (line, float("inf"))) - 1
+        return i >= 0 and line < self.ranges[i][1]
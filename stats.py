@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+# Copyright 2016-2019 Thomas Krug
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import json
+import math
+import threading
+import time
+import unittest
+
+
+## render statistics
+#
+# Values are counted in logarithmic buckets, each one 5 % wider than the
+# previous, so percentiles are off by at most 5 % and memory does not grow
+# with the number of renders.
+
+base = 1.05
+
+
+class Histogram():
+
+    def __init__(self):
+        # bucket -> count, bucket b holds values in [base**b, base**(b+1))
+        self.buckets = collections.Counter()
+        # values <= 0
+        self.zero = 0
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        if value <= 0:
+            self.zero += 1
+        else:
+            self.buckets[math.floor(math.log(value, base))] += 1
+
+    def percentile(self, p):
+        # p in [0, 100]
+        if not self.count:
+            return None
+        rank = p / 100 * self.count
+        seen = self.zero
+        if seen and seen >= rank:
+            return min(0, self.max)
+        for b in sorted(self.buckets):
+            seen += self.buckets[b]
+            if seen >= rank:
+                # middle of the bucket
+                value = base ** (b + 0.5)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def summary(self):
+        if not self.count:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "mean": self.total / self.count,
+            "min": self.min,
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+        }
+
+
+class Stats():
+    # times in milliseconds, filled from the gtk and the render thread
+
+    def __init__(self):
+        self.hists = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    def add(self, name, value):
+        with self.lock:
+            if name not in self.hists:
+                self.hists[name] = Histogram()
+            self.hists[name].add(value)
+
+    def timer(self, name):
+        return Timer(self, name)
+
+    def summary(self):
+        with self.lock:
+            res = collections.OrderedDict()
+            for (name, hist) in self.hists.items():
+                res[name] = hist.summary()
+            return res
+
+    def dump(self, path):
+        res = {
+            "started": self.started,
+            "dumped": time.time(),
+            "phases": self.summary()
+        }
+        with open(path, "w") as f:
+            json.dump(res, f, indent=2)
+            f.write("\n")
+
+
+class Timer():
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, typ, value, tb):
+        self.elapsed = (time.perf_counter() - self.start) * 1000
+        self.stats.add(self.name, self.elapsed)
+        return False
+
+
+class Tests(unittest.TestCase):
+
+    def test_percentiles(self):
+        hist = Histogram()
+        for i in range(1, 1001):
+            hist.add(i)
+        for p in (50, 95, 99):
+            self.assertAlmostEqual(hist.percentile(p), p * 10, delta=p * 10 * (base - 1))
+        self.assertAlmostEqual(hist.percentile(100), 1000, delta=1000 * (base - 1))
+        self.assertAlmostEqual(hist.percentile(0), 1, delta=base - 1)
+
+    def test_single(self):
+        hist = Histogram()
+        hist.add(3.5)
+        summary = hist.summary()
+        self.assertEqual(summary["p50"], 3.5)
+        self.assertEqual(summary["p99"], 3.5)
+
+    def test_zero(self):
+        hist = Histogram()
+        hist.add(0)
+        hist.add(0)
+        hist.add(10)
+        self.assertEqual(hist.percentile(50), 0)
+        self.assertAlmostEqual(hist.percentile(99), 10, delta=0.5)
+
+    def test_empty(self):
+        self.assertEqual(Histogram().summary(), {"count": 0})
+
+    def test_stats(self):
+        stats = Stats()
+        with stats.timer("a"):
+            pass
+        stats.add("b", 5)
+        summary = stats.summary()
+        self.assertEqual(list(summary), ["a", "b"])
+        self.assertEqual(summary["b"]["count"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()